@@ -8,13 +8,20 @@ cd ~/ant-cloud || exit
 
 echo "Starting Ant Cloud servers and client..."
 
-# Start picture server
-python server-picture.py &
-PID1=$!
-
-# Start labeler server
-python server-labeler.py &
-PID2=$!
+if [ "$ANTPI_COMBINED" = "1" ]; then
+    # Gallery and labeler in one process, both on port 5000
+    python server.py &
+    PID1=$!
+    PID2=$PID1
+else
+    # Start picture server
+    python server-picture.py &
+    PID1=$!
+
+    # Start labeler server
+    python server-labeler.py &
+    PID2=$!
+fi
 
 # Start GPIO/camera client (the button + GPS + BME280 script)
 python client.py &
@@ -0,0 +1,257 @@
+"""
+Pick the deployment detector for one device under a latency or energy budget.
+
+    python autotune.py rpi5 --latency-ms 150 --min-map 0.5
+    python autotune.py rpi3 --energy-j 0.8 --min-map 0.45 --imgsz 320,480,640
+
+The search space is benchmark.py's matrix x input sizes x intra-op threads,
+explored in stages on the device's worker instead of as a full grid:
+
+1. screen latency (p95 per image) or energy (J/image) on the first
+   SCREEN_IMAGES test images, cheapest candidates first, converting the
+   ones not in the device's conversion cache yet; a candidate over
+   budget prunes every candidate of the same family/precision/format with a
+   model and input size at least as large
+2. validate the survivors (mAP50-95), FP32 and large inputs first; one below
+   the accuracy floor prunes the lower precisions and smaller inputs of the
+   same model/format
+3. time the most accurate survivors on the whole test set until one stays
+   within budget, then sweep its thread count
+
+The winner is written as a JSON config that client.py loads (DETECTOR_CONFIG).
+Candidates that could not be converted or measured are listed at the end.
+Screening, accuracy and confirmation results go to the result store under
+the run id, so `benchmark.py --run <id> --analyse-only` shows them too.
+"""
+import os
+import json
+import argparse
+from datetime import datetime
+from time import time, sleep
+from benchmark import (
+    DEVICES, IMGSZS, IDLE_BASELINE_S, SCRIPT_FOLDER, BenchmarkWorker, experiment_matrix,
+    local_worker_command, power_analysis, run_experiments, ssh_worker_command,
+)
+from results import ResultStore, DEFAULT_STORE
+
+DEFAULT_CONFIG = "detector_config.json"
+
+# Images per screening run, and how far over budget a (noisy) screening
+# result may be before the candidate is pruned
+SCREEN_IMAGES = 20
+SCREEN_MARGIN = 0.1
+
+# Most accurate candidates confirmed on the full test set
+CONFIRM_TOP = 3
+
+THREADS = [1, 2, 4]
+
+# Model size within a family (v9t < v9s < v9m, v11n < v11s < v11m) and
+# precision fidelity, lowest first
+SIZE_ORDER = "tnsm"
+PREC_ORDER = ["INT8", "FP16", "FP32"]
+
+
+def family(mod):
+    return mod[:-1]
+
+
+def size_rank(mod):
+    return SIZE_ORDER.index(mod[-1])
+
+
+def at_least_as_costly(a, b):
+    """b costs at least as much as a: same family/precision/format, model and imgsz no smaller."""
+    return (family(a[0]) == family(b[0]) and a[1:3] == b[1:3]
+            and size_rank(b[0]) >= size_rank(a[0]) and b[3] >= a[3])
+
+
+def at_most_as_accurate(a, b):
+    """b is expected no more accurate than a: same model/format, precision and imgsz no higher."""
+    return (a[0] == b[0] and a[2] == b[2]
+            and PREC_ORDER.index(b[1]) <= PREC_ORDER.index(a[1]) and b[3] <= a[3])
+
+
+def cost(data, budget_kind):
+    return data.get("call_ms_p95") if budget_kind == "latency" else data.get("J_per_image")
+
+
+def convert(worker, combo):
+    """Convert a candidate on the device unless it is cached; True if its artifact exists."""
+    if combo[2] == "pytorch":
+        return True
+    mod, prec, form, imgsz = combo
+    req_id = worker.submit("convert_model", mod=mod, prec=prec, form=form, imgsz=imgsz)
+    while True:
+        event = worker.read()
+        if event.get("id") != req_id:
+            print("Worker:", event)
+        elif event["event"] == "result":
+            return True
+        elif event["event"] == "error":
+            print(f"Conversion of {' '.join(map(str, combo))} failed: {event.get('message')}")
+            return False
+
+
+def measure(worker, combo, power_log, baseline, **args):
+    """One run_test on the worker: (started, finished, data) or None, with J_per_image when metered."""
+    for started, finished, _, data in run_experiments(worker, [combo], **args):
+        if power_log:
+            window = dict(data, started=started, finished=finished)
+            data["J_per_image"] = float(power_analysis([window], power_log, baseline)["J_per_image"][0])
+        return started, finished, data
+    return None
+
+
+def autotune(store, run_id, device, command, model_root, budget_kind, budget, min_map,
+             imgszs=IMGSZS, threads=THREADS):
+    """
+    Search the device's configuration space (see module docstring).
+
+    Returns:
+        the deployment config dict, or None when nothing meets both the
+        budget and the accuracy floor.
+    """
+    cfg = DEVICES[device]
+    power_log = cfg.get("power_log")
+    if budget_kind == "energy" and not (power_log and os.path.exists(power_log)):
+        print(f"[{device}] no power log: an energy budget cannot be checked")
+        return None
+
+    combos = sorted({e[:4] for e in experiment_matrix(cfg["mods"], imgszs=imgszs)},
+                    key=lambda c: (size_rank(c[0]), c[3], family(c[0]), c[1], c[2]))
+    print(f"[{device}] {len(combos)} candidates, {budget_kind} budget {budget}, mAP50-95 >= {min_map}")
+
+    worker = BenchmarkWorker(command)
+    try:
+        store.add_environment(run_id, device, worker.fingerprint)
+        baseline = store.baseline(run_id, device)
+        if power_log and baseline is None:
+            idle_start = time()
+            sleep(IDLE_BASELINE_S)
+            baseline = (idle_start, time())
+            store.add_baseline(run_id, device, *baseline)
+
+        # 1. Screen cost, cheapest first
+        screened, over, skipped = {}, [], []
+        for combo in combos:
+            if any(at_least_as_costly(f, combo) for f in over):
+                print(f"[{device}] pruned {' '.join(map(str, combo))}: a cheaper configuration is over budget")
+                continue
+            if not convert(worker, combo):
+                skipped.append((combo, "conversion failed"))
+                continue
+            measured = measure(worker, combo, power_log, baseline, limit=SCREEN_IMAGES)
+            if measured is None:
+                skipped.append((combo, "no screening result"))
+                continue
+            value = cost(measured[2], budget_kind)
+            print(f"[{device}] screen {' '.join(map(str, combo))}: {value}")
+            if value is None or value > budget * (1 + SCREEN_MARGIN):
+                over.append(combo)
+            else:
+                screened[combo] = value
+
+        # 2. Accuracy of the survivors, highest fidelity first
+        accuracy = store.accuracy(run_id, device)
+        accurate, below = [], []
+        for combo in sorted(screened, key=lambda c: (-PREC_ORDER.index(c[1]), -c[3])):
+            if any(at_most_as_accurate(f, combo) for f in below):
+                print(f"[{device}] pruned {' '.join(map(str, combo))}: a more accurate configuration is below the floor")
+                continue
+            if combo not in accuracy:
+                for _, _, _, data in run_experiments(worker, [combo], op="validate"):
+                    store.add_accuracy(run_id, device, combo, data["mAP50"], data["mAP50_95"])
+                    accuracy[combo] = (data["mAP50"], data["mAP50_95"])
+            if combo not in accuracy:
+                skipped.append((combo, "no accuracy result"))
+                continue
+            print(f"[{device}] accuracy {' '.join(map(str, combo))}: mAP50-95 {accuracy[combo][1]}")
+            (accurate if accuracy[combo][1] >= min_map else below).append(combo)
+
+        # 3. Confirm on the full test set, most accurate (then cheapest) first
+        best = None
+        for combo in sorted(accurate, key=lambda c: (-accuracy[c][1], screened[c]))[:CONFIRM_TOP]:
+            measured = measure(worker, combo, power_log, baseline)
+            if measured is None:
+                skipped.append((combo, "no confirmation result"))
+                continue
+            started, finished, data = measured
+            store.add_result(run_id, device, combo + (0,), started, finished, data)
+            print(f"[{device}] confirm {' '.join(map(str, combo))}: {cost(data, budget_kind)}")
+            if cost(data, budget_kind) is not None and cost(data, budget_kind) <= budget:
+                best = (combo, data)
+                break
+
+        for combo, reason in skipped:
+            print(f"[{device}] skipped {' '.join(map(str, combo))}: {reason}")
+        if best is None:
+            print(f"[{device}] no configuration meets the budget and the accuracy floor")
+            return None
+
+        # 4. Intra-op threads for single-stream latency
+        combo, data = best
+        n_threads = None
+        for _, _, _, sweep in run_experiments(worker, [combo], op="sweep", workers=[1], threads=threads,
+                                              modes=["thread"]):
+            n_threads = sweep["recommended_latency"]["threads"]
+    finally:
+        worker.close()
+
+    mod, prec, form, imgsz = combo
+    return {
+        "device": device,
+        "model": os.path.join(model_root, data["artifact"]),
+        "model_name": mod,
+        "precision": prec,
+        "format": form,
+        "imgsz": imgsz,
+        "threads": n_threads,
+        "budget": {budget_kind: budget, "min_mAP50_95": min_map},
+        "measured": {
+            "call_ms_p95": data.get("call_ms_p95"),
+            "images_per_s": data.get("images_per_s"),
+            "J_per_image": data.get("J_per_image"),
+            "mAP50": accuracy[combo][0],
+            "mAP50_95": accuracy[combo][1],
+        },
+        "skipped": [{"candidate": list(c), "reason": reason} for c, reason in skipped],
+        "run_id": run_id,
+        "created": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Select the deployment detector for a device")
+    parser.add_argument("device", choices=list(DEVICES))
+    budget = parser.add_mutually_exclusive_group(required=True)
+    budget.add_argument("--latency-ms", type=float, help="p95 latency budget per image")
+    budget.add_argument("--energy-j", type=float, help="energy budget per image (metered devices)")
+    parser.add_argument("--min-map", type=float, default=0.0, help="minimum mAP50-95 on the test split")
+    parser.add_argument("--imgsz", default=",".join(map(str, IMGSZS)), help="comma-separated input sizes")
+    parser.add_argument("--threads", default=",".join(map(str, THREADS)), help="comma-separated thread counts")
+    parser.add_argument("--run", help="run id; reuse one to keep earlier accuracy results")
+    parser.add_argument("--store", default=DEFAULT_STORE, help="SQLite result store")
+    parser.add_argument("--local", action="store_true", help="use a local worker subprocess instead of SSH")
+    parser.add_argument("--output", default=DEFAULT_CONFIG, help="config file to write")
+    args = parser.parse_args()
+
+    run_id = args.run or datetime.now().strftime("tune-%Y%m%d-%H%M%S")
+    print(f"Run id: {run_id}")
+
+    if args.local:
+        command, model_root = local_worker_command(), os.path.dirname(os.path.abspath(__file__))
+    else:
+        command, model_root = ssh_worker_command(DEVICES[args.device]["host"]), SCRIPT_FOLDER
+
+    kind, value = ("latency", args.latency_ms) if args.latency_ms is not None else ("energy", args.energy_j)
+    config = autotune(ResultStore(args.store), run_id, args.device, command, model_root, kind, value,
+                      args.min_map, imgszs=[int(x) for x in args.imgsz.split(",")],
+                      threads=[int(x) for x in args.threads.split(",")])
+    if config is None:
+        raise SystemExit(1)
+
+    with open(args.output, "w") as f:
+        json.dump(config, f, indent=4)
+    print(f"Config {args.output} saved: {config['model_name']} {config['precision']} {config['format']} "
+          f"{config['imgsz']} px, {config['threads']} threads")
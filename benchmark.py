@@ -1,208 +1,561 @@
 import json
 import os
+import sys
+import argparse
+import threading
 import subprocess
-from time import time
+from datetime import datetime
+from time import time, sleep
 import numpy as np
 import pandas as pd
+from scipy import stats
+from results import ResultStore, DEFAULT_STORE
 
-# Raspberry Pi SSH details
-# HOST = "192.168.1.197" # RPi5
-HOST = "192.168.1.178" # RPi3
+# Raspberry Pi SSH details (hosts are in DEVICES below)
 USER = "fra"
 PRIVATE_KEY_PATH = "~/.ssh/id_rsa"
 SCRIPT_FOLDER = "/home/fra/model-tests/exp_time_resource/"
 SCRIPT_FILE = "main.py"
+WORKER_FILE = "worker.py"
 VENV_PATH = "/home/fra/antenv/bin/activate"
 FNIRSI_BIN_PATH = "/home/fra/fnirsi/fnirsi_logger.py"
 LOG_FILE_PATH = "/home/fra/fnirsi/log.txt"
 
-avg_RAM = []
-max_RAM = []
-avg_CPU = []
-max_CPU = []
-avg_pre_processing = []
-avg_inference = []
-avg_post_processing = []
-
-avg_W = []
-max_W = []
-avg_V = []
-max_V = []
-avg_A = []
-max_A = []
-
-
-def run_remote_script(mod, prec, form):
-    argument = f"{mod} {prec} {form}"
-
-    cmd = f"source {VENV_PATH} && cd {SCRIPT_FOLDER} && python3 {SCRIPT_FILE} {argument}"
-    ssh_command = f"ssh -i {PRIVATE_KEY_PATH} {USER}@{HOST} '{cmd}'"
-
-    # Record the start timestamp
-    start_time = time()
-
-    # Run the command using subprocess
-    process = subprocess.Popen(ssh_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = process.communicate()
-
-    if stderr:
-        print("Error:\n", stderr.decode())
-
-    # Record the end timestamp
-    end_time = time()
-
+# Seconds of idle device power recorded before the matrix (baseline)
+IDLE_BASELINE_S = 10
+
+# Device inventory: each device runs its own matrix, all devices at once.
+# power_log: FNIRSI log of the meter on that device's supply (None if unmetered)
+DEVICES = {
+    "rpi5": {
+        "host": "192.168.1.197",
+        "mods": ["v10n", "v10s", "v10m", "v11n", "v11s", "v11m", "v9s", "v9m", "v9t"],
+        "power_log": None,
+    },
+    "rpi3": {
+        "host": "192.168.1.178",
+        "mods": ["v10n", "v10s", "v11n", "v11s", "v9s", "v9m"],
+        "power_log": LOG_FILE_PATH,
+    },
+}
+
+# precs = ["FP32", "FP16", "INT8"]
+PRECS = ["FP32"]
+FORMS = ["openvino", "mnn", "tflite", "ncnn", "pytorch"]
+IMGSZS = [640]
+
+# Metrics checked by --compare: (result key, True if higher is worse)
+REGRESSION_METRICS = [
+    ("inference_ms", True),
+    ("call_ms_p95", True),
+    ("images_per_s", False),
+    ("max_RAM_MB", True),
+    ("J_per_image", True),
+]
+
+
+def ssh_worker_command(host):
+    """Start the persistent benchmark worker on the device over one SSH session."""
+    cmd = f"source {VENV_PATH} && cd {SCRIPT_FOLDER} && python3 -u {WORKER_FILE}"
+    return ["ssh", "-i", os.path.expanduser(PRIVATE_KEY_PATH), f"{USER}@{host}", cmd]
+
+
+def local_worker_command():
+    """Local stand-in for a device: the worker as a subprocess of this checkout."""
+    return [sys.executable, "-u", os.path.join(os.path.dirname(os.path.abspath(__file__)), WORKER_FILE)]
+
+
+class BenchmarkWorker:
+    """
+    Client side of worker.py's JSON-lines protocol. The worker process (and
+    its Ultralytics import) lives for the whole experiment matrix.
+    """
+
+    def __init__(self, command, cwd=None):
+        self.proc = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1,
+            cwd=cwd or os.path.dirname(os.path.abspath(__file__)),
+        )
+        self.next_id = 0
+        ready = self.read()
+        if ready.get("event") != "ready":
+            raise RuntimeError(f"Worker did not start: {ready}")
+        self.fingerprint = ready.get("fingerprint", {})
+        print(f"Worker ready (imports took {ready.get('import_s')} s)")
+
+    def submit(self, op, **args):
+        self.next_id += 1
+        self.proc.stdin.write(json.dumps({"id": self.next_id, "op": op, "args": args}) + "\n")
+        self.proc.stdin.flush()
+        return self.next_id
+
+    def read(self):
+        line = self.proc.stdout.readline()
+        if not line:
+            raise EOFError("Worker exited")
+        return json.loads(line)
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+def run_experiments(worker, experiments, op="run_test", **args):
+    """
+    Queue every experiment on the worker at once, then stream events.
+    Experiments are tuples starting with (mod, prec, form, imgsz); extra
+    fields (e.g. the repeat index) are passed through. Keyword arguments
+    are sent to every request (e.g. limit=20 for run_test).
+
+    Yields:
+        (start_time, end_time, experiment, data) per successful experiment,
+        with host-clock timestamps taken when the worker reports it started
+        and finished (what the power log is aligned against), and the device
+        temperature at start in data["temp_C_start"].
+    """
+    pending = {worker.submit(op, mod=e[0], prec=e[1], form=e[2], imgsz=e[3], **args): e for e in experiments}
+    started = {}
+    start_temp = {}
+
+    while pending:
+        event = worker.read()
+        req_id = event.get("id")
+        if req_id not in pending:
+            print("Worker:", event)
+            continue
+
+        if event["event"] == "started":
+            started[req_id] = time()
+            start_temp[req_id] = event.get("temp_C")
+            print(f"Running {' '.join(map(str, pending[req_id]))} ({event.get('pending', 0)} queued)")
+        elif event["event"] == "result":
+            data = event["data"]
+            data["temp_C_start"] = start_temp.get(req_id)
+            yield started.get(req_id, time()), time(), pending.pop(req_id), data
+        else:
+            print(f"Error for {' '.join(map(str, pending.pop(req_id)))}: {event.get('message')}")
+
+
+def experiment_matrix(mods, precs=PRECS, forms=FORMS, imgszs=IMGSZS, repeats=1):
+    """
+    (mod, prec, form, imgsz, repeat) tuples. Repeats are the outer loop, so
+    the runs of one combination are spread over the session (and its
+    thermal state) rather than back to back.
+    """
+    experiments = []
+    for repeat in range(repeats):
+        for mod in mods:
+            for prec in precs:
+                for form in forms:
+                    if prec == "INT8" and (form == "tflite" or form == "ncnn"):
+                        continue
+
+                    if form == "pytorch" and prec != "FP32":
+                        continue
+
+                    if "10" in mod and form == "ncnn":
+                        continue
+
+                    for imgsz in imgszs:
+                        experiments.append((mod, prec, form, imgsz, repeat))
+    return experiments
+
+
+def run_device(store, run_id, device, experiments, command, accuracy=False):
+    """
+    Run one device's remaining experiments on its own worker (one job at a
+    time on the device), writing each result to the store as it arrives.
+    With accuracy=True, each distinct artifact is then validated (mAP).
+    """
+    done = store.done(run_id, device)
+    todo = [e for e in experiments if e not in done]
+
+    validated = store.accuracy(run_id, device)
+    to_validate = []
+    if accuracy:
+        to_validate = sorted({e[:4] for e in experiments} - set(validated))
+
+    if not todo and not to_validate:
+        print(f"[{device}] nothing left to run")
+        return
+    print(f"[{device}] {len(todo)} experiments ({len(done)} already done), {len(to_validate)} validations")
+
+    worker = BenchmarkWorker(command)
     try:
-        data = json.loads(stdout.decode().split("RESULTS")[1])
-        print(f"{argument} - {data}")
-
-        max_ram = float(data["max_RAM_MB"])
-        avg_ram = float(data["avg_RAM_MB"])
-        max_cpu = float(data["max_CPU_percent"])
-        avg_cpu = float(data["avg_CPU_percent"])
-        pre_processing = float(data["pre_processing_ms"])
-        inference = float(data["inference_ms"])
-        post_processing = float(data["post_processing_ms"])
-
-        max_RAM.append(max_ram)
-        avg_RAM.append(avg_ram)
-        max_CPU.append(max_cpu)
-        avg_CPU.append(avg_cpu)
-        avg_pre_processing.append(pre_processing)
-        avg_inference.append(inference)
-        avg_post_processing.append(post_processing)
-
-    except json.JSONDecodeError as e:
-        print("Error decoding JSON:", e)
-
-    return start_time, end_time
-
-
-# Function to process the output of the logger
-def process_logger_output(start_time, end_time):
-    voltage_vals = []
-    current_vals = []
-    power_vals = []
-
-    # Open the log file
-    with open(LOG_FILE_PATH, 'r') as log_file:
-        for line in log_file:
-            # Skip the header
-            if line.startswith("timestamp"):
-                continue
-
-            # Extract the columns (assuming they are space-separated)
-            columns = line.split()
-
-            if len(columns) >= 9:
-                timestamp = float(columns[0])  # timestamp
-                voltage = float(columns[2])  # voltage_V
-                current = float(columns[3])  # current_A
-                # energy = float(columns[7])  # energy_Ws
-
-                # Filter data based on timestamps
-                if start_time <= timestamp <= end_time:
-                    # Calculate instantaneous power (P = V * I)
-                    power = voltage * current
-                    power_vals.append(power)
-
-                    # Add voltage and current for reporting
-                    voltage_vals.append(voltage)
-                    current_vals.append(current)
-
-    # Calculate max and average power
-    max_power = max(power_vals) if power_vals else 0.
-    avg_power = np.mean(power_vals) if power_vals else 0.
-
-    # Calculate max and average voltage and current for reporting
-    max_voltage = max(voltage_vals) if voltage_vals else 0.
-    avg_voltage = np.mean(voltage_vals) if voltage_vals else 0.
-
-    max_current = max(current_vals) if current_vals else 0.
-    avg_current = np.mean(current_vals) if current_vals else 0.
-
-    max_W.append(max_power)
-    avg_W.append(avg_power)
-
-    max_V.append(max_voltage)
-    avg_V.append(avg_voltage)
-
-    max_A.append(max_current)
-    avg_A.append(avg_current)
-
-
-if __name__ == '__main__':
-    exps = []
-    starts = []
-    ends = []
-
-    # RPi5
-    # mods = ["v10n", "v10s", "v10m", "v11n", "v11s", "v11m", "v9s", "v9m", "v9t"]
-
-    # RPi3
-    mods = ["v10n", "v10s", "v11n", "v11s", "v9s", "v9m"]
-
-    # precs = ["FP32", "FP16", "INT8"]
-    precs = ["FP32"]
-    forms = ["openvino", "mnn", "tflite", "ncnn", "pytorch"]
-
-    # Need this to be run first
-    for mod in mods:
-        for prec in precs:
-            for form in forms:
-                if prec == "INT8" and (form == "tflite" or form == "ncnn"):
-                    continue
-
-                if form == "pytorch" and prec != "FP32":
-                    continue
-
-                if "10" in mod and form == "ncnn":
+        store.add_environment(run_id, device, worker.fingerprint)
+        if store.baseline(run_id, device) is None:
+            # Idle baseline: worker loaded, nothing running
+            idle_start = time()
+            sleep(IDLE_BASELINE_S)
+            store.add_baseline(run_id, device, idle_start, time())
+
+        for start_time, end_time, experiment, data in run_experiments(worker, todo):
+            print(f"[{device}] {' '.join(map(str, experiment))} - {data}")
+            store.add_result(run_id, device, experiment, start_time, end_time, data)
+
+        # After all timing runs, so validation never overlaps a power window
+        for _, _, combo, data in run_experiments(worker, to_validate, op="validate"):
+            print(f"[{device}] {' '.join(map(str, combo))} - {data}")
+            store.add_accuracy(run_id, device, combo, data["mAP50"], data["mAP50_95"])
+    finally:
+        worker.close()
+
+
+def run_matrix(store, run_id, devices, local=False, repeats=1, imgszs=IMGSZS, accuracy=False):
+    """Run every device's matrix in parallel (one thread and one worker per device)."""
+    threads = []
+    for name in devices:
+        cfg = DEVICES[name]
+        command = local_worker_command() if local else ssh_worker_command(cfg["host"])
+        t = threading.Thread(
+            target=run_device,
+            args=(store, run_id, name, experiment_matrix(cfg["mods"], imgszs=imgszs, repeats=repeats),
+                  command, accuracy),
+            name=name,
+        )
+        t.start()
+        threads.append(t)
+
+    for t in threads:
+        t.join()
+
+
+def load_power_log(path=LOG_FILE_PATH):
+    """
+    Read the FNIRSI log once into a time-sorted frame.
+
+    Columns are space-separated: timestamp, ?, voltage_V, current_A, ...
+    (at least 9 per row); the header and malformed rows are dropped. Only
+    timestamp, voltage and current are kept; the 9th column is read just to
+    drop rows that are too short.
+    """
+    log = pd.read_csv(
+        path, sep=r"\s+", header=None, usecols=[0, 2, 3, 8],
+        names=["timestamp", "voltage", "current", "row_end"],
+        on_bad_lines="skip", dtype=str,
+    )
+    log = log.apply(pd.to_numeric, errors="coerce").dropna().drop(columns="row_end")
+    log = log.sort_values("timestamp", ignore_index=True)
+    log["power"] = log["voltage"] * log["current"]
+    return log
+
+
+def window_stats(log, starts, ends):
+    """
+    Power statistics for many [start, end] windows in one vectorized pass:
+    windows are located with a binary search on the sorted timestamps and
+    reduced with prefix sums (means, trapezoidal energy) and reduceat (max).
+    """
+    starts = np.asarray(starts, dtype=float)
+    ends = np.asarray(ends, dtype=float)
+    out = pd.DataFrame({"duration_s": ends - starts})
+
+    t = log["timestamp"].to_numpy()
+    lo = np.searchsorted(t, starts, side="left")
+    hi = np.searchsorted(t, ends, side="right")
+    count = hi - lo
+    has_data = count > 0
+
+    for col, name in [("power", "power"), ("voltage", "voltage"), ("current", "current")]:
+        x = log[col].to_numpy()
+        csum = np.concatenate(([0.], np.cumsum(x)))
+        out[f"avg_{name}"] = np.where(has_data, (csum[hi] - csum[lo]) / np.maximum(count, 1), 0.)
+
+        # reduceat over interleaved [lo, hi) pairs: even entries are the window maxima
+        padded = np.append(x, 0.)
+        peaks = np.maximum.reduceat(padded, np.column_stack([lo, hi]).ravel())[::2] if len(x) else np.zeros(len(lo))
+        out[f"max_{name}"] = np.where(has_data, peaks, 0.)
+
+    p = log["power"].to_numpy()
+    if len(t) > 1:
+        ecum = np.concatenate(([0.], np.cumsum((p[:-1] + p[1:]) / 2 * np.diff(t))))
+        last = np.clip(hi - 1, 0, len(t) - 1)
+        first = np.clip(lo, 0, len(t) - 1)
+        out["energy_J"] = np.where(count > 1, ecum[last] - ecum[first], 0.)
+    else:
+        out["energy_J"] = 0.
+
+    return out
+
+
+def power_analysis(results, log_path, baseline):
+    """Power/energy columns for one device's results (see window_stats)."""
+    log = load_power_log(log_path)
+    idle_power = window_stats(log, [baseline[0]], [baseline[1]])["avg_power"][0] if baseline else 0.
+    starts = np.array([r["started"] for r in results])
+    ends = np.array([r["finished"] for r in results])
+    power = window_stats(log, starts, ends)
+
+    # Timed inference loop: the last images / images_per_s seconds of each window
+    n_images = np.array([r.get("images", 0) for r in results], dtype=float)
+    ips = np.array([r.get("images_per_s", 0) for r in results], dtype=float)
+    timed_s = np.divide(n_images, ips, out=np.zeros_like(n_images), where=ips > 0)
+    inference_power = window_stats(log, ends - timed_s, ends)
+
+    power["idle_power"] = idle_power
+    power["net_energy_J"] = power["energy_J"] - idle_power * power["duration_s"]
+    power["J_per_image"] = (inference_power["avg_power"] - idle_power) * timed_s / np.maximum(n_images, 1)
+    power["J_per_inference"] = power["J_per_image"] * np.array([r.get("batch", 1) for r in results])
+    return power
+
+
+def analyse_run(store, run_id, csv_name="overall_performance_assessment.csv"):
+    """Summarize a stored run (all devices) and write the CSV."""
+    frames = []
+    for device, cfg in DEVICES.items():
+        results = store.results(run_id, device)
+        if not results:
+            continue
+
+        frame = pd.DataFrame({
+            "device": device,
+            "model": [r["model"] for r in results],
+            "precision": [r["precision"] for r in results],
+            "format": [r["format"] for r in results],
+            "imgsz": [r["imgsz"] for r in results],
+            "repeat": [r["repeat"] for r in results],
+            "max_RAM": [r["max_RAM_MB"] for r in results],
+            "avg_RAM": [r["avg_RAM_MB"] for r in results],
+            "max_CPU": [r["max_CPU_percent"] for r in results],
+            "avg_CPU": [r["avg_CPU_percent"] for r in results],
+            "avg_preprocessing": [r["pre_processing_ms"] for r in results],
+            "avg_inference": [r["inference_ms"] for r in results],
+            "avg_postprocessing": [r["post_processing_ms"] for r in results],
+            "images_per_s": [r.get("images_per_s", 0) for r in results],
+        })
+
+        log_path = cfg.get("power_log")
+        if log_path and os.path.exists(log_path):
+            # Single pass over the log: every experiment window at once
+            power = power_analysis(results, log_path, store.baseline(run_id, device))
+            for col in ["max_power", "avg_power", "max_voltage", "avg_voltage", "max_current",
+                        "avg_current", "idle_power", "energy_J", "net_energy_J", "J_per_image",
+                        "J_per_inference"]:
+                frame[col] = power[col].to_numpy()
+
+        accuracy = store.accuracy(run_id, device)
+        if accuracy:
+            maps = [accuracy.get((r["model"], r["precision"], r["format"], r["imgsz"]), (None, None))
+                    for r in results]
+            frame["mAP50"] = [m[0] for m in maps]
+            frame["mAP50_95"] = [m[1] for m in maps]
+        frames.append(frame)
+
+    if not frames:
+        print(f"No results for run {run_id}")
+        return None
+
+    csv = pd.concat(frames, ignore_index=True)
+
+    for row in csv.itertuples(index=False):
+        print(f"\nSummary for {row.device} {row.model} {row.precision} {row.format} {row.imgsz}...")
+        print(f"Max RAM: {row.max_RAM:.2f} MB, Avg RAM: {row.avg_RAM:.2f} MB")
+        print(f"Max CPU: {row.max_CPU:.2f} %, Avg CPU: {row.avg_CPU:.2f} %")
+        if hasattr(row, "avg_power") and not pd.isna(row.avg_power):
+            print(f"Max Power: {row.max_power:.2f} W, Avg Power: {row.avg_power:.2f} W (idle {row.idle_power:.2f} W)")
+            print(f"Max Voltage: {row.max_voltage:.2f} V, Avg Voltage: {row.avg_voltage:.2f} V")
+            print(f"Max Current: {row.max_current:.2f} A, Avg Current: {row.avg_current:.2f} A")
+            print(f"Energy: {row.energy_J:.2f} J ({row.net_energy_J:.2f} J above idle), "
+                  f"{row.J_per_image:.4f} J/image, {row.J_per_inference:.4f} J/inference")
+        print(f"Avg Pre-processing time: {row.avg_preprocessing:.4f} ms")
+        print(f"Avg Inference time: {row.avg_inference:.3f} ms")
+        print(f"Avg Post-processing time: {row.avg_postprocessing:.4f} ms")
+        if hasattr(row, "mAP50_95") and not pd.isna(row.mAP50_95):
+            print(f"mAP50: {row.mAP50:.4f}, mAP50-95: {row.mAP50_95:.4f}")
+
+    csv.round(4).to_csv(csv_name, index=False)
+    print(f"CSV {csv_name} saved.")
+    return csv
+
+
+def results_with_energy(store, run_id, device):
+    """Stored results of one device, with J_per_image added when it has a power log."""
+    results = store.results(run_id, device)
+    log_path = DEVICES.get(device, {}).get("power_log")
+    if results and log_path and os.path.exists(log_path):
+        power = power_analysis(results, log_path, store.baseline(run_id, device))
+        for r, j in zip(results, power["J_per_image"]):
+            r["J_per_image"] = float(j)
+    return results
+
+
+def mean_ci(values, confidence=0.95):
+    """Mean and half-width of its t-based confidence interval (0 with one value)."""
+    values = np.asarray(values, dtype=float)
+    if values.size < 2:
+        return float(values.mean()), 0.
+    sem = values.std(ddof=1) / np.sqrt(values.size)
+    return float(values.mean()), float(sem * stats.t.ppf((1 + confidence) / 2, values.size - 1))
+
+
+def fingerprint_diff(base, cand):
+    """Flattened fields of two environment fingerprints that differ (temperature excluded)."""
+    def flat(fp):
+        out = {k: v for k, v in (fp or {}).items() if k not in ("versions", "temp_C")}
+        out.update({f"versions.{k}": v for k, v in (fp or {}).get("versions", {}).items()})
+        return out
+
+    base, cand = flat(base), flat(cand)
+    return {k: (base.get(k), cand.get(k)) for k in sorted(set(base) | set(cand)) if base.get(k) != cand.get(k)}
+
+
+def compare_runs(store, baseline_run, candidate_run, alpha=0.05, min_change=0.03,
+                 csv_name="regression_report.csv"):
+    """
+    Compare every device/model/precision/format/imgsz present in both runs.
+
+    A metric is flagged when Welch's t-test over the repeats is significant
+    at `alpha` and the relative change exceeds `min_change`; with a single
+    repeat on either side no significance is claimed. Returns the report.
+    """
+    rows = []
+    for device in DEVICES:
+        base = results_with_energy(store, baseline_run, device)
+        cand = results_with_energy(store, candidate_run, device)
+        if not base or not cand:
+            continue
+
+        for key, (old, new) in fingerprint_diff(store.environment(baseline_run, device),
+                                                store.environment(candidate_run, device)).items():
+            print(f"[{device}] environment changed: {key}: {old} -> {new}")
+
+        def group(results):
+            out = {}
+            for r in results:
+                out.setdefault((r["model"], r["precision"], r["format"], r["imgsz"]), []).append(r)
+            return out
+
+        base_groups, cand_groups = group(base), group(cand)
+        for combo in sorted(set(base_groups) & set(cand_groups)):
+            for metric, higher_is_worse in REGRESSION_METRICS:
+                a = [r[metric] for r in base_groups[combo] if r.get(metric) is not None]
+                b = [r[metric] for r in cand_groups[combo] if r.get(metric) is not None]
+                if not a or not b:
                     continue
 
-                exps.append(f"{mod} {prec} {form}")
-                start_time, end_time = run_remote_script(mod, prec, form)
-
-                starts.append(start_time)
-                ends.append(end_time)
-
-    # After all, iterate to read the log file for V, W, A
-    for i in range(0, len(starts)):
-        start_time = starts[i]
-        end_time = ends[i]
-        process_logger_output(start_time, end_time)
-
-    # CSV and DataFrame
-    csv = pd.DataFrame(columns=[
-        "model", "precision", "format", "max_RAM", "avg_RAM", "max_CPU",
-        "avg_CPU", "max_power", "avg_power", "max_voltage", "avg_voltage",
-        "max_current", "avg_current", "avg_preprocessing", "avg_inference", "avg_postprocessing"
-    ])
-    csv_name = "overall_performance_assessment.csv"
-
-    # Print and append to CSV
-    for i in range(0, len(exps)):
-        print(f"\nSummary for {exps[i]}...")
-        print(f"Max RAM: {max_RAM[i]:.2f} MB, Avg RAM: {avg_RAM[i]:.2f} MB")
-        print(f"Max CPU: {max_CPU[i]:.2f} %, Avg CPU: {avg_CPU[i]:.2f} %")
-        print(f"Max Power: {max_W[i]:.2f} W, Avg Power: {avg_W[i]:.2f} W")
-        print(f"Max Voltage: {max_V[i]:.2f} V, Avg Voltage: {avg_V[i]:.2f} V")
-        print(f"Max Current: {max_A[i]:.2f} A, Avg Current: {avg_A[i]:.2f} A")
-        print(f"Avg Pre-processing time: {avg_pre_processing[i]:.4f} ms")
-        print(f"Avg Inference time: {avg_inference[i]:.3f} ms")
-        print(f"Avg Post-processing time: {avg_post_processing[i]:.4f} ms")
-
-        model, precision, format_type = exps[i].split(" ")
-        csv.loc[len(csv)] = [
-            model, precision, format_type,
-            f"{max_RAM[i]:.2f}", f"{avg_RAM[i]:.2f}",
-            f"{max_CPU[i]:.2f}", f"{avg_CPU[i]:.2f}",
-            f"{max_W[i]:.2f}", f"{avg_W[i]:.2f}",
-            f"{max_V[i]:.2f}", f"{avg_V[i]:.2f}",
-            f"{max_A[i]:.2f}", f"{avg_A[i]:.2f}",
-            f"{avg_pre_processing[i]:.4f}",
-            f"{avg_inference[i]:.3f}",
-            f"{avg_post_processing[i]:.4f}"
-        ]
-
-    csv.to_csv(csv_name, index=False)
+                base_mean, base_ci = mean_ci(a)
+                cand_mean, cand_ci = mean_ci(b)
+                change = (cand_mean - base_mean) / base_mean if base_mean else 0.
+                p_value = None
+                if len(a) > 1 and len(b) > 1:
+                    p_value = float(stats.ttest_ind(a, b, equal_var=False).pvalue)
+
+                verdict = ""
+                if p_value is not None and p_value < alpha and abs(change) > min_change:
+                    worse = change > 0 if higher_is_worse else change < 0
+                    verdict = "regression" if worse else "improvement"
+
+                rows.append({
+                    "device": device,
+                    "model": combo[0],
+                    "precision": combo[1],
+                    "format": combo[2],
+                    "imgsz": combo[3],
+                    "metric": metric,
+                    "baseline": round(base_mean, 4),
+                    "baseline_ci": round(base_ci, 4),
+                    "candidate": round(cand_mean, 4),
+                    "candidate_ci": round(cand_ci, 4),
+                    "change_percent": round(change * 100, 2),
+                    "p_value": round(p_value, 5) if p_value is not None else None,
+                    "n": f"{len(a)}/{len(b)}",
+                    "verdict": verdict,
+                })
+
+    report = pd.DataFrame(rows)
+    if report.empty:
+        print(f"Nothing in common between runs {baseline_run} and {candidate_run}")
+        return report
+
+    flagged = report[report["verdict"] != ""]
+    for row in flagged.itertuples(index=False):
+        print(f"{row.verdict.upper()}: {row.device} {row.model} {row.precision} {row.format} {row.imgsz} "
+              f"{row.metric} {row.baseline} ±{row.baseline_ci} -> {row.candidate} ±{row.candidate_ci} "
+              f"({row.change_percent:+.2f} %, p={row.p_value})")
+    print(f"{(flagged['verdict'] == 'regression').sum()} regressions, "
+          f"{(flagged['verdict'] == 'improvement').sum()} improvements")
+
+    report.to_csv(csv_name, index=False)
+    print(f"CSV {csv_name} saved.")
+    return report
+
+
+def pareto_mask(cost, gain):
+    """True for points no other point beats (lower-or-equal cost, higher-or-equal gain, one strictly)."""
+    cost, gain = np.asarray(cost, dtype=float), np.asarray(gain, dtype=float)
+    no_worse = (cost[None, :] <= cost[:, None]) & (gain[None, :] >= gain[:, None])
+    better = (cost[None, :] < cost[:, None]) | (gain[None, :] > gain[:, None])
+    return ~(no_worse & better).any(axis=1)
+
+
+def pareto_front(csv, csv_name="pareto_front.csv"):
+    """
+    Accuracy-vs-cost trade-off per device from analyse_run()'s frame.
+
+    Repeats are averaged per model/precision/format/imgsz; cost is the
+    end-to-end latency per image (pre + inference + post) and, where a power
+    log exists, J_per_image. Every combination is written with flags telling
+    whether it is on the mAP50-95/latency and mAP50-95/energy fronts.
+    """
+    if csv is None or "mAP50_95" not in csv:
+        print("No accuracy results: run with --accuracy to get a Pareto front")
+        return None
+
+    frame = csv.dropna(subset=["mAP50_95"]).copy()
+    frame["latency_ms"] = frame["avg_preprocessing"] + frame["avg_inference"] + frame["avg_postprocessing"]
+    columns = ["latency_ms", "images_per_s", "mAP50", "mAP50_95"]
+    if "J_per_image" in frame:
+        columns.append("J_per_image")
+    keys = ["device", "model", "precision", "format", "imgsz"]
+    front = frame.groupby(keys, as_index=False)[columns].mean()
+
+    fronts = []
+    for _, group in front.groupby("device"):
+        group = group.copy()
+        group["pareto_latency"] = pareto_mask(group["latency_ms"], group["mAP50_95"])
+        if "J_per_image" in group and group["J_per_image"].notna().all():
+            group["pareto_energy"] = pareto_mask(group["J_per_image"], group["mAP50_95"])
+        fronts.append(group.sort_values("latency_ms"))
+    front = pd.concat(fronts, ignore_index=True)
+
+    for row in front[front["pareto_latency"]].itertuples(index=False):
+        print(f"Pareto {row.device}: {row.model} {row.precision} {row.format} {row.imgsz} - "
+              f"{row.latency_ms:.1f} ms, mAP50-95 {row.mAP50_95:.4f}")
+
+    front.round(4).to_csv(csv_name, index=False)
     print(f"CSV {csv_name} saved.")
+    return front
 
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the benchmark matrix on all devices")
+    parser.add_argument("--devices", default=",".join(DEVICES), help="comma-separated names from DEVICES")
+    parser.add_argument("--run", help="run id; reuse one to resume an interrupted matrix")
+    parser.add_argument("--store", default=DEFAULT_STORE, help="SQLite result store")
+    parser.add_argument("--local", action="store_true", help="use local worker subprocesses instead of SSH")
+    parser.add_argument("--analyse-only", action="store_true", help="only write the CSV for --run")
+    parser.add_argument("--repeats", type=int, default=1, help="runs per combination (for confidence intervals)")
+    parser.add_argument("--imgsz", default=",".join(map(str, IMGSZS)),
+                        help="comma-separated input resolutions (exported per size)")
+    parser.add_argument("--accuracy", action="store_true",
+                        help="also validate every artifact (mAP) and write the Pareto front")
+    parser.add_argument("--compare", metavar="BASELINE_RUN",
+                        help="after the run, flag significant changes of --run against this run")
+    args = parser.parse_args()
+
+    run_id = args.run or datetime.now().strftime("%Y%m%d-%H%M%S")
+    print(f"Run id: {run_id}")
+    store = ResultStore(args.store)
+
+    if not args.analyse_only:
+        run_matrix(store, run_id, args.devices.split(","), local=args.local, repeats=args.repeats,
+                   imgszs=[int(x) for x in args.imgsz.split(",")], accuracy=args.accuracy)
+
+    csv = analyse_run(store, run_id)
+    if csv is not None and "mAP50_95" in csv:
+        pareto_front(csv)
+
+    if args.compare:
+        report = compare_runs(store, args.compare, run_id)
+        if not report.empty and (report["verdict"] == "regression").any():
+            sys.exit(1)
@@ -0,0 +1,276 @@
+"""
+Query index of the image catalog (SQLite next to the uploads), so gallery
+filters are answered by indexes instead of a pass over every image.
+
+    index = CatalogIndex(UPLOAD_ROOT, changes)
+    index.sync()    # apply the change log (full mtime check after a server start)
+    index.query(since=time.time() - 86400, devices=["b8-27-eb-3b-8d-1c"])
+    index.query(bbox=(45.0, 11.0, 46.0, 12.5), temperature=(30, None), classes=[2])
+
+Per image it keeps the capture time (filename, else mtime), the client id
+(NULL unless the filename ends with one, see filenames.py),
+the EXIF sensor values written by client.py (ImageDescription
+"Temperature=..|Pressure=..|Humidity=.." and the GPS IFD), the labeled flag
+(non-empty json, as in the gallery) and the TP box count per class (YOLO
+txt). Time, device and sensor filters use B-tree indexes, the GPS bounding
+box an R-tree, and classes an index on (cls, image).
+"""
+import os
+import re
+import sqlite3
+import threading
+from PIL import Image
+from filenames import capture_time, device_of
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg")
+
+EXIF_IMAGE_DESCRIPTION = 0x010E
+EXIF_GPS_IFD = 0x8825
+SENSOR_PATTERN = re.compile(r"(Temperature|Pressure|Humidity)=(-?[\d.]+)")
+
+# Range filters accepted by query(): column -> (min, max)
+SENSORS = ("temperature", "pressure", "humidity")
+
+# Bumped when filenames.py reads names differently: stored capture times and
+# devices are then recomputed when the index is opened
+FILENAME_RULES = 2
+
+
+def gps_decimal(dms, ref):
+    if not dms:
+        return None
+    degrees, minutes, seconds = (float(v) for v in dms)
+    value = degrees + minutes / 60 + seconds / 3600
+    return -value if ref in ("S", "W") else value
+
+
+def read_sensors(path):
+    """
+    EXIF values written by client.py: {temperature, pressure, humidity,
+    latitude, longitude}, None where missing. The client writes zeros when
+    it has no reading, so all-zero sensors and (0, 0) coordinates count as missing.
+    """
+    out = dict.fromkeys(SENSORS + ("latitude", "longitude"))
+    try:
+        with Image.open(path) as img:    # header only
+            exif = img.getexif()
+            description = exif.get(EXIF_IMAGE_DESCRIPTION)
+            gps = exif.get_ifd(EXIF_GPS_IFD)
+    except OSError:
+        return out
+
+    if isinstance(description, bytes):
+        description = description.decode("utf-8", "replace")
+    values = {k.lower(): float(v) for k, v in SENSOR_PATTERN.findall(description or "")}
+    if any(values.values()):
+        out.update(values)
+
+    try:
+        lat = gps_decimal(gps.get(2), gps.get(1))
+        lon = gps_decimal(gps.get(4), gps.get(3))
+    except (TypeError, ValueError, ZeroDivisionError):
+        lat = lon = None
+    if lat is not None and lon is not None and (lat, lon) != (0., 0.):
+        out.update(latitude=lat, longitude=lon)
+    return out
+
+
+def read_classes(txt_path):
+    """{class: TP box count} from a YOLO txt."""
+    counts = {}
+    try:
+        with open(txt_path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 5:
+                    cls = int(float(parts[0]))
+                    counts[cls] = counts.get(cls, 0) + 1
+    except (OSError, ValueError):
+        pass
+    return counts
+
+
+def mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+
+class CatalogIndex:
+    """Thread-safe index of one upload root, kept current from the change log."""
+
+    def __init__(self, upload_root, changes, path=None):
+        self.images_dir = os.path.join(upload_root, "images")
+        self.labels_dir = os.path.join(upload_root, "labels")
+        self.jsons_dir = os.path.join(upload_root, "jsons")
+        self.changes = changes
+        self.conn = sqlite3.connect(path or os.path.join(upload_root, "catalog.sqlite"), check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS images (
+                    id INTEGER PRIMARY KEY,
+                    filename TEXT NOT NULL UNIQUE,
+                    ts REAL NOT NULL,
+                    device TEXT,
+                    temperature REAL,
+                    pressure REAL,
+                    humidity REAL,
+                    latitude REAL,
+                    longitude REAL,
+                    labeled INTEGER NOT NULL,
+                    image_mtime_ns INTEGER NOT NULL,
+                    label_mtime_ns INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS images_ts ON images (ts);
+                CREATE INDEX IF NOT EXISTS images_device_ts ON images (device, ts);
+                CREATE INDEX IF NOT EXISTS images_temperature ON images (temperature);
+                CREATE INDEX IF NOT EXISTS images_pressure ON images (pressure);
+                CREATE INDEX IF NOT EXISTS images_humidity ON images (humidity);
+                CREATE VIRTUAL TABLE IF NOT EXISTS images_geo USING rtree (id, min_lat, max_lat, min_lon, max_lon);
+                CREATE TABLE IF NOT EXISTS image_classes (
+                    cls INTEGER NOT NULL,
+                    image_id INTEGER NOT NULL,
+                    boxes INTEGER NOT NULL,
+                    PRIMARY KEY (cls, image_id)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS image_classes_image ON image_classes (image_id);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            """)
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'filename_rules'").fetchone()
+            if (row["value"] if row else 0) < FILENAME_RULES:
+                self._reparse_filenames()
+
+    def _reparse_filenames(self):
+        """Recompute ts and device of every indexed image from its name (no image reads)."""
+        for r in self.conn.execute("SELECT id, filename FROM images").fetchall():
+            image = self._paths(r["filename"])[0]
+            if os.path.exists(image):   # gone: removed at the next sync
+                self.conn.execute("UPDATE images SET ts = ?, device = ? WHERE id = ?",
+                                  (capture_time(r["filename"], image), device_of(r["filename"]), r["id"]))
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('filename_rules', ?)", (FILENAME_RULES,))
+
+    def _paths(self, filename):
+        stem = os.path.splitext(filename)[0]
+        return (os.path.join(self.images_dir, filename),
+                os.path.join(self.labels_dir, stem + ".txt"),
+                os.path.join(self.jsons_dir, stem + ".json"))
+
+    def sync(self):
+        """
+        Apply the images changed since the last sync. After a server start
+        (whose missed changes the log cannot tell) every image is checked,
+        but only those whose image or label files changed are re-read.
+        Returns the number of images re-indexed or removed.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+            applied = row["value"] if row else 0
+            if applied < self.changes.last_reset():
+                version = self.changes.version()
+                names = {f for f in os.listdir(self.images_dir) if f.lower().endswith(IMAGE_EXTENSIONS)}
+                known = {r["filename"]: (r["image_mtime_ns"], r["label_mtime_ns"])
+                         for r in self.conn.execute("SELECT filename, image_mtime_ns, label_mtime_ns FROM images")}
+                stale = set(known) - names
+                for name in names:
+                    image, txt, jpath = self._paths(name)
+                    if known.get(name) != (mtime_ns(image), max(mtime_ns(txt), mtime_ns(jpath))):
+                        stale.add(name)
+            else:
+                version, changed = self.changes.since(applied)
+                stale = set(changed)
+
+            with self.conn:
+                for name in stale:
+                    self._reindex(name)
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (version,))
+            return len(stale)
+
+    def _reindex(self, name):
+        image, txt, jpath = self._paths(name)
+        row = self.conn.execute("SELECT id FROM images WHERE filename = ?", (name,)).fetchone()
+        if row is not None:
+            self.conn.execute("DELETE FROM images_geo WHERE id = ?", (row["id"],))
+            self.conn.execute("DELETE FROM image_classes WHERE image_id = ?", (row["id"],))
+        if not os.path.exists(image):
+            self.conn.execute("DELETE FROM images WHERE filename = ?", (name,))
+            return
+
+        sensors = read_sensors(image)
+        labeled = os.path.exists(jpath) and os.path.getsize(jpath) > 0
+        self.conn.execute("""
+            INSERT INTO images (filename, ts, device, temperature, pressure, humidity, latitude, longitude,
+                                labeled, image_mtime_ns, label_mtime_ns)
+            VALUES (:filename, :ts, :device, :temperature, :pressure, :humidity, :latitude, :longitude,
+                    :labeled, :image_mtime_ns, :label_mtime_ns)
+            ON CONFLICT (filename) DO UPDATE SET
+                ts = excluded.ts, device = excluded.device, temperature = excluded.temperature,
+                pressure = excluded.pressure, humidity = excluded.humidity, latitude = excluded.latitude,
+                longitude = excluded.longitude, labeled = excluded.labeled,
+                image_mtime_ns = excluded.image_mtime_ns, label_mtime_ns = excluded.label_mtime_ns
+        """, dict(sensors, filename=name, ts=capture_time(name, image), device=device_of(name),
+                  labeled=int(labeled), image_mtime_ns=mtime_ns(image),
+                  label_mtime_ns=max(mtime_ns(txt), mtime_ns(jpath))))
+        # Upsert keeps the id; not RETURNING, which Raspberry Pi OS's SQLite (3.34) lacks
+        image_id = self.conn.execute("SELECT id FROM images WHERE filename = ?", (name,)).fetchone()["id"]
+
+        if sensors["latitude"] is not None:
+            self.conn.execute("INSERT INTO images_geo VALUES (?, ?, ?, ?, ?)",
+                              (image_id, sensors["latitude"], sensors["latitude"],
+                               sensors["longitude"], sensors["longitude"]))
+        self.conn.executemany("INSERT INTO image_classes (cls, image_id, boxes) VALUES (?, ?, ?)",
+                              [(cls, image_id, n) for cls, n in read_classes(txt).items()])
+
+    def query(self, since=None, until=None, devices=None, bbox=None, classes=None, labeled=None,
+              name_contains=None, **ranges):
+        """
+        Filenames matching every given filter, newest first.
+
+        since/until: capture timestamps (inclusive); devices: client ids;
+        bbox: (min_lat, min_lon, max_lat, max_lon); classes: at least one TP
+        box of any of them; labeled: True/False; name_contains: filename
+        substring (case-insensitive); temperature/pressure/humidity:
+        (min, max) with None for an open end.
+        """
+        joins, where, args = [], [], []
+        if since is not None:
+            where.append("i.ts >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("i.ts <= ?")
+            args.append(until)
+        if devices:
+            where.append(f"i.device IN ({','.join('?' * len(devices))})")
+            args += list(devices)
+        if bbox is not None:
+            joins.append("JOIN images_geo g ON g.id = i.id")
+            where.append("g.min_lat >= ? AND g.max_lat <= ? AND g.min_lon >= ? AND g.max_lon <= ?")
+            args += [bbox[0], bbox[2], bbox[1], bbox[3]]
+        if classes:
+            where.append(f"i.id IN (SELECT image_id FROM image_classes WHERE cls IN ({','.join('?' * len(classes))}))")
+            args += list(classes)
+        if labeled is not None:
+            where.append("i.labeled = ?")
+            args.append(int(labeled))
+        if name_contains:
+            where.append("instr(lower(i.filename), ?) > 0")
+            args.append(name_contains.lower())
+        for column, (low, high) in ranges.items():
+            if column not in SENSORS:
+                raise ValueError(f"unknown range filter: {column}")
+            if low is not None:
+                where.append(f"i.{column} >= ?")
+                args.append(low)
+            if high is not None:
+                where.append(f"i.{column} <= ?")
+                args.append(high)
+
+        sql = f"SELECT i.filename FROM images i {' '.join(joins)}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY i.ts DESC"
+        with self.lock:
+            return [r["filename"] for r in self.conn.execute(sql, args)]
@@ -0,0 +1,78 @@
+"""
+Shared change log of the image catalog (SQLite next to the uploads).
+
+Both servers append to it: server-picture.py when images are received or
+deleted, server-labeler.py when labels are saved. Every change gets the
+next version number, so a gallery that has seen version N only needs the
+images changed after N instead of the whole catalog.
+
+    changes = ChangeLog(os.path.join(UPLOAD_ROOT, "changes.sqlite"))
+    changes.record("2023-07-20T20-19-46+0200_b8-27-eb-3b-8d-1c.jpeg", "relabeled")
+    version, changed = changes.since(41)   # {filename: latest kind}
+"""
+import time
+import sqlite3
+import threading
+
+# Kinds of change; "reset" (no filename) marks a server start, after which
+# deltas from older versions cannot be trusted
+KINDS = {"added", "updated", "deleted", "relabeled", "reset"}
+
+
+class ChangeLog:
+    """Thread-safe append-only log; WAL mode so the two server processes can share it."""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS changes (
+                    version INTEGER PRIMARY KEY AUTOINCREMENT,
+                    filename TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    ts REAL NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS changes_filename ON changes (filename)")
+
+    def record(self, filename, kind):
+        """Append one change; returns its version."""
+        if kind not in KINDS:
+            raise ValueError(f"unknown change kind: {kind}")
+        with self.lock, self.conn:
+            cur = self.conn.execute("INSERT INTO changes (filename, kind, ts) VALUES (?, ?, ?)",
+                                    (filename, kind, time.time()))
+            return cur.lastrowid
+
+    def record_many(self, filenames, kind):
+        """Append one change per filename in a single transaction."""
+        with self.lock, self.conn:
+            now = time.time()
+            self.conn.executemany("INSERT INTO changes (filename, kind, ts) VALUES (?, ?, ?)",
+                                  [(f, kind, now) for f in filenames])
+
+    def version(self):
+        with self.lock:
+            row = self.conn.execute("SELECT MAX(version) AS v FROM changes").fetchone()
+        return row["v"] or 0
+
+    def last_reset(self):
+        """Version of the latest server start (0 if none)."""
+        with self.lock:
+            row = self.conn.execute("SELECT MAX(version) AS v FROM changes WHERE kind = 'reset'").fetchone()
+        return row["v"] or 0
+
+    def since(self, version):
+        """(current version, {filename: kind of its latest change after `version`})."""
+        current = self.version()
+        with self.lock:
+            # Bounded by `current`: rows appended meanwhile by the other server come next time
+            rows = self.conn.execute(
+                "SELECT filename, kind FROM changes WHERE version > ? AND version <= ? AND filename != '' "
+                "ORDER BY version",
+                (version, current),
+            ).fetchall()
+        return current, {r["filename"]: r["kind"] for r in rows}
@@ -3,6 +3,8 @@ from signal import pause
 from PIL import Image
 import piexif
 import os
+import io
+import json
 from datetime import datetime
 import serial
 import adafruit_dht
@@ -12,6 +14,11 @@ import logging
 import smbus2
 import bme280
 import subprocess
+import requests
+import threading
+import queue
+import argparse
+import uuid
 
 # Configure logging
 logging.basicConfig(
@@ -24,6 +31,45 @@ logging.basicConfig(
 IMAGE_DIR = "static/uploads/images"
 os.makedirs(IMAGE_DIR, exist_ok=True)
 
+# Upload target (server-picture.py /receive). Leave as None when the client
+# runs on the same Pi as the server: images already land in IMAGE_DIR.
+SERVER_URL = None
+
+# Client id sent with every upload (MAC address, e.g. b8-27-eb-3b-8d-1c):
+# the server answers with the originals it wants from this client only
+CLIENT_ID = "-".join(f"{(uuid.getnode() >> s) & 0xff:02x}" for s in range(40, -8, -8))
+
+# Optional on-device detector (path to YOLO weights/exported model).
+# When None, the adaptive policy only reacts to sensor changes.
+DETECTOR_MODEL = None
+
+# Deployment config written by autotune.py (model, imgsz, threads); when
+# the file exists it takes precedence over DETECTOR_MODEL
+DETECTOR_CONFIG = "detector_config.json"
+
+# Time-lapse capture (seconds)
+TIMELAPSE_INTERVAL = 300
+TIMELAPSE_MIN_INTERVAL = 30
+TIMELAPSE_MAX_INTERVAL = 1800
+
+# Sensor deltas that count as "something is happening"
+SENSOR_CHANGE_THRESHOLDS = {
+    "temperature": 0.5,  # °C
+    "pressure": 1.0,     # hPa
+    "humidity": 3.0,     # %
+}
+
+# Pending jobs per pipeline stage before new triggers are dropped
+PIPELINE_QUEUE_SIZE = 4
+
+# Upload variants: above this expected send time (seconds, including the
+# images already queued) the uploader degrades full -> reduced -> crop
+UPLOAD_TIME_BUDGET = 10.0
+REDUCED_MAX_SIDE = 1280
+REDUCED_QUALITY = 70
+CROP_MARGIN = 0.1        # fraction of the detections' bounding box
+CROP_QUALITY = 85
+
 # GPIO setup
 capture_button = Button(12)
 led_green = PWMLED(4)
@@ -161,49 +207,379 @@ def add_gps_metadata(image_path, latitude=None, longitude=None, temperature=None
         raise
 
 
-def handle_button_press() -> None:
-    # Start capture
-    led_green.value = 0
-    led_blue.value = 1
-    led_red.value = 0
-
-    file_path = capture_photo()
-
-    if not file_path:
-        # Capture failed
-        led_blue.value = 0
-        led_red.blink(on_time=0.5, off_time=0.5, n=20, background=True)
-        return
-
-    # Now gather metadata and write it
-    led_blue.value = 0
-    led_red.value = 1
-
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    temperature, pressure, humidity = get_weather()
-    latitude, longitude = get_gps_data()
-
-    logging.info(f"Timestamp: {timestamp}")
-    if latitude is not None and longitude is not None:
-        logging.info(f"GPS Coordinates: Latitude={latitude}, Longitude={longitude}")
-    if temperature is not None:
-        logging.info(f"Temperature: {temperature}°C")
-    if pressure is not None:
-        logging.info(f"Pressure: {pressure} hPa")
-    if humidity is not None:
-        logging.info(f"Humidity: {humidity}%")
+detector = None
+detector_settings = None
+
+
+def load_detector_settings():
+    """{"model", "imgsz", "threads"} from DETECTOR_CONFIG, else from DETECTOR_MODEL, else None."""
+    if os.path.exists(DETECTOR_CONFIG):
+        try:
+            with open(DETECTOR_CONFIG, "r") as f:
+                config = json.load(f)
+            logging.info(f"Detector config: {config['model']} at {config['imgsz']} px, {config.get('threads')} threads")
+            return {"model": config["model"], "imgsz": config["imgsz"], "threads": config.get("threads")}
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring {DETECTOR_CONFIG}: {e}")
+    if DETECTOR_MODEL is None:
+        return None
+    return {"model": DETECTOR_MODEL, "imgsz": 640, "threads": None}
+
 
+def detect_objects(image_path):
+    """
+    Run the optional on-device detector on an image.
+
+    Returns:
+        list of (cls, x_center, y_center, width, height) in normalized YOLO
+        space, or None if no detector is configured/available.
+    """
+    global detector, detector_settings
+    if detector_settings is None:
+        detector_settings = load_detector_settings() or {}
+    if not detector_settings:
+        return None
     try:
-        add_gps_metadata(file_path, latitude, longitude, temperature, pressure, humidity)
-        # Success: green on
-        led_red.value = 0
-        led_green.value = 1
-    except Exception:
-        # Metadata writing failed
-        led_red.blink(on_time=0.5, off_time=0.5, n=20, background=True)
-        led_green.value = 0
+        if detector is None:
+            # Same thread settings as the benchmark that tuned them (rpi.py)
+            from rpi import YOLO, set_intra_op_threads, set_backend_threads
+            threads = detector_settings["threads"]
+            if threads:
+                set_intra_op_threads(threads)
+            detector = YOLO(detector_settings["model"], task="detect")
+            if threads:
+                detector(image_path, imgsz=detector_settings["imgsz"], verbose=False)  # creates the backend
+                set_backend_threads(detector, detector_settings["model"], threads)
+        result = detector(image_path, imgsz=detector_settings["imgsz"], verbose=False)[0]
+        return [
+            (int(c), *map(float, xywhn))
+            for c, xywhn in zip(result.boxes.cls.tolist(), result.boxes.xywhn.tolist())
+        ]
+    except Exception as e:
+        logging.warning(f"Detection failed: {e}")
+        return None
 
 
+class LinkEstimator:
+    """Exponentially weighted estimate of upload throughput (bytes/s)."""
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.bytes_per_s = None
+
+    def record(self, n_bytes, seconds):
+        if seconds <= 0:
+            return
+        sample = n_bytes / seconds
+        if self.bytes_per_s is None:
+            self.bytes_per_s = sample
+        else:
+            self.bytes_per_s = self.alpha * sample + (1 - self.alpha) * self.bytes_per_s
+
+    def send_time(self, n_bytes) -> float:
+        if self.bytes_per_s is None:
+            return 0.0  # optimistic until the first upload is measured
+        return n_bytes / self.bytes_per_s
+
+
+link = LinkEstimator()
+
+
+def choose_variant(image_path, detections, queue_depth) -> str:
+    """
+    Pick what to send for one image given the link estimate and how many
+    uploads are already waiting behind it:
+      - "full": original JPEG
+      - "reduced": downscaled, lower-quality JPEG
+      - "crop": crop around the detections (+ detections), only if any
+    """
+    size = os.path.getsize(image_path)
+    backlog = 1 + queue_depth
+    if link.send_time(size) * backlog <= UPLOAD_TIME_BUDGET:
+        return "full"
+    # a REDUCED_MAX_SIDE/REDUCED_QUALITY JPEG is roughly 10-15% of a 12MP original
+    if link.send_time(size * 0.15) * backlog <= UPLOAD_TIME_BUDGET or not detections:
+        return "reduced"
+    return "crop"
+
+
+def make_variant(image_path, variant, detections):
+    """
+    Encode the upload payload for a variant.
+
+    Returns:
+        (jpeg bytes, extra form fields)
+    """
+    if variant == "full":
+        with open(image_path, "rb") as f:
+            return f.read(), {}
+
+    image = Image.open(image_path)
+    exif = image.info.get("exif", b"")
+    buf = io.BytesIO()
+    fields = {"detections": json.dumps(detections or [])}
+
+    if variant == "reduced":
+        image.thumbnail((REDUCED_MAX_SIDE, REDUCED_MAX_SIDE))
+        image.save(buf, format="JPEG", quality=REDUCED_QUALITY, exif=exif)
+        return buf.getvalue(), fields
+
+    # crop: union of the detection boxes plus a margin, in normalized coords
+    x1 = min(d[1] - d[3] / 2 for d in detections)
+    y1 = min(d[2] - d[4] / 2 for d in detections)
+    x2 = max(d[1] + d[3] / 2 for d in detections)
+    y2 = max(d[2] + d[4] / 2 for d in detections)
+    mx, my = (x2 - x1) * CROP_MARGIN, (y2 - y1) * CROP_MARGIN
+    box = [max(0.0, x1 - mx), max(0.0, y1 - my), min(1.0, x2 + mx), min(1.0, y2 + my)]
+
+    W, H = image.size
+    image.crop((int(box[0] * W), int(box[1] * H), int(box[2] * W), int(box[3] * H))).save(
+        buf, format="JPEG", quality=CROP_QUALITY, exif=exif
+    )
+    fields["crop_box"] = json.dumps(box)
+    return buf.getvalue(), fields
+
+
+def upload_photo(image_path, detections=None, queue_depth=0, variant=None):
+    """
+    POST an image to SERVER_URL (no-op when SERVER_URL is None).
+
+    Returns:
+        list of filenames whose full-resolution original the server wants,
+        or None if the upload failed.
+    """
+    if SERVER_URL is None:
+        return []
+    if variant is None:
+        variant = choose_variant(image_path, detections, queue_depth)
+    try:
+        payload, fields = make_variant(image_path, variant, detections)
+        fields["variant"] = variant
+        fields["device"] = CLIENT_ID
+
+        start = time.monotonic()
+        r = requests.post(
+            SERVER_URL,
+            files={"image": (os.path.basename(image_path), payload, "image/jpeg")},
+            data=fields,
+            timeout=30,
+        )
+        r.raise_for_status()
+        link.record(len(payload), time.monotonic() - start)
+
+        logging.info(f"Uploaded {image_path} ({variant}, {len(payload) / 1024:.0f} KB)")
+        return r.json().get("originals_requested", [])
+    except Exception as e:
+        logging.error(f"Failed to upload {image_path}: {e}")
+        return None
+
+
+class AdaptiveInterval:
+    """
+    Time-lapse period that shrinks while something is happening (detections
+    or sensor changes) and grows back while the scene is quiet.
+    """
+
+    def __init__(self, interval=TIMELAPSE_INTERVAL, min_interval=TIMELAPSE_MIN_INTERVAL,
+                 max_interval=TIMELAPSE_MAX_INTERVAL, adaptive=True, shrink=0.5, grow=1.5):
+        self.base = interval
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.adaptive = adaptive
+        self.shrink = shrink
+        self.grow = grow
+        self.last_readings = None
+        self.lock = threading.Lock()
+
+    def sensors_changed(self, readings) -> bool:
+        previous = self.last_readings
+        if readings is not None:
+            self.last_readings = readings
+        if previous is None or readings is None:
+            return False
+        for key, threshold in SENSOR_CHANGE_THRESHOLDS.items():
+            old, new = previous.get(key), readings.get(key)
+            if old is not None and new is not None and abs(new - old) >= threshold:
+                return True
+        return False
+
+    def update(self, detections=None, readings=None) -> float:
+        """Feed the outcome of the latest frame and return the next interval."""
+        with self.lock:
+            changed = self.sensors_changed(readings)
+            if not self.adaptive:
+                return self.interval
+            if detections or changed:
+                self.interval = max(self.min_interval, self.interval * self.shrink)
+            else:
+                self.interval = min(self.max_interval, self.interval * self.grow)
+            logging.info(f"Next time-lapse capture in {self.interval:.0f}s "
+                         f"(detections={len(detections) if detections else 0}, sensors_changed={changed})")
+            return self.interval
+
+    def current(self) -> float:
+        with self.lock:
+            return self.interval
+
+
+class CapturePipeline:
+    """
+    Capture -> metadata -> upload, each stage on its own worker thread with a
+    bounded queue in between, so a slow GPS fix or upload never delays the
+    next camera trigger. Triggers (button or scheduler) are dropped, not
+    queued up, when the camera stage is already saturated.
+    """
+
+    def __init__(self, policy=None):
+        self.policy = policy
+        self.capture_q = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        self.metadata_q = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        self.upload_q = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        self.stop_event = threading.Event()
+        self.threads = [
+            threading.Thread(target=self.capture_worker, daemon=True),
+            threading.Thread(target=self.metadata_worker, daemon=True),
+            threading.Thread(target=self.upload_worker, daemon=True),
+        ]
+
+    def start(self):
+        for t in self.threads:
+            t.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def trigger(self, source: str) -> bool:
+        try:
+            self.capture_q.put_nowait(source)
+            return True
+        except queue.Full:
+            logging.warning(f"Capture busy, dropping {source} trigger")
+            return False
+
+    def get(self, q):
+        while not self.stop_event.is_set():
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return None
+
+    def capture_worker(self):
+        while (source := self.get(self.capture_q)) is not None:
+            led_green.value = 0
+            led_blue.value = 1
+            led_red.value = 0
+
+            file_path = capture_photo()
+            led_blue.value = 0
+
+            if not file_path:
+                # Capture failed
+                led_red.blink(on_time=0.5, off_time=0.5, n=20, background=True)
+                continue
+
+            led_red.value = 1
+            self.metadata_q.put((source, file_path))
+
+    def metadata_worker(self):
+        while (item := self.get(self.metadata_q)) is not None:
+            source, file_path = item
+
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            temperature, pressure, humidity = get_weather()
+            latitude, longitude = get_gps_data()
+
+            logging.info(f"Timestamp: {timestamp} ({source})")
+            if latitude is not None and longitude is not None:
+                logging.info(f"GPS Coordinates: Latitude={latitude}, Longitude={longitude}")
+            if temperature is not None:
+                logging.info(f"Temperature: {temperature}°C")
+            if pressure is not None:
+                logging.info(f"Pressure: {pressure} hPa")
+            if humidity is not None:
+                logging.info(f"Humidity: {humidity}%")
+
+            try:
+                add_gps_metadata(file_path, latitude, longitude, temperature, pressure, humidity)
+            except Exception:
+                # Metadata writing failed
+                led_red.blink(on_time=0.5, off_time=0.5, n=20, background=True)
+                led_green.value = 0
+                continue
+
+            detections = detect_objects(file_path)
+            if self.policy is not None:
+                self.policy.update(detections, {
+                    "temperature": temperature,
+                    "pressure": pressure,
+                    "humidity": humidity,
+                })
+
+            # Success: green on
+            led_red.value = 0
+            led_green.value = 1
+            self.upload_q.put((file_path, detections))
+
+    def upload_worker(self):
+        # Originals requested by the server are sent only when no fresh
+        # capture is waiting, so they never delay new frames.
+        requested = set()
+        while not self.stop_event.is_set():
+            try:
+                file_path, detections = self.upload_q.get(timeout=0.5)
+                variant = None
+            except queue.Empty:
+                if not requested:
+                    continue
+                file_path = os.path.join(IMAGE_DIR, requested.pop())
+                if not os.path.exists(file_path):
+                    continue
+                detections, variant = None, "full"
+
+            wanted = upload_photo(file_path, detections, self.upload_q.qsize(), variant)
+            if wanted is None and variant == "full":
+                requested.add(os.path.basename(file_path))  # retry later
+            elif wanted:
+                requested.update(os.path.basename(f) for f in wanted)
+
+
+def run_scheduler(pipeline, policy):
+    """Trigger a capture every policy.current() seconds until the pipeline stops."""
+    while not pipeline.stop_event.wait(policy.current()):
+        pipeline.trigger("timelapse")
+
+
+def handle_button_press() -> None:
+    pipeline.trigger("button")
+
+
+parser = argparse.ArgumentParser(description="AntPi camera client")
+parser.add_argument("--timelapse", action="store_true",
+                    help="capture periodically in addition to the button")
+parser.add_argument("--interval", type=float, default=TIMELAPSE_INTERVAL,
+                    help="time-lapse interval in seconds")
+parser.add_argument("--fixed", action="store_true",
+                    help="disable the adaptive policy and keep --interval constant")
+args = parser.parse_args()
+
+policy = None
+if args.timelapse:
+    policy = AdaptiveInterval(
+        interval=args.interval,
+        min_interval=min(TIMELAPSE_MIN_INTERVAL, args.interval),
+        max_interval=max(TIMELAPSE_MAX_INTERVAL, args.interval),
+        adaptive=not args.fixed,
+    )
+
+pipeline = CapturePipeline(policy)
+pipeline.start()
+
+if policy is not None:
+    threading.Thread(target=run_scheduler, args=(pipeline, policy), daemon=True).start()
+    logging.info(f"Time-lapse enabled ({'fixed' if args.fixed else 'adaptive'}, {args.interval:.0f}s)")
+
 # Event binding
 capture_button.when_pressed = handle_button_press
 
@@ -0,0 +1,279 @@
+"""
+YOLO-ready training directory built from the uploads, kept in sync with the
+catalog change log instead of being rebuilt.
+
+    python dataset.py static/uploads/dataset --root static/uploads
+
+    training = TrainingSet(UPLOAD_ROOT, DATASET_DIR, changes)
+    training.sync()     # first call: every image; then only changed ones
+
+Layout (Ultralytics):
+
+    <dir>/data.yaml
+    <dir>/images/{train,val}/<image>     hardlink (reflink, then copy, across filesystems)
+    <dir>/labels/{train,val}/<stem>.txt  copy of the TP-only YOLO txt
+    <dir>/state.json                     splits and the last applied change version
+
+Only images with at least one true-positive box are included: unlabeled
+images and images whose boxes are all false positives are left out.
+Splits are stratified by most frequent class x device: an image gets its
+split when it first qualifies and then keeps it (also across relabels), so
+val never leaks into train. The images a sync adds to a stratum fill its
+val share (val_count(): VAL_FRACTION of it, at least one image from two
+images on) in the order of a stable hash of their filenames, so a stratum
+built in one sync gets the same split whatever the upload order.
+"""
+import os
+import json
+import errno
+import shutil
+import argparse
+import hashlib
+import threading
+import collections
+from changes import ChangeLog
+from filenames import device_of
+
+VAL_FRACTION = 0.2
+SPLITS = ("train", "val")
+
+# Same order as CLASS_DEFS in static/labeler.js
+CLASS_NAMES = [
+    "Camponotus vagus",
+    "Plagiolepis pygmaea",
+    "Crematogaster scutellaris",
+    "Temnothorax spp.",
+    "Dolichoderus quadripunctatus",
+    "Colobopsis truncata",
+]
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg")
+
+FICLONE = 0x40049409   # Linux ioctl: share the extents of another file (btrfs, XFS)
+
+
+def hash_rank(filename):
+    """Stable pseudo-random order of filenames (same on every run and machine)."""
+    return hashlib.sha1(filename.encode()).digest()
+
+
+def val_count(n, val_fraction=VAL_FRACTION):
+    """Val images of a stratum of n: the rounded fraction, at least one once there are two."""
+    return 0 if n < 2 else max(1, int(val_fraction * n + 0.5))
+
+
+def read_tp_classes(txt_path):
+    """Classes of the boxes in a YOLO txt (TP-only by construction), [] if missing/empty."""
+    classes = []
+    try:
+        with open(txt_path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 5:
+                    classes.append(int(float(parts[0])))
+    except (OSError, ValueError):
+        return []
+    return classes
+
+
+def link_or_copy(src, dst):
+    """Hardlink src to dst; reflink or copy when they are on different filesystems. Returns the method."""
+    tmp = dst + ".tmp"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+        method = "hardlink"
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+        method = "copy"
+        try:
+            import fcntl
+            with open(src, "rb") as fs, open(tmp, "wb") as fd:
+                fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+            method = "reflink"
+        except (ImportError, OSError):
+            shutil.copyfile(src, tmp)
+        shutil.copystat(src, tmp)
+    os.replace(tmp, dst)
+    return method
+
+
+def up_to_date(src, dst):
+    """dst is src (same inode), or a copy with the same size and mtime."""
+    try:
+        if os.path.samefile(src, dst):
+            return True
+        a, b = os.stat(src), os.stat(dst)
+    except OSError:
+        return False
+    return a.st_size == b.st_size and a.st_mtime_ns == b.st_mtime_ns
+
+
+class TrainingSet:
+    """Materialized train/val directory of one upload root."""
+
+    def __init__(self, upload_root, out_dir, changes, val_fraction=VAL_FRACTION, restore=None):
+        self.images_dir = os.path.join(upload_root, "images")
+        self.labels_dir = os.path.join(upload_root, "labels")
+        self.out_dir = out_dir
+        self.changes = changes
+        self.val_fraction = val_fraction
+        self.state_path = os.path.join(out_dir, "state.json")
+        self.restore = restore   # brings an archived original back before linking (retention.py)
+        self.lock = threading.Lock()
+
+    @property
+    def exists(self):
+        return os.path.exists(self.state_path)
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"version": 0, "images": {}}
+
+    def _save_state(self, state):
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_path)
+
+    def _write_yaml(self):
+        lines = [f"path: {os.path.abspath(self.out_dir)}", "train: images/train", "val: images/val", "names:"]
+        lines += [f"  {i}: {name}" for i, name in enumerate(CLASS_NAMES)]
+        with open(os.path.join(self.out_dir, "data.yaml"), "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def _paths(self, name, split):
+        stem = os.path.splitext(name)[0]
+        return (os.path.join(self.out_dir, "images", split, name),
+                os.path.join(self.out_dir, "labels", split, stem + ".txt"))
+
+    def sync(self):
+        """
+        Bring the directory up to date: all images the first time (or after a
+        server restart, which may have missed changes), else the images
+        changed since the last sync. Returns a summary dict.
+        """
+        with self.lock:
+            for kind in ("images", "labels"):
+                for split in SPLITS:
+                    os.makedirs(os.path.join(self.out_dir, kind, split), exist_ok=True)
+
+            state = self._load_state()
+            entries = state["images"]
+            full = not self.exists or state["version"] < self.changes.last_reset()
+            if full:
+                version = self.changes.version()
+                names = {f for f in os.listdir(self.images_dir) if f.lower().endswith(IMAGE_EXTENSIONS)}
+                names |= set(entries)
+            else:
+                version, changed = self.changes.since(state["version"])
+                names = set(changed)
+
+            strata = {name: self._stratum(name) for name in sorted(names)}
+            self._assign_splits(entries, strata)
+            done = collections.Counter()
+            for name, stratum in strata.items():
+                done[self._update(name, entries, stratum)] += 1
+
+            state["version"] = version
+            self._write_yaml()
+            self._save_state(state)
+
+            included = [e for e in entries.values() if e["included"]]
+            return {
+                "dir": os.path.abspath(self.out_dir),
+                "version": version,
+                "full": full,
+                "checked": len(names),
+                "changes": dict(done),
+                "images": {s: sum(1 for e in included if e["split"] == s) for s in SPLITS},
+                "excluded": len(entries) - len(included),
+            }
+
+    def _stratum(self, name):
+        """"<most frequent class>|<device>" of an image, None if it does not qualify."""
+        txt = os.path.join(self.labels_dir, os.path.splitext(name)[0] + ".txt")
+        classes = read_tp_classes(txt) if os.path.exists(os.path.join(self.images_dir, name)) else []
+        if not classes:
+            return None
+        # Most frequent class, lowest id on ties
+        cls = max(sorted(set(classes)), key=classes.count)
+        return f"{cls}|{device_of(name) or 'unknown'}"
+
+    def _assign_splits(self, entries, strata):
+        """
+        Create the entries of the images in `strata` ({name: stratum or None})
+        that qualify for the first time: per stratum, the lowest-hash ones go
+        to val until it holds val_count() of its images, the rest to train.
+        """
+        counts = collections.Counter()
+        for name, e in entries.items():
+            stratum = strata[name] if name in strata else (e["stratum"] if e["included"] else None)
+            if stratum is not None:
+                counts[(stratum, e["split"])] += 1
+        new = collections.defaultdict(list)
+        for name, stratum in strata.items():
+            if stratum is not None and name not in entries:
+                new[stratum].append(name)
+
+        for stratum, names in new.items():
+            n_val, n_train = counts[(stratum, "val")], counts[(stratum, "train")]
+            slots = val_count(n_val + n_train + len(names), self.val_fraction) - n_val
+            for i, name in enumerate(sorted(names, key=hash_rank)):
+                entries[name] = {"split": "val" if i < slots else "train", "stratum": stratum, "included": False}
+
+    def _update(self, name, entries, stratum):
+        """Link, relabel or remove one image (its split already assigned); returns what was done."""
+        src = os.path.join(self.images_dir, name)
+        txt = os.path.join(self.labels_dir, os.path.splitext(name)[0] + ".txt")
+        entry = entries.get(name)
+
+        if stratum is None:
+            if entry is not None and entry["included"]:
+                for path in self._paths(name, entry["split"]):
+                    if os.path.exists(path):
+                        os.remove(path)
+            if not os.path.exists(src):
+                entries.pop(name, None)
+                return "removed" if entry is not None else "unchanged"
+            if entry is not None:
+                entry["included"] = False
+            return "excluded"
+
+        entry["stratum"], entry["included"] = stratum, True
+
+        image_dst, label_dst = self._paths(name, entry["split"])
+        result = "unchanged"
+        if self.restore is not None and self.restore(name):
+            result = "restored"
+        if not up_to_date(src, image_dst):
+            result = link_or_copy(src, image_dst)
+        with open(txt) as f:
+            label = f.read()
+        try:
+            with open(label_dst) as f:
+                same = f.read() == label
+        except OSError:
+            same = False
+        if not same:
+            with open(label_dst, "w") as f:
+                f.write(label)
+            if result == "unchanged":
+                result = "relabeled"
+        return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Materialize a YOLO training directory from the uploads")
+    parser.add_argument("out", help="dataset directory (same filesystem as the uploads for hardlinks)")
+    parser.add_argument("--root", default=os.path.join("static", "uploads"), help="upload root")
+    parser.add_argument("--val", type=float, default=VAL_FRACTION, help="fraction of each stratum in val")
+    args = parser.parse_args()
+
+    changes = ChangeLog(os.path.join(args.root, "changes.sqlite"))
+    print(json.dumps(TrainingSet(args.root, args.out, changes, args.val).sync(), indent=4))
@@ -0,0 +1,236 @@
+"""
+Near-duplicate detection for uploads: a 64-bit perceptual hash (dHash) per
+image, and a multi-index hash table in SQLite to find the images within a
+few bits of a new one without comparing against all of them.
+
+    dedup = DuplicateIndex(UPLOAD_ROOT)
+    h = image_hash(path_or_file)
+    match = dedup.nearest(h)                  # (filename, distance, group) or None
+    group, others = dedup.add(filename, h)    # joins the group of its nearest match
+    others = dedup.forget(filename)           # leaves it
+
+    python dedup.py --root static/uploads --workers 4   # hash existing images
+
+The hash is split into HASH_CHUNKS 16-bit chunks, each with its own index.
+Two hashes within MAX_DISTANCE bits have, by pigeonhole, a chunk within
+MAX_DISTANCE // HASH_CHUNKS bits of each other, so a lookup probes the
+chunk values at that radius (17 per chunk for MAX_DISTANCE 6) and checks
+only the rows found. A group is named after its first image. add() and
+forget() return the other members of the group, whose group size (shown in
+the gallery) has just changed.
+"""
+import os
+import sqlite3
+import argparse
+import threading
+import multiprocessing as mp
+from PIL import Image
+from changes import ChangeLog
+
+HASH_SIZE = 8          # dHash of a (HASH_SIZE + 1) x HASH_SIZE grayscale thumbnail: 64 bits
+HASH_CHUNKS = 4
+CHUNK_BITS = 64 // HASH_CHUNKS
+MAX_DISTANCE = 6       # bits; frames of a static scene differ by a few bits
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg")
+
+QUERY_CHUNK = 500      # filenames per IN (...) list
+
+
+def image_hash(src):
+    """dHash (64-bit int) of an image path or file object: where brightness rises left to right."""
+    with Image.open(src) as img:
+        img.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))   # JPEG: decode at 1/8 scale
+        small = img.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR)
+    px = list(small.getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left, right = px[row * (HASH_SIZE + 1) + col], px[row * (HASH_SIZE + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def chunks(value):
+    mask = (1 << CHUNK_BITS) - 1
+    return [(value >> (i * CHUNK_BITS)) & mask for i in range(HASH_CHUNKS)]
+
+
+def neighbours(chunk, radius):
+    """Chunk values within `radius` bits (radius 0 or 1)."""
+    out = [chunk]
+    if radius >= 1:
+        out += [chunk ^ (1 << b) for b in range(CHUNK_BITS)]
+    return out
+
+
+def to_signed(value):
+    """SQLite integers are signed 64-bit."""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class DuplicateIndex:
+    """Hashes and duplicate groups of one upload root (phash.sqlite)."""
+
+    def __init__(self, upload_root, max_distance=MAX_DISTANCE):
+        if max_distance // HASH_CHUNKS > 1:
+            raise ValueError(f"max_distance must be below {2 * HASH_CHUNKS}")
+        self.max_distance = max_distance
+        self.conn = sqlite3.connect(os.path.join(upload_root, "phash.sqlite"), check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS hashes (
+                    filename TEXT PRIMARY KEY,
+                    hash INTEGER NOT NULL,
+                    grp TEXT NOT NULL,
+                    {', '.join(f'c{i} INTEGER NOT NULL' for i in range(HASH_CHUNKS))}
+                )
+            """)
+            for i in range(HASH_CHUNKS):
+                self.conn.execute(f"CREATE INDEX IF NOT EXISTS hashes_c{i} ON hashes (c{i})")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS hashes_grp ON hashes (grp)")
+            # Images in groups of more than one, kept current by add() and forget()
+            self.grouped = self.conn.execute(
+                "SELECT COALESCE(SUM(n), 0) FROM (SELECT COUNT(*) AS n FROM hashes GROUP BY grp HAVING n > 1)"
+            ).fetchone()[0]
+
+    def nearest(self, value, exclude=None):
+        """Closest hashed image within max_distance: (filename, distance, group), or None."""
+        radius = self.max_distance // HASH_CHUNKS
+        candidates = {}
+        with self.lock:
+            for i, chunk in enumerate(chunks(value)):
+                probe = neighbours(chunk, radius)
+                for r in self.conn.execute(
+                        f"SELECT filename, hash, grp FROM hashes WHERE c{i} IN ({','.join('?' * len(probe))})", probe):
+                    candidates[r["filename"]] = (r["hash"] & ((1 << 64) - 1), r["grp"])
+
+        best = None
+        for filename, (other, group) in candidates.items():
+            if filename == exclude:
+                continue
+            distance = bin(value ^ other).count("1")
+            if distance <= self.max_distance and (best is None or (distance, filename) < (best[1], best[0])):
+                best = (filename, distance, group)
+        return best
+
+    def _grouped_in(self, groups):
+        """Images in groups of more than one among `groups` (index lookups on grp)."""
+        total = 0
+        for group in groups:
+            n = self.conn.execute("SELECT COUNT(*) FROM hashes WHERE grp = ?", (group,)).fetchone()[0]
+            total += n if n > 1 else 0
+        return total
+
+    def _old_group(self, filename):
+        row = self.conn.execute("SELECT grp FROM hashes WHERE filename = ?", (filename,)).fetchone()
+        return row["grp"] if row else None
+
+    def _members(self, group, exclude):
+        rows = self.conn.execute("SELECT filename FROM hashes WHERE grp = ? AND filename != ?", (group, exclude))
+        return [r["filename"] for r in rows]
+
+    def add(self, filename, value):
+        """
+        Store the hash of an image; returns its group (its nearest match's,
+        else its own name) and the group's other members.
+        """
+        match = self.nearest(value, exclude=filename)
+        group = match[2] if match else filename
+        with self.lock, self.conn:
+            touched = {group, self._old_group(filename)} - {None}
+            before = self._grouped_in(touched)
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO hashes (filename, hash, grp, {', '.join(f'c{i}' for i in range(HASH_CHUNKS))}) "
+                f"VALUES (?, ?, ?, {', '.join('?' * HASH_CHUNKS)})",
+                [filename, to_signed(value), group] + chunks(value))
+            self.grouped += self._grouped_in(touched) - before
+            return group, self._members(group, filename)
+
+    def has(self, filename):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM hashes WHERE filename = ?", (filename,)).fetchone() is not None
+
+    def forget(self, filename):
+        """Drop an image's hash; returns the other members of its group."""
+        with self.lock, self.conn:
+            group = self._old_group(filename)
+            if group is None:
+                return []
+            before = self._grouped_in([group])
+            self.conn.execute("DELETE FROM hashes WHERE filename = ?", (filename,))
+            self.grouped += self._grouped_in([group]) - before
+            return self._members(group, filename)
+
+    def groups(self, filenames=None):
+        """
+        {filename: (group, group size)} for the images in groups of more than
+        one; with `filenames`, only those are looked up (index on filename,
+        sizes counted on the grp index).
+        """
+        with self.lock:
+            if filenames is None:
+                rows = self.conn.execute("""
+                    SELECT h.filename, h.grp, g.n FROM hashes h
+                    JOIN (SELECT grp, COUNT(*) AS n FROM hashes GROUP BY grp HAVING n > 1) g ON g.grp = h.grp
+                """).fetchall()
+            else:
+                filenames = list(filenames)
+                rows = []
+                for i in range(0, len(filenames), QUERY_CHUNK):
+                    chunk = filenames[i:i + QUERY_CHUNK]
+                    rows += self.conn.execute(f"""
+                        SELECT h.filename, h.grp, (SELECT COUNT(*) FROM hashes g WHERE g.grp = h.grp) AS n
+                        FROM hashes h WHERE h.filename IN ({','.join('?' * len(chunk))})
+                    """, chunk).fetchall()
+        return {r["filename"]: (r["grp"], r["n"]) for r in rows if r["n"] > 1}
+
+
+def _hash_file(path):
+    try:
+        return os.path.basename(path), image_hash(path)
+    except OSError:
+        return os.path.basename(path), None
+
+
+def backfill(upload_root, workers=None):
+    """
+    Hash the images not hashed yet on a process pool; returns how many were
+    added. Images that end up in a group are logged as "updated" in the
+    change log, so a running server's gallery picks their groups up.
+    """
+    index = DuplicateIndex(upload_root)
+    images_dir = os.path.join(upload_root, "images")
+    todo = sorted(f for f in os.listdir(images_dir) if f.lower().endswith(IMAGE_EXTENSIONS) and not index.has(f))
+    added = 0
+    grouped = set()
+    with mp.Pool(workers) as pool:
+        # Ordered results: groups form in capture order, as they would at ingest
+        for filename, value in pool.imap(_hash_file, [os.path.join(images_dir, f) for f in todo], chunksize=32):
+            if value is None:
+                print(f"Skipping unreadable {filename}")
+                continue
+            _, others = index.add(filename, value)
+            if others:
+                grouped.update(others)
+                grouped.add(filename)
+            added += 1
+            if added % 1000 == 0:
+                print(f"{added} / {len(todo)} hashed")
+    if grouped:
+        ChangeLog(os.path.join(upload_root, "changes.sqlite")).record_many(sorted(grouped), "updated")
+    return added
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hash existing uploads for near-duplicate detection")
+    parser.add_argument("--root", default=os.path.join("static", "uploads"), help="upload root")
+    parser.add_argument("--workers", type=int, help="hashing processes (default: CPU count)")
+    args = parser.parse_args()
+
+    n = backfill(args.root, args.workers)
+    groups = DuplicateIndex(args.root).groups()
+    print(f"{n} images hashed; {len(groups)} images in {len(set(g for g, _ in groups.values()))} duplicate groups")
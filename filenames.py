@@ -0,0 +1,45 @@
+"""
+What an upload's filename says about it, in one place for the indexes
+(catalog.py, dataset.py, retention.py) and the gallery:
+
+    2023-07-20T20-19-46+0200_b8-27-eb-3b-8d-1c.jpeg   capture time with UTC offset, client id (MAC)
+    img_20230720-201946.jpg                           capture time (local) as named by client.py
+
+/receive stores names through secure_filename(), which drops the "+" of a
+positive offset (2023-07-20T20-19-460200_...); an unsigned offset is read
+as positive. Other names have no client id, and their capture time is the
+file mtime.
+"""
+import os
+import re
+import datetime
+
+# Client id (MAC address) at the end of the stem
+DEVICE_SUFFIX = re.compile(r"_((?:[0-9a-f]{2}-){5}[0-9a-f]{2})$", re.IGNORECASE)
+
+# Capture time at the start of the stem: (pattern, strptime format of its
+# groups joined, an empty group standing for "+")
+TIME_PREFIXES = (
+    (re.compile(r"^(\d{4}-\d{2}-\d{2}T\d{2}-\d{2}-\d{2})([+-]?)(\d{4})(?:_|$)"), "%Y-%m-%dT%H-%M-%S%z"),
+    (re.compile(r"^img_(\d{8}-\d{6})$"), "%Y%m%d-%H%M%S"),
+)
+
+
+def device_of(filename):
+    """Client id from the MAC-style suffix of the name (lowercase), else None."""
+    match = DEVICE_SUFFIX.search(os.path.splitext(filename)[0])
+    return match.group(1).lower() if match else None
+
+
+def capture_time(filename, path):
+    """Timestamp from the name (see the module docstring), else the mtime of `path`."""
+    stem = os.path.splitext(filename)[0]
+    for pattern, fmt in TIME_PREFIXES:
+        match = pattern.match(stem)
+        if match:
+            try:
+                text = "".join(group or "+" for group in match.groups())
+                return datetime.datetime.strptime(text, fmt).timestamp()
+            except ValueError:
+                break
+    return os.path.getmtime(path)
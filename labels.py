@@ -0,0 +1,133 @@
+"""
+Label files of the catalog (labels/<stem>.txt, YOLO, TP boxes only, and
+jsons/<stem>.json, every box with is_tp) behind one reader and writer, with
+the per-image summary the gallery shows cached in memory.
+
+    store = LabelStore(UPLOAD_ROOT, changes)
+    store.sync()                  # drop the images changed since the last sync
+    store.summaries(filenames)    # {filename: (labels_count, is_labeled)}
+    store.load("img.jpeg")        # boxes for the labeler
+    store.save("img.jpeg", boxes) # txt + json, logged as "relabeled"
+
+labels_count is the number of non-empty lines of the txt, is_labeled
+whether the json is non-empty. The change log is the only invalidation:
+every writer logs the images it touches (label saves here, deletions in
+server-picture.py), so a store sees saves made through another store, in
+another process (two-server deployment) or in the same one (server.py), at
+its next sync.
+"""
+import os
+import json
+import threading
+
+BOX_FIELDS = ("x_center", "y_center", "width", "height")
+
+
+def box(cls, xc, yc, w, h, is_tp):
+    return {"cls": cls, "x_center": xc, "y_center": yc, "width": w, "height": h, "is_tp": is_tp}
+
+
+class LabelStore:
+    """Thread-safe; summaries are read once per image and change."""
+
+    def __init__(self, upload_root, changes):
+        self.labels_dir = os.path.join(upload_root, "labels")
+        self.jsons_dir = os.path.join(upload_root, "jsons")
+        self.changes = changes
+        self.lock = threading.Lock()
+        self.cache = {}   # filename -> (labels_count, is_labeled)
+        self.version = changes.version()   # the cache starts empty: nothing older can be stale
+
+    def txt_path(self, filename):
+        return os.path.join(self.labels_dir, os.path.splitext(filename)[0] + ".txt")
+
+    def json_path(self, filename):
+        return os.path.join(self.jsons_dir, os.path.splitext(filename)[0] + ".json")
+
+    def sync(self):
+        """Forget the summaries of the images changed since the last sync."""
+        with self.lock:
+            self.version, changed = self.changes.since(self.version)
+            for filename in changed:
+                self.cache.pop(filename, None)
+
+    def forget(self, filename):
+        with self.lock:
+            self.cache.pop(filename, None)
+
+    def _summary(self, filename):
+        count = 0
+        try:
+            with open(self.txt_path(filename), "r") as f:
+                count = sum(1 for line in f if line.strip())
+        except OSError:
+            pass
+        try:
+            labeled = os.path.getsize(self.json_path(filename)) > 0
+        except OSError:
+            labeled = False
+        return count, labeled
+
+    def summaries(self, filenames):
+        """{filename: (labels_count, is_labeled)}, from the cache where possible."""
+        with self.lock:
+            out = {}
+            for filename in filenames:
+                if filename not in self.cache:
+                    self.cache[filename] = self._summary(filename)
+                out[filename] = self.cache[filename]
+            return out
+
+    def summary(self, filename):
+        return self.summaries([filename])[filename]
+
+    def _read_json(self, filename):
+        """Boxes of the json, or None when it is missing, empty or not a list."""
+        try:
+            with open(self.json_path(filename), "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return data if isinstance(data, list) else None
+
+    def load(self, filename):
+        """
+        All boxes of an image: the json if any (authoritative; is_tp defaults
+        to True), else the txt, whose boxes are all TP. Raises ValueError or
+        OSError for an unreadable txt.
+        """
+        entries = self._read_json(filename)
+        if entries is not None:
+            boxes = []
+            for l in entries:
+                try:
+                    boxes.append(box(int(l["cls"]), *(float(l[k]) for k in BOX_FIELDS), bool(l.get("is_tp", True))))
+                except (KeyError, ValueError, TypeError):
+                    continue
+            return boxes
+
+        txt = self.txt_path(filename)
+        if not os.path.exists(txt):
+            return []
+        boxes = []
+        with open(txt, "r") as f:
+            for line in f:
+                parts = line.strip().split()
+                if len(parts) != 5:
+                    continue
+                boxes.append(box(int(float(parts[0])), *(float(p) for p in parts[1:]), True))
+        return boxes
+
+    def save(self, filename, boxes):
+        """
+        Write the TP boxes to the txt and all boxes to the json, and log the
+        change. `boxes` are already validated (see box()).
+        """
+        with open(self.txt_path(filename), "w") as f:
+            for b in boxes:
+                if b["is_tp"]:
+                    f.write(f"{b['cls']} {b['x_center']:.6f} {b['y_center']:.6f} {b['width']:.6f} {b['height']:.6f}\n")
+        with open(self.json_path(filename), "w") as f:
+            json.dump(boxes, f, indent=2)
+        self.forget(filename)
+        return self.changes.record(filename, "relabeled")
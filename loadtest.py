@@ -0,0 +1,322 @@
+"""
+Load test for server-picture.py and server-labeler.py on a synthetic dataset.
+
+    python loadtest.py --sizes 1000,10000,100000 --concurrency 1,8
+
+For every dataset size the script grows a synthetic dataset (images named
+like the client's uploads, 2023-07-20T20-19-46+0200_<mac>.jpeg, with YOLO
+labels and per-image jsons for part of them) in a scratch upload root,
+starts both servers on it (ANTPI_UPLOAD_ROOT), and drives each endpoint
+from local client processes. Throughput and p50/p99 latency per size,
+endpoint and concurrency are printed and written to loadtest_results.csv.
+
+    python loadtest.py --sizes 100000 --endpoints index,socketio,get_labels --during-export
+
+--during-export runs every measurement twice: idle, then while another
+process downloads /download-dataset over and over, so the rows show how
+much a large export slows down the rest of the servers ("index" and
+"socketio", the Engine.IO polling handshake, touch no disk at all).
+--combined starts server.py (both route sets in one process) instead of the
+two servers; every row records the servers' resident memory.
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import argparse
+import datetime
+import tempfile
+import subprocess
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+import psutil
+import requests
+from PIL import Image
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PICTURE_URL = "http://127.0.0.1:5000"
+LABELER_URL = "http://127.0.0.1:5001"
+SERVERS = [("server-picture.py", PICTURE_URL + "/"), ("server-labeler.py", LABELER_URL + "/label?image=x")]
+# --combined: both route sets in one process (server.py)
+COMBINED_SERVERS = [("server.py", PICTURE_URL + "/label?image=x")]
+SERVER_START_TIMEOUT = 60
+
+# Synthetic dataset: one capture per minute, round-robin over a few clients
+START_TIME = datetime.datetime(2023, 7, 1, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+DEVICE_MACS = ["b8-27-eb-3b-8d-1c", "b8-27-eb-11-22-33", "dc-a6-32-aa-bb-cc", "d8-3a-dd-01-02-03"]
+IMAGE_SIZE = (640, 480)
+LABELED_FRACTION = 0.5
+
+# Requests per run: listing and export scan the whole dataset, so fewer
+ENDPOINTS = {
+    "get-images": 20,
+    "get_labels": 200,
+    "save_labels": 200,
+    "download-dataset": 3,
+    "receive": 200,
+    "index": 200,
+    "socketio": 200,
+}
+EXPORT_WARMUP = 1.0   # seconds between starting the background export and measuring
+
+
+def synthetic_jpeg(size=IMAGE_SIZE, seed=0):
+    """A noise JPEG (does not compress away, so sizes stay realistic)."""
+    pixels = np.random.default_rng(seed).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+
+def synthetic_name(i):
+    ts = START_TIME + datetime.timedelta(minutes=i)
+    return f"{ts.strftime('%Y-%m-%dT%H-%M-%S%z')}_{DEVICE_MACS[i % len(DEVICE_MACS)]}.jpeg"
+
+
+def synthetic_labels(rng):
+    return [{
+        "cls": 0,
+        "x_center": round(rng.uniform(0.1, 0.9), 6),
+        "y_center": round(rng.uniform(0.1, 0.9), 6),
+        "width": round(rng.uniform(0.02, 0.2), 6),
+        "height": round(rng.uniform(0.02, 0.2), 6),
+        "is_tp": rng.random() < 0.8,
+    } for _ in range(rng.randint(1, 5))]
+
+
+def make_dataset(root, n):
+    """Grow the synthetic dataset in `root` to n images (existing files are kept)."""
+    images, labels, jsons = (os.path.join(root, d) for d in ("images", "labels", "jsons"))
+    for d in (images, labels, jsons):
+        os.makedirs(d, exist_ok=True)
+
+    jpeg = synthetic_jpeg()
+    start = time.time()
+    for i in range(n):
+        name = synthetic_name(i)
+        path = os.path.join(images, name)
+        if os.path.exists(path):
+            continue
+        with open(path, "wb") as f:
+            f.write(jpeg)
+
+        rng = random.Random(i)
+        if rng.random() >= LABELED_FRACTION:
+            continue
+        entries = synthetic_labels(rng)
+        stem = os.path.splitext(name)[0]
+        with open(os.path.join(jsons, stem + ".json"), "w") as f:
+            json.dump(entries, f, indent=2)
+        with open(os.path.join(labels, stem + ".txt"), "w") as f:
+            for e in entries:
+                if e["is_tp"]:
+                    f.write(f"{e['cls']} {e['x_center']:.6f} {e['y_center']:.6f} {e['width']:.6f} {e['height']:.6f}\n")
+    print(f"Dataset {root}: {n} images ({time.time() - start:.1f} s to generate)")
+
+
+def start_servers(root, servers=SERVERS):
+    """Start the servers on `root` and wait until they answer."""
+    env = dict(os.environ, ANTPI_UPLOAD_ROOT=root)
+    log = open(os.path.join(root, "servers.log"), "a")
+    procs = []
+    for script, _ in servers:
+        # Own process group: the debug reloader forks a child that must go too
+        procs.append(subprocess.Popen([sys.executable, os.path.join(BASE_DIR, script)], cwd=BASE_DIR, env=env,
+                                      stdout=log, stderr=log, start_new_session=True))
+
+    deadline = time.time() + SERVER_START_TIMEOUT
+    for _, url in servers:
+        while True:
+            try:
+                requests.get(url, timeout=1)
+                break
+            except requests.RequestException:
+                if time.time() > deadline:
+                    stop_servers(procs)
+                    raise RuntimeError(f"Server at {url} did not start (see {log.name})")
+                time.sleep(0.5)
+    return procs
+
+
+def stop_servers(procs):
+    for p in procs:
+        try:
+            os.killpg(p.pid, signal.SIGTERM)
+            p.wait(timeout=10)
+        except ProcessLookupError:
+            pass
+        except subprocess.TimeoutExpired:
+            os.killpg(p.pid, signal.SIGKILL)
+            p.wait()
+
+
+def send(session, endpoint, rng, n_images, jpeg, upload_name, labeler_url=LABELER_URL):
+    """One request, body read to the end; returns (response bytes, request bytes)."""
+    sent = 0
+    if endpoint == "get-images":
+        r = session.get(PICTURE_URL + "/get-images", stream=True)
+    elif endpoint == "index":
+        r = session.get(PICTURE_URL + "/", stream=True)
+    elif endpoint == "socketio":
+        r = session.get(PICTURE_URL + "/socket.io/", params={"EIO": 4, "transport": "polling"}, stream=True)
+    elif endpoint == "download-dataset":
+        r = session.get(PICTURE_URL + "/download-dataset", stream=True)
+    elif endpoint == "get_labels":
+        r = session.get(labeler_url + "/get_labels", params={"image": synthetic_name(rng.randrange(n_images))},
+                        stream=True)
+    elif endpoint == "save_labels":
+        payload = json.dumps({"image": synthetic_name(rng.randrange(n_images)), "labels": synthetic_labels(rng)})
+        r = session.post(labeler_url + "/save_labels", data=payload, headers={"Content-Type": "application/json"},
+                         stream=True)
+        sent = len(payload)
+    elif endpoint == "receive":
+        r = session.post(PICTURE_URL + "/receive", files={"image": (upload_name, jpeg, "image/jpeg")}, stream=True)
+        sent = len(jpeg)
+    else:
+        raise ValueError(f"unknown endpoint: {endpoint}")
+
+    received = sum(len(chunk) for chunk in r.iter_content(1 << 16))
+    r.raise_for_status()
+    return received, sent
+
+
+def client_process(args):
+    """Load-generating process: `count` sequential requests on one keep-alive session."""
+    endpoint, n_images, count, seed, labeler_url = args
+    rng = random.Random(seed)
+    session = requests.Session()
+    jpeg = synthetic_jpeg(seed=seed) if endpoint == "receive" else None
+
+    latencies, errors, bytes_in, bytes_out = [], 0, 0, 0
+    started = time.time()
+    for k in range(count):
+        # Uploads get timestamps after the synthetic range, one client id per process
+        upload_name = synthetic_name(n_images + k).split("_")[0] + f"_loadtest-{seed}-{k}.jpeg"
+        t0 = time.perf_counter()
+        try:
+            received, sent = send(session, endpoint, rng, n_images, jpeg, upload_name, labeler_url)
+        except requests.RequestException:
+            errors += 1
+            continue
+        latencies.append((time.perf_counter() - t0) * 1000)
+        bytes_in += received
+        bytes_out += sent
+    return started, time.time(), latencies, errors, bytes_in, bytes_out
+
+
+def export_loop(stop, exports):
+    """Background process: download the dataset zip again and again until `stop` is set."""
+    session = requests.Session()
+    while not stop.is_set():
+        try:
+            r = session.get(PICTURE_URL + "/download-dataset", stream=True)
+            for _ in r.iter_content(1 << 16):
+                pass
+            r.raise_for_status()
+            with exports.get_lock():
+                exports.value += 1
+        except requests.RequestException:
+            time.sleep(0.5)
+
+
+def servers_rss(procs):
+    """Resident memory of the server processes (with the debug reloader's children), bytes."""
+    total = 0
+    for p in procs:
+        try:
+            proc = psutil.Process(p.pid)
+            for q in [proc] + proc.children(recursive=True):
+                total += q.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return total
+
+
+def run_load(endpoint, n_images, concurrency, total, during_export=False, labeler_url=LABELER_URL):
+    """Spread `total` requests over `concurrency` client processes; one result row."""
+    ctx = mp.get_context("spawn")
+    if during_export:
+        stop, exports = ctx.Event(), ctx.Value("i", 0)
+        exporter = ctx.Process(target=export_loop, args=(stop, exports), daemon=True)
+        exporter.start()
+        time.sleep(EXPORT_WARMUP)
+
+    counts = [total // concurrency + (1 if i < total % concurrency else 0) for i in range(concurrency)]
+    jobs = [(endpoint, n_images, c, seed, labeler_url) for seed, c in enumerate(counts) if c]
+    try:
+        with ctx.Pool(len(jobs)) as pool:
+            results = pool.map(client_process, jobs)
+    finally:
+        if during_export:
+            stop.set()
+            exporter.join()
+
+    # Wall time from the first request to the last response (pool startup excluded)
+    elapsed = max(r[1] for r in results) - min(r[0] for r in results)
+    latencies = np.concatenate([r[2] for r in results]) if any(r[2] for r in results) else np.array([np.nan])
+    p50, p99 = np.percentile(latencies, [50, 99])
+    return {
+        "n_images": n_images,
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "during_export": during_export,
+        "exports": exports.value if during_export else 0,
+        "requests": total,
+        "errors": sum(r[3] for r in results),
+        "seconds": round(elapsed, 3),
+        "req_per_s": round((total - sum(r[3] for r in results)) / elapsed, 2),
+        "p50_ms": round(float(p50), 2),
+        "p99_ms": round(float(p99), 2),
+        "MB_in": round(sum(r[4] for r in results) / 2 ** 20, 2),
+        "MB_out": round(sum(r[5] for r in results) / 2 ** 20, 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the picture and labeler servers")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma-separated dataset sizes")
+    parser.add_argument("--concurrency", default="1,8", help="comma-separated client process counts")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help="comma-separated, from: " + ", ".join(ENDPOINTS))
+    parser.add_argument("--combined", action="store_true",
+                        help="run both route sets in one process (server.py) instead of two servers")
+    parser.add_argument("--during-export", action="store_true",
+                        help="also measure every run while /download-dataset is running")
+    parser.add_argument("--requests", type=int, help="requests per run for every endpoint (default: per endpoint)")
+    parser.add_argument("--root", help="upload root for the synthetic dataset (default: a temporary directory)")
+    parser.add_argument("--keep", action="store_true", help="keep the synthetic dataset afterwards")
+    parser.add_argument("--csv", default="loadtest_results.csv", help="where to write the results")
+    args = parser.parse_args()
+
+    root = args.root or tempfile.mkdtemp(prefix="antpi-loadtest-")
+    endpoints = args.endpoints.split(",")
+    rows = []
+    try:
+        for n in sorted(int(x) for x in args.sizes.split(",")):
+            make_dataset(root, n)
+            procs = start_servers(root, COMBINED_SERVERS if args.combined else SERVERS)
+            try:
+                for endpoint in endpoints:
+                    for concurrency in (int(x) for x in args.concurrency.split(",")):
+                        for during_export in (False, True) if args.during_export else (False,):
+                            row = run_load(endpoint, n, concurrency, args.requests or ENDPOINTS[endpoint],
+                                           during_export, PICTURE_URL if args.combined else LABELER_URL)
+                            row["servers_rss_mb"] = round(servers_rss(procs) / 2 ** 20, 1)
+                            print(f"{n:>7} {endpoint:<17} c={concurrency:<3} {'export' if during_export else 'idle':<6} "
+                                  f"{row['req_per_s']:9.2f} req/s  p50 {row['p50_ms']:9.2f} ms  "
+                                  f"p99 {row['p99_ms']:9.2f} ms  errors {row['errors']}  "
+                                  f"servers {row['servers_rss_mb']:.0f} MB")
+                            rows.append(row)
+            finally:
+                stop_servers(procs)
+    finally:
+        if not args.keep and not args.root:
+            shutil.rmtree(root, ignore_errors=True)
+
+    pd.DataFrame(rows).to_csv(args.csv, index=False)
+    print(f"CSV {args.csv} saved.")
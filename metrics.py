@@ -0,0 +1,329 @@
+"""
+Prometheus text-format metrics and request timing for the Flask servers
+(no client library).
+
+    metrics = Metrics("antpi_picture")
+    metrics.install(app)            # per-route latency, bytes, in-flight; GET /metrics
+    metrics.gauge("images", "Images stored", lambda: count_files(IMAGES_DIR, (".jpg", ".jpeg")))
+
+    @metrics.timed("get_sorted_images")
+    def get_sorted_images(...):
+        with metrics.stage("listing"):
+            ...
+
+Recording a request costs a bisect and a few dict updates under a lock;
+gauges (file counts, process RSS/CPU) are only computed when /metrics is
+scraped. Stages of the current request are also returned in its
+Server-Timing header. POST /debug/profile {"seconds": 30} or
+{"requests": 50} (from the server's own host only) samples the handler
+stacks into a collapsed-stack file in profiles/ (flamegraph.pl, speedscope)
+for at most PROFILE_MAX_SECONDS.
+"""
+import os
+import sys
+import time
+import bisect
+import datetime
+import functools
+import threading
+import contextlib
+import collections
+import psutil
+from flask import Response, g, has_request_context, jsonify, request
+
+# Seconds; upper bounds of the latency histogram buckets (+Inf is implicit)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PROFILE_DIR = "profiles"
+PROFILE_INTERVAL = 0.005
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 300   # also ends a {"requests": n} run that never sees n requests
+PROFILE_CLIENTS = {"127.0.0.1", "::1"}
+
+# Not counted as profiled requests
+OWN_ROUTES = {"/metrics", "/debug/profile"}
+
+
+def count_files(directory, extensions):
+    """Number of files in `directory` ending with one of `extensions` (case-insensitive)."""
+    try:
+        with os.scandir(directory) as entries:
+            return sum(1 for e in entries if e.name.lower().endswith(extensions))
+    except OSError:
+        return 0
+
+
+class Histogram:
+    """Cumulative-bucket histogram as exposed by Prometheus."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        out = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (None,), self.counts):
+            cumulative += count
+            le = "+Inf" if bound is None else repr(bound)
+            out.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+        out.append(f"{name}_sum{{{labels}}} {self.sum:.6f}")
+        out.append(f"{name}_count{{{labels}}} {cumulative}")
+        return out
+
+
+class SamplingProfiler:
+    """
+    Samples the Python stack of every other thread each `interval` seconds
+    while `busy()` is true (requests in flight), aggregated as collapsed
+    stacks: one "outer;...;inner count" line per distinct stack.
+    """
+
+    def __init__(self, name, busy, interval=PROFILE_INTERVAL):
+        self.name = name
+        self.busy = busy
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.stacks = collections.Counter()
+        self.deadline = None
+        self.remaining = None
+        self.output = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds=None, requests=None):
+        """
+        Profile for `seconds`, or until `requests` more requests have finished;
+        never longer than PROFILE_MAX_SECONDS.
+        """
+        with self.lock:
+            if self.running:
+                return False
+            self.stacks = collections.Counter()
+            self.remaining = requests
+            if seconds is None:
+                seconds = PROFILE_MAX_SECONDS if requests is not None else PROFILE_DEFAULT_SECONDS
+            self.deadline = time.monotonic() + min(seconds, PROFILE_MAX_SECONDS)
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+            self.thread.start()
+            return True
+
+    def request_done(self):
+        if self.remaining is None or not self.running:
+            return
+        with self.lock:
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self.stop_event.set()
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            if time.monotonic() > self.deadline:
+                break
+            if not self.busy():
+                continue
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+        self.dump()
+
+    def dump(self):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{self.name}-{datetime.datetime.now():%Y%m%d-%H%M%S}.folded")
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        self.output = path
+
+
+class Metrics:
+    """Request and function timings of one Flask app, rendered on GET /metrics."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.requests = {}    # (route, method, status) -> count
+        self.latency = {}     # (route, method) -> Histogram
+        self.bytes_in = {}    # route -> request body bytes
+        self.bytes_out = {}   # route -> response body bytes (when the length is known)
+        self.in_flight = {}   # route -> requests being handled
+        self.timers = {}      # stage/function name -> Histogram
+        self.gauges = {}      # name -> (help, callable)
+        self.process = psutil.Process()
+        self.profiler = SamplingProfiler(prefix, lambda: any(self.in_flight.values()))
+
+    def install(self, app):
+        app.before_request(self._before)
+        app.after_request(self._after)
+        app.teardown_request(self._teardown)
+        app.add_url_rule("/metrics", "metrics", self.render)
+        app.add_url_rule("/debug/profile", "debug_profile", self.profile, methods=["GET", "POST"])
+
+    def gauge(self, name, help_text, func):
+        """Register a value computed at scrape time."""
+        self.gauges[name] = (help_text, func)
+
+    def timed(self, name):
+        """Decorator: record the duration of every call in a histogram."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time a block: stage histogram, plus the request's Server-Timing header."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(name, elapsed)
+            if has_request_context() and "stages" in g:
+                g.stages[name] = g.stages.get(name, 0.) + elapsed
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if name not in self.timers:
+                self.timers[name] = Histogram()
+            self.timers[name].observe(seconds)
+
+    # Unmatched URLs share one label, so 404 scans cannot blow up the series count
+    @staticmethod
+    def _route():
+        return request.url_rule.rule if request.url_rule else "unmatched"
+
+    def _before(self):
+        g.metrics_start = time.perf_counter()
+        g.stages = {}
+        route = self._route()
+        with self.lock:
+            self.in_flight[route] = self.in_flight.get(route, 0) + 1
+            self.bytes_in[route] = self.bytes_in.get(route, 0) + (request.content_length or 0)
+
+    def _after(self, response):
+        elapsed = time.perf_counter() - g.metrics_start
+        route, method = self._route(), request.method
+        with self.lock:
+            key = (route, method, response.status_code)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            if (route, method) not in self.latency:
+                self.latency[(route, method)] = Histogram()
+            self.latency[(route, method)].observe(elapsed)
+            self.bytes_out[route] = self.bytes_out.get(route, 0) + (response.content_length or 0)
+
+        timing = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in g.stages.items()]
+        response.headers["Server-Timing"] = ", ".join(timing + [f"app;dur={elapsed * 1000:.2f}"])
+        if route not in OWN_ROUTES:
+            self.profiler.request_done()
+        return response
+
+    def _teardown(self, exc):
+        if "metrics_start" not in g:
+            return
+        route = self._route()
+        with self.lock:
+            self.in_flight[route] -= 1
+
+    def profile(self):
+        """
+        GET: profiler status. POST {"seconds": s} or {"requests": n}: start
+        sampling; the collapsed stacks are written to profiles/ at the end.
+        Only answered to clients on the server's own host.
+        """
+        if request.remote_addr not in PROFILE_CLIENTS:
+            return jsonify({"status": "error", "message": "profiling is only available from localhost"}), 403
+        if request.method == "POST":
+            data = request.get_json(silent=True) or {}
+            try:
+                seconds = float(data["seconds"]) if "seconds" in data else None
+                requests = int(data["requests"]) if "requests" in data else None
+            except (TypeError, ValueError):
+                return jsonify({"status": "error", "message": "seconds/requests must be numbers"}), 400
+            if not self.profiler.start(seconds, requests):
+                return jsonify({"status": "error", "message": "profiler already running"}), 409
+
+        return jsonify({
+            "running": self.profiler.running,
+            "samples": sum(self.profiler.stacks.values()),
+            "remaining_requests": self.profiler.remaining,
+            "output": self.profiler.output,
+        })
+
+    def render(self):
+        p = self.prefix
+        with self.lock:
+            requests = dict(self.requests)
+            latency = {k: (list(h.counts), h.sum) for k, h in self.latency.items()}
+            timers = {k: (list(h.counts), h.sum) for k, h in self.timers.items()}
+            bytes_in, bytes_out, in_flight = dict(self.bytes_in), dict(self.bytes_out), dict(self.in_flight)
+
+        def histogram(counts, total):
+            h = Histogram()
+            h.counts, h.sum = counts, total
+            return h
+
+        lines = [f"# HELP {p}_http_requests_total Requests handled, by route, method and status.",
+                 f"# TYPE {p}_http_requests_total counter"]
+        for (route, method, status), n in sorted(requests.items()):
+            lines.append(f'{p}_http_requests_total{{route="{route}",method="{method}",status="{status}"}} {n}')
+
+        lines += [f"# HELP {p}_http_request_duration_seconds Request handling time.",
+                  f"# TYPE {p}_http_request_duration_seconds histogram"]
+        for (route, method), (counts, total) in sorted(latency.items()):
+            lines += histogram(counts, total).lines(f"{p}_http_request_duration_seconds",
+                                                    f'route="{route}",method="{method}"')
+
+        for name, values, help_text in [("http_request_bytes_total", bytes_in, "Request body bytes received."),
+                                        ("http_response_bytes_total", bytes_out, "Response body bytes sent.")]:
+            lines += [f"# HELP {p}_{name} {help_text}", f"# TYPE {p}_{name} counter"]
+            lines += [f'{p}_{name}{{route="{route}"}} {n}' for route, n in sorted(values.items())]
+
+        lines += [f"# HELP {p}_http_requests_in_flight Requests currently being handled.",
+                  f"# TYPE {p}_http_requests_in_flight gauge"]
+        lines += [f'{p}_http_requests_in_flight{{route="{route}"}} {n}' for route, n in sorted(in_flight.items())]
+
+        lines += [f"# HELP {p}_stage_duration_seconds Time spent in instrumented stages and functions.",
+                  f"# TYPE {p}_stage_duration_seconds histogram"]
+        for name, (counts, total) in sorted(timers.items()):
+            lines += histogram(counts, total).lines(f"{p}_stage_duration_seconds", f'stage="{name}"')
+
+        for name, (help_text, func) in self.gauges.items():
+            lines += [f"# HELP {p}_{name} {help_text}", f"# TYPE {p}_{name} gauge", f"{p}_{name} {func()}"]
+
+        cpu = self.process.cpu_times()
+        lines += [
+            "# HELP process_resident_memory_bytes Resident set size.",
+            "# TYPE process_resident_memory_bytes gauge",
+            f"process_resident_memory_bytes {self.process.memory_info().rss}",
+            "# HELP process_cpu_seconds_total User and system CPU time.",
+            "# TYPE process_cpu_seconds_total counter",
+            f"process_cpu_seconds_total {cpu.user + cpu.system:.3f}",
+            "# HELP process_num_threads Threads of the server process.",
+            "# TYPE process_num_threads gauge",
+            f"process_num_threads {self.process.num_threads()}",
+        ]
+        return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,242 @@
+"""
+Out-of-process resource sampler used by rpi.py.
+
+The sampler runs as its own lightweight interpreter (psutil only), so it
+never competes for the GIL of the process being measured. It samples the
+target's process tree (RSS/USS, CPU), per-core utilisation, CPU frequency,
+SoC temperature and the Raspberry Pi throttle flags at a fixed rate, and
+hands the buffered samples back when stopped.
+
+    with ResourceProfiler() as prof:
+        run_inference()
+    summary, series = summarize(prof.samples, spans)
+"""
+import os
+import sys
+import json
+import time
+import select
+import platform
+import subprocess
+import importlib.metadata
+import numpy as np
+import psutil
+
+THERMAL_ZONE = "/sys/class/thermal/thermal_zone0/temp"
+CPU_FREQ = "/sys/devices/system/cpu/cpu{}/cpufreq/scaling_cur_freq"
+THROTTLED = "/sys/devices/platform/soc/soc:firmware/get_throttled"
+GOVERNOR = "/sys/devices/system/cpu/cpu0/cpufreq/scaling_governor"
+DEVICE_MODEL = "/proc/device-tree/model"
+
+# Packages whose versions change benchmark results
+FINGERPRINT_PACKAGES = [
+    "ultralytics", "torch", "openvino", "ncnn", "MNN", "tensorflow", "tflite-runtime",
+    "onnx", "numpy", "opencv-python",
+]
+
+# get_throttled bits: 0 under-voltage, 1 arm freq capped, 2 throttled, 3 soft temp limit
+THROTTLE_NOW_MASK = 0xF
+
+
+def read_sysfs(path):
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def read_throttled():
+    """Throttle flags from the firmware sysfs node, falling back to vcgencmd."""
+    value = read_sysfs(THROTTLED)
+    if value is not None:
+        return int(value, 16)
+    try:
+        out = subprocess.run(["vcgencmd", "get_throttled"], capture_output=True, text=True, timeout=1).stdout
+        return int(out.strip().split("=")[1], 16)
+    except Exception:
+        return None
+
+
+def read_temperature():
+    temp = read_sysfs(THERMAL_ZONE)
+    return int(temp) / 1000 if temp else None
+
+
+def environment_fingerprint():
+    """Library versions and device state that a benchmark result depends on."""
+    versions = {}
+    for pkg in FINGERPRINT_PACKAGES:
+        try:
+            versions[pkg] = importlib.metadata.version(pkg)
+        except importlib.metadata.PackageNotFoundError:
+            continue
+
+    model = read_sysfs(DEVICE_MODEL)
+    return {
+        "device_model": model.rstrip("\x00") if model else platform.machine(),
+        "kernel": platform.release(),
+        "python": platform.python_version(),
+        "governor": read_sysfs(GOVERNOR),
+        "cpu_count": psutil.cpu_count(),
+        "temp_C": read_temperature(),
+        "throttled": read_throttled(),
+        "versions": versions,
+    }
+
+
+def sampler(pid, interval):
+    """
+    Sampler process main loop: buffer one sample every `interval` seconds
+    until stdin is closed, then print the samples as JSON lines.
+    """
+    target = psutil.Process(pid)
+    me = os.getpid()
+    n_cpus = psutil.cpu_count() or 1
+    procs = {}
+    samples = []
+    last_throttle_check = 0.0
+    throttled = read_throttled()
+    use_sysfs_throttle = read_sysfs(THROTTLED) is not None
+
+    psutil.cpu_percent(percpu=True)  # prime the per-core counters
+    print("ready", flush=True)
+
+    while True:
+        ready, _, _ = select.select([sys.stdin], [], [], interval)
+        if ready and not sys.stdin.readline():
+            break
+
+        t = time.monotonic()
+        rss = uss = cpu = 0.0
+        try:
+            tree = [target] + target.children(recursive=True)
+        except psutil.NoSuchProcess:
+            break
+        for p in tree:
+            if p.pid == me:
+                continue
+            try:
+                if p.pid not in procs:
+                    procs[p.pid] = p
+                    p.cpu_percent(None)  # first call only primes the counter
+                mem = procs[p.pid].memory_full_info()
+                rss += mem.rss
+                uss += mem.uss
+                cpu += procs[p.pid].cpu_percent(None)
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+
+        # vcgencmd forks a process: poll it at most once per second
+        if use_sysfs_throttle or t - last_throttle_check >= 1.0:
+            throttled = read_throttled()
+            last_throttle_check = t
+
+        freq = read_sysfs(CPU_FREQ.format(0))
+        samples.append({
+            "t": t,
+            "rss_MB": rss / 2 ** 20,
+            "uss_MB": uss / 2 ** 20,
+            "cpu_percent": cpu / n_cpus,
+            "per_core_percent": psutil.cpu_percent(percpu=True),
+            "freq_MHz": int(freq) / 1000 if freq else None,
+            "temp_C": read_temperature(),
+            "throttled": throttled,
+        })
+
+    for s in samples:
+        print(json.dumps(s))
+
+
+class ResourceProfiler:
+    """Start/stop the sampler process for `pid` (default: this process)."""
+
+    def __init__(self, pid=None, interval=0.1):
+        self.pid = pid or os.getpid()
+        self.interval = interval
+        self.proc = None
+        self.samples = []
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), str(self.pid), str(self.interval)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+        )
+        self.proc.stdout.readline()  # "ready"
+        return self
+
+    def stop(self):
+        self.proc.stdin.close()
+        out = self.proc.stdout.read()
+        self.proc.wait()
+        self.samples = [json.loads(line) for line in out.splitlines() if line]
+        return self.samples
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def summarize(samples, spans=None):
+    """
+    Summary stats and aligned time series.
+
+    Args:
+        samples: output of ResourceProfiler.stop()
+        spans: optional list of (t_start, t_end) time.monotonic() pairs, one
+               per inference call
+
+    Returns:
+        (summary dict, series dict) where series holds the raw samples and,
+        per inference, its latency with the temperature/frequency of the
+        nearest sample at its end.
+    """
+    summary = {}
+    series = {"samples": samples, "inferences": []}
+    if samples:
+        def column(key):
+            return np.array([s[key] for s in samples if s[key] is not None], dtype=float)
+
+        rss, uss, cpu = column("rss_MB"), column("uss_MB"), column("cpu_percent")
+        summary.update({
+            "max_RAM_MB": round(float(rss.max()), 2),
+            "avg_RAM_MB": round(float(rss.mean()), 2),
+            "max_USS_MB": round(float(uss.max()), 2),
+            "max_CPU_percent": round(float(cpu.max()), 2),
+            "avg_CPU_percent": round(float(cpu.mean()), 2),
+            "max_core_percent": round(max(max(s["per_core_percent"]) for s in samples), 2),
+        })
+        freq, temp = column("freq_MHz"), column("temp_C")
+        if freq.size:
+            summary["avg_freq_MHz"] = round(float(freq.mean()), 1)
+            summary["min_freq_MHz"] = round(float(freq.min()), 1)
+        if temp.size:
+            summary["max_temp_C"] = round(float(temp.max()), 1)
+        flags = [s["throttled"] for s in samples if s["throttled"] is not None]
+        if flags:
+            summary["throttled"] = bool(any(f & THROTTLE_NOW_MASK for f in flags))
+
+    if spans:
+        times = np.array([s["t"] for s in samples]) if samples else np.array([])
+        latencies = []
+        for t0, t1 in spans:
+            entry = {"t0": t0, "t1": t1, "ms": (t1 - t0) * 1000}
+            if times.size:
+                nearest = samples[min(int(np.searchsorted(times, t1)), times.size - 1)]
+                entry["temp_C"] = nearest["temp_C"]
+                entry["freq_MHz"] = nearest["freq_MHz"]
+            series["inferences"].append(entry)
+            latencies.append(entry["ms"])
+
+        # Thermal throttling shows up as later inferences getting slower
+        tenth = max(1, len(latencies) // 10)
+        first, last = np.mean(latencies[:tenth]), np.mean(latencies[-tenth:])
+        summary["latency_drift_percent"] = round(float((last - first) / first * 100), 2)
+
+    return summary, series
+
+
+if __name__ == "__main__":
+    sampler(int(sys.argv[1]), float(sys.argv[2]))
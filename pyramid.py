@@ -0,0 +1,162 @@
+"""
+Cached image pyramid for the labeler: a screen-sized preview plus JPEG
+tiles of the full-resolution image at power-of-two scales.
+
+    pyramid = ImagePyramid(IMAGES_DIR, os.path.join(UPLOAD_DIR, "pyramid"))
+    pyramid.info("img.jpeg")           # sizes, tile size, number of tile levels
+    pyramid.preview("img.jpeg")        # path of the preview JPEG
+    pyramid.tile("img.jpeg", 0, 3, 2)  # path of tile (x=3, y=2) at full resolution
+
+Level L is the image downscaled by 2**L, cut into TILE_SIZE squares; only
+the levels sharper than the preview are kept. A level is decoded and cut
+on its first tile request (JPEG draft mode decodes the coarse levels at
+reduced size), so opening an image costs one small preview, and zooming
+in costs the level actually viewed. Files are rebuilt when the source
+image changes (mtime), and drop() removes them with the image.
+"""
+import os
+import json
+import math
+import shutil
+import threading
+from PIL import Image, ImageOps
+
+TILE_SIZE = 512
+PREVIEW_MAX = 1600   # longest side of the preview, px
+JPEG_QUALITY = 85
+
+
+class ImagePyramid:
+    """Thread-safe; one build at a time per image."""
+
+    def __init__(self, images_dir, cache_dir, restore=None):
+        self.images_dir = images_dir
+        self.cache_dir = cache_dir
+        self.restore = restore   # brings an archived original back first (retention.py)
+        self.lock = threading.Lock()
+        self.image_locks = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def source(self, name):
+        """Path of the image, or None for unknown names (no paths outside images_dir)."""
+        if not name or os.path.basename(name) != name:
+            return None
+        path = os.path.join(self.images_dir, name)
+        if not os.path.isfile(path):
+            return None
+        if self.restore is not None:
+            self.restore(name)
+        return path
+
+    def _dir(self, name):
+        return os.path.join(self.cache_dir, os.path.splitext(name)[0])
+
+    def _lock(self, name):
+        with self.lock:
+            return self.image_locks.setdefault(name, threading.Lock())
+
+    def _open(self, src, size=None):
+        """Decoded RGB image, upright (EXIF orientation applied like the browser does)."""
+        img = Image.open(src)
+        if size is not None:
+            # JPEG: decode at 1/2, 1/4 or 1/8 scale when that still covers `size`
+            img.draft("RGB", size)
+        img = ImageOps.exif_transpose(img)
+        return img.convert("RGB")
+
+    def info(self, name):
+        """Sizes and tile layout of an image (cached next to its tiles), or None."""
+        src = self.source(name)
+        if src is None:
+            return None
+        with self._lock(name):
+            return self._info(name, src)
+
+    def _info(self, name, src):
+        d = self._dir(name)
+        info_path = os.path.join(d, "info.json")
+        mtime = os.stat(src).st_mtime_ns
+        try:
+            with open(info_path) as f:
+                info = json.load(f)
+            if info["mtime_ns"] == mtime:
+                return info
+        except (OSError, ValueError, KeyError):
+            pass
+
+        # New or replaced image: start over
+        shutil.rmtree(d, ignore_errors=True)
+        os.makedirs(d)
+        with Image.open(src) as img:
+            width, height = img.size
+            if img.getexif().get(0x0112) in (5, 6, 7, 8):   # rotated by 90 degrees
+                width, height = height, width
+
+        longest = max(width, height)
+        levels = max(0, math.ceil(math.log2(longest / PREVIEW_MAX))) if longest > PREVIEW_MAX else 0
+        scale = min(1., PREVIEW_MAX / longest)
+        preview_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+
+        img = self._open(src, preview_size)
+        if img.size != preview_size:
+            img = img.resize(preview_size, Image.LANCZOS)
+        img.save(os.path.join(d, "preview.jpg"), quality=JPEG_QUALITY)
+
+        info = {
+            "mtime_ns": mtime,
+            "width": width,
+            "height": height,
+            "preview_width": preview_size[0],
+            "preview_height": preview_size[1],
+            "tile_size": TILE_SIZE,
+            "levels": levels,
+        }
+        tmp = info_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(info, f)
+        os.replace(tmp, info_path)
+        return info
+
+    def preview(self, name):
+        """Path of the preview JPEG, or None for unknown images."""
+        if self.info(name) is None:
+            return None
+        return os.path.join(self._dir(name), "preview.jpg")
+
+    def tile(self, name, level, x, y):
+        """Path of one tile, or None when the image or the tile does not exist."""
+        src = self.source(name)
+        if src is None:
+            return None
+        with self._lock(name):
+            info = self._info(name, src)
+            if not 0 <= level < info["levels"]:
+                return None
+            level_w = math.ceil(info["width"] / 2 ** level)
+            level_h = math.ceil(info["height"] / 2 ** level)
+            if not (0 <= x < math.ceil(level_w / TILE_SIZE) and 0 <= y < math.ceil(level_h / TILE_SIZE)):
+                return None
+
+            level_dir = os.path.join(self._dir(name), str(level))
+            if not os.path.exists(os.path.join(level_dir, "done")):
+                self._cut_level(src, level_dir, (level_w, level_h))
+            return os.path.join(level_dir, f"{x}_{y}.jpg")
+
+    def _cut_level(self, src, level_dir, size):
+        os.makedirs(level_dir, exist_ok=True)
+        img = self._open(src, size)
+        if img.size != size:
+            img = img.resize(size, Image.LANCZOS)
+        for ty in range(0, size[1], TILE_SIZE):
+            for tx in range(0, size[0], TILE_SIZE):
+                box = (tx, ty, min(tx + TILE_SIZE, size[0]), min(ty + TILE_SIZE, size[1]))
+                img.crop(box).save(os.path.join(level_dir, f"{tx // TILE_SIZE}_{ty // TILE_SIZE}.jpg"),
+                                   quality=JPEG_QUALITY)
+        open(os.path.join(level_dir, "done"), "w").close()
+
+    def drop(self, name):
+        """Remove the cached files of an image (deleted images)."""
+        with self._lock(name):
+            shutil.rmtree(self._dir(name), ignore_errors=True)
+        with self.lock:
+            self.image_locks.pop(name, None)
@@ -0,0 +1,190 @@
+"""
+SQLite store for benchmark results.
+
+Every finished experiment is written (and committed) as soon as the worker
+reports it, keyed by run id, device, model/precision/format/imgsz and repeat, so
+an interrupted matrix can be resumed by re-running with the same run id.
+Each run also keeps the environment fingerprint of every device, so runs
+used as regression baselines can be told apart.
+"""
+import json
+import sqlite3
+import threading
+
+DEFAULT_STORE = "benchmark_results.sqlite"
+
+# Bumped whenever a table changes; older stores are migrated on open
+SCHEMA_VERSION = 2
+
+TABLES = {
+    "results": """
+        CREATE TABLE IF NOT EXISTS results (
+            run_id TEXT NOT NULL,
+            device TEXT NOT NULL,
+            model TEXT NOT NULL,
+            precision TEXT NOT NULL,
+            format TEXT NOT NULL,
+            imgsz INTEGER NOT NULL DEFAULT 640,
+            repeat INTEGER NOT NULL DEFAULT 0,
+            started REAL,
+            finished REAL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (run_id, device, model, precision, format, imgsz, repeat)
+        )
+    """,
+    "accuracy": """
+        CREATE TABLE IF NOT EXISTS accuracy (
+            run_id TEXT NOT NULL,
+            device TEXT NOT NULL,
+            model TEXT NOT NULL,
+            precision TEXT NOT NULL,
+            format TEXT NOT NULL,
+            imgsz INTEGER NOT NULL DEFAULT 640,
+            map50 REAL,
+            map50_95 REAL,
+            PRIMARY KEY (run_id, device, model, precision, format, imgsz)
+        )
+    """,
+    "baselines": """
+        CREATE TABLE IF NOT EXISTS baselines (
+            run_id TEXT NOT NULL,
+            device TEXT NOT NULL,
+            started REAL,
+            finished REAL,
+            PRIMARY KEY (run_id, device)
+        )
+    """,
+    "environments": """
+        CREATE TABLE IF NOT EXISTS environments (
+            run_id TEXT NOT NULL,
+            device TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            PRIMARY KEY (run_id, device)
+        )
+    """,
+}
+
+# Tables whose layout changed since the first release: results gained repeat
+# (version 1) and imgsz (version 2, which also added accuracy)
+MIGRATED_TABLES = ("results", "accuracy")
+
+
+class ResultStore:
+    """Thread-safe wrapper around one SQLite connection (one writer per device thread)."""
+
+    def __init__(self, path=DEFAULT_STORE):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN")
+            if self.conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                self._migrate()
+            for create in TABLES.values():
+                self.conn.execute(create)
+
+    def _migrate(self):
+        """
+        Bring a store written by an older version to SCHEMA_VERSION: the
+        tables of MIGRATED_TABLES are recreated and their rows copied, columns
+        they lacked taking their defaults (imgsz 640, repeat 0).
+        """
+        for table in MIGRATED_TABLES:
+            columns = [r["name"] for r in self.conn.execute(f"PRAGMA table_info({table})")]
+            if not columns:
+                continue
+            self.conn.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+            self.conn.execute(TABLES[table])
+            kept = ", ".join(columns)
+            self.conn.execute(f"INSERT OR REPLACE INTO {table} ({kept}) SELECT {kept} FROM {table}_old")
+            self.conn.execute(f"DROP TABLE {table}_old")
+        self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def add_result(self, run_id, device, experiment, started, finished, data):
+        """experiment: (model, precision, format, imgsz, repeat)"""
+        mod, prec, form, imgsz, repeat = experiment
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (run_id, device, mod, prec, form, imgsz, repeat, started, finished, json.dumps(data)),
+            )
+
+    def add_accuracy(self, run_id, device, combo, map50, map50_95):
+        """combo: (model, precision, format, imgsz)"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO accuracy VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (run_id, device, *combo, map50, map50_95),
+            )
+
+    def accuracy(self, run_id, device):
+        """{(model, precision, format, imgsz): (mAP50, mAP50-95)} for this run/device."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM accuracy WHERE run_id = ? AND device = ?", (run_id, device),
+            ).fetchall()
+        return {(r["model"], r["precision"], r["format"], r["imgsz"]): (r["map50"], r["map50_95"]) for r in rows}
+
+    def add_environment(self, run_id, device, fingerprint):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO environments VALUES (?, ?, ?)",
+                (run_id, device, json.dumps(fingerprint)),
+            )
+
+    def environment(self, run_id, device):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT fingerprint FROM environments WHERE run_id = ? AND device = ?",
+                (run_id, device),
+            ).fetchone()
+        return json.loads(row["fingerprint"]) if row else None
+
+    def add_baseline(self, run_id, device, started, finished):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO baselines VALUES (?, ?, ?, ?)",
+                (run_id, device, started, finished),
+            )
+
+    def baseline(self, run_id, device):
+        """(started, finished) of the device's idle window, or None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT started, finished FROM baselines WHERE run_id = ? AND device = ?",
+                (run_id, device),
+            ).fetchone()
+        return (row["started"], row["finished"]) if row else None
+
+    def done(self, run_id, device):
+        """Set of (model, precision, format, imgsz, repeat) already finished for this run/device."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT model, precision, format, imgsz, repeat FROM results WHERE run_id = ? AND device = ?",
+                (run_id, device),
+            ).fetchall()
+        return {(r["model"], r["precision"], r["format"], r["imgsz"], r["repeat"]) for r in rows}
+
+    def results(self, run_id, device=None):
+        """Finished experiments as dicts (result fields flattened), in completion order."""
+        query = "SELECT * FROM results WHERE run_id = ?"
+        params = [run_id]
+        if device is not None:
+            query += " AND device = ?"
+            params.append(device)
+        with self.lock:
+            rows = self.conn.execute(query + " ORDER BY finished", params).fetchall()
+
+        out = []
+        for r in rows:
+            entry = dict(r)
+            entry.update(json.loads(entry.pop("data")))
+            out.append(entry)
+        return out
+
+    def runs(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT run_id, COUNT(*) AS n, MIN(started) AS started FROM results GROUP BY run_id ORDER BY started"
+            ).fetchall()
+        return [dict(r) for r in rows]
@@ -0,0 +1,304 @@
+"""
+Storage tiering for the uploads: old originals leave the SD card, the
+gallery keeps working on thumbnails, and the labeler gets the original back
+when it opens an image.
+
+    retention = Retention(UPLOAD_ROOT, ARCHIVE_DIR)
+    retention.run()                # apply the policy once; returns a summary
+    retention.restore("img.jpeg")  # original back in images/ if archived
+
+Policy, by the capture time in the filename (filenames.py; mtime as fallback):
+
+- unlabeled images older than REENCODE_AFTER_DAYS are re-encoded in place
+  at REENCODE_QUALITY (EXIF kept); this is lossy and not undone
+- labeled images older than ARCHIVE_AFTER_DAYS are archived: the original
+  is appended to a per-month zip bundle in the archive directory and the
+  file in images/ is replaced by a THUMB_SIZE thumbnail with the same name
+  and EXIF, so listing, gallery tiles and metadata are unchanged
+- while the uploads disk is above HIGH_WATER usage, unlabeled images (any
+  age) are re-encoded and then any images archived, oldest first, until it
+  is below LOW_WATER
+
+Labels and jsons are never touched. Images hardlinked into the training
+set (dataset.py) are not archived: the link keeps their blocks in use.
+Archiving only frees space when the archive directory is on another disk
+(ANTPI_ARCHIVE_DIR, e.g. a USB drive), so nothing is archived while it is
+on the uploads disk (the default) and only re-encoding applies. The state
+of every image lives in retention.sqlite next to the uploads (WAL, shared
+by both servers), and a restore, archive or overwrite holds its write
+lock, so the two servers never interleave on one image.
+"""
+import os
+import io
+import time
+import shutil
+import sqlite3
+import zipfile
+import argparse
+import datetime
+import threading
+from PIL import Image
+from filenames import capture_time
+
+REENCODE_AFTER_DAYS = 14
+REENCODE_QUALITY = 60
+ARCHIVE_AFTER_DAYS = 60
+RESTORED_KEEP_DAYS = 7     # a restored original stays hot this long before re-archiving
+THUMB_SIZE = 640           # longest side of the thumbnail left in images/
+THUMB_QUALITY = 80
+
+HIGH_WATER = 0.85          # fraction of the uploads disk in use
+LOW_WATER = 0.75
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg")
+DAY = 86400
+
+
+def disk_usage(path):
+    usage = shutil.disk_usage(path)
+    return usage.used / usage.total
+
+
+def reencode(src, dst, quality, size=None):
+    """Write src as a JPEG at `quality` (optionally shrunk to `size` px), keeping EXIF and mtime."""
+    with Image.open(src) as img:
+        exif = img.info.get("exif", b"")
+        out = img.convert("RGB")
+        if size is not None:
+            out.thumbnail((size, size))
+        buf = io.BytesIO()
+        out.save(buf, format="JPEG", quality=quality, exif=exif)
+    stat = os.stat(src)
+    tmp = dst + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(buf.getvalue())
+    os.utime(tmp, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(tmp, dst)
+
+
+class Retention:
+    """Retention policy and archive index of one upload root."""
+
+    def __init__(self, upload_root, archive_dir, now=time.time):
+        self.images_dir = os.path.join(upload_root, "images")
+        self.jsons_dir = os.path.join(upload_root, "jsons")
+        self.archive_dir = archive_dir
+        self.now = now
+        os.makedirs(archive_dir, exist_ok=True)
+        # isolation_level=None: transactions are explicit (BEGIN IMMEDIATE below)
+        self.conn = sqlite3.connect(os.path.join(upload_root, "retention.sqlite"), check_same_thread=False,
+                                    timeout=30, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS images (
+                    filename TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,        -- reencoded | archived | restored
+                    bundle TEXT,
+                    member TEXT,
+                    ts REAL NOT NULL
+                )
+            """)
+
+    def _row(self, filename):
+        return self.conn.execute("SELECT * FROM images WHERE filename = ?", (filename,)).fetchone()
+
+    def _set(self, filename, state, bundle=None, member=None):
+        self.conn.execute("INSERT OR REPLACE INTO images (filename, state, bundle, member, ts) VALUES (?, ?, ?, ?, ?)",
+                          (filename, state, bundle, member, self.now()))
+
+    def is_labeled(self, filename):
+        """Same rule as the gallery: a non-empty jsons/<stem>.json."""
+        jpath = os.path.join(self.jsons_dir, os.path.splitext(filename)[0] + ".json")
+        return os.path.exists(jpath) and os.path.getsize(jpath) > 0
+
+    def count(self, state):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM images WHERE state = ?", (state,)).fetchone()[0]
+
+    def archived(self, filename):
+        """(bundle path, member name) of an archived original, or None."""
+        with self.lock:
+            row = self._row(filename)
+        if row is None or row["state"] != "archived":
+            return None
+        return os.path.join(self.archive_dir, row["bundle"]), row["member"]
+
+    def read_original(self, filename):
+        """Bytes of an archived original without restoring it (dataset zip), or None."""
+        where = self.archived(filename)
+        if where is None:
+            return None
+        with zipfile.ZipFile(where[0]) as zf:
+            return zf.read(where[1])
+
+    def restore(self, filename):
+        """Put an archived original back in images/; returns True if it was archived."""
+        if self.archived(filename) is None:   # common case: no write lock
+            return False
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._row(filename)
+                if row is None or row["state"] != "archived":
+                    self.conn.execute("COMMIT")
+                    return False
+                path = os.path.join(self.images_dir, filename)
+                stat = os.stat(path)
+                tmp = path + ".tmp"
+                with zipfile.ZipFile(os.path.join(self.archive_dir, row["bundle"])) as zf, \
+                        zf.open(row["member"]) as src, open(tmp, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                os.utime(tmp, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+                os.replace(tmp, path)
+                # The bundle keeps its copy: archiving it again only swaps the thumbnail back in
+                self._set(filename, "restored", row["bundle"], row["member"])
+                self.conn.execute("COMMIT")
+                return True
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def replace(self, filename, write):
+        """
+        Overwrite an image with write() (a new upload under the same name)
+        and drop its index entry in the same transaction, so an archived
+        copy of the old file is never restored or served in its place.
+        """
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                write()
+                self.conn.execute("DELETE FROM images WHERE filename = ?", (filename,))
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def forget(self, filename):
+        """Drop the index entry of a deleted image (its bundle copy stays until the bundle is removed)."""
+        with self.lock:
+            self.conn.execute("DELETE FROM images WHERE filename = ?", (filename,))
+
+    @property
+    def archive_frees(self):
+        """Whether archiving frees space: the archive is on another disk than the images."""
+        return os.stat(self.archive_dir).st_dev != os.stat(self.images_dir).st_dev
+
+    def archive(self, filename):
+        """
+        Archive one image now, whatever its age (near-duplicates at ingest);
+        returns False, leaving it in place, when archive_frees is false.
+        """
+        if not self.archive_frees:
+            return False
+        self._archive(filename, os.path.join(self.images_dir, filename))
+        return True
+
+    def _archive(self, filename, path):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._row(filename)
+                stat = os.stat(path)
+                member = f"{filename}@{stat.st_mtime_ns}"
+                if row is not None and row["state"] == "restored" and row["member"] == member:
+                    bundle = row["bundle"]   # unchanged since the restore: already in its bundle
+                else:
+                    bundle = datetime.datetime.fromtimestamp(capture_time(filename, path)).strftime("%Y-%m") + ".zip"
+                    # JPEGs barely deflate: stored, so members can be read back without inflating
+                    with zipfile.ZipFile(os.path.join(self.archive_dir, bundle), "a",
+                                         compression=zipfile.ZIP_STORED) as zf:
+                        zf.write(path, member)
+                reencode(path, path, THUMB_QUALITY, THUMB_SIZE)
+                self._set(filename, "archived", bundle, member)
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def _reencode(self, filename, path):
+        with self.lock:
+            reencode(path, path, REENCODE_QUALITY)
+            self._set(filename, "reencoded")
+
+    def candidates(self):
+        """Images that may still be tiered: (capture time, filename, path, state or None), oldest first."""
+        with self.lock:
+            states = {r["filename"]: (r["state"], r["ts"]) for r in self.conn.execute("SELECT filename, state, ts FROM images")}
+        out = []
+        for f in os.listdir(self.images_dir):
+            if not f.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            path = os.path.join(self.images_dir, f)
+            state, ts = states.get(f, (None, 0))
+            if state == "archived" or (state == "restored" and self.now() - ts < RESTORED_KEEP_DAYS * DAY):
+                continue
+            out.append((capture_time(f, path), f, path, state))
+        return sorted(out)
+
+    def run(self, dry_run=False):
+        """Apply the policy once (see module docstring); returns what was (or would be) done."""
+        done = {"reencoded": [], "archived": []}
+        now = self.now()
+        # Archiving frees nothing when the bundles end up on the same disk
+        archive_frees = self.archive_frees
+
+        def apply(action, filename, path):
+            if not dry_run:
+                try:
+                    (self._reencode if action == "reencoded" else self._archive)(filename, path)
+                except (OSError, zipfile.BadZipFile) as e:
+                    print(f"[retention] {action} {filename} failed: {e}")
+                    return
+            done[action].append(filename)
+
+        def eligible(filename, path, state, action):
+            if action == "reencoded":
+                return state is None and not self.is_labeled(filename)
+            return os.stat(path).st_nlink == 1   # not pinned by the training set
+
+        remaining = []
+        for ts, filename, path, state in self.candidates():
+            age_days = (now - ts) / DAY
+            if age_days > REENCODE_AFTER_DAYS and eligible(filename, path, state, "reencoded"):
+                apply("reencoded", filename, path)
+            elif archive_frees and age_days > ARCHIVE_AFTER_DAYS and self.is_labeled(filename) \
+                    and eligible(filename, path, state, "archived"):
+                apply("archived", filename, path)
+            else:
+                remaining.append((filename, path, state))
+
+        # High-water mark: shrink the oldest first until below LOW_WATER
+        usage = disk_usage(self.images_dir)
+        if usage > HIGH_WATER and not dry_run:
+            for action in ("reencoded", "archived"):
+                if action == "archived" and not archive_frees:
+                    print("[retention] archive directory is on the uploads disk: archiving cannot free space")
+                    break
+                for filename, path, state in remaining:
+                    if disk_usage(self.images_dir) <= LOW_WATER:
+                        break
+                    if filename not in done[action] and eligible(filename, path, state, action):
+                        apply(action, filename, path)
+
+        return {
+            "reencoded": len(done["reencoded"]),
+            "archived": len(done["archived"]),
+            "disk_usage_before": round(usage, 4),
+            "disk_usage": round(disk_usage(self.images_dir), 4),
+            "dry_run": dry_run,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply the uploads retention policy once")
+    parser.add_argument("--root", default=os.path.join("static", "uploads"), help="upload root")
+    parser.add_argument("--archive", help="archive directory (default: <root>/archive)")
+    parser.add_argument("--dry-run", action="store_true", help="only report what the age rules would do")
+    args = parser.parse_args()
+
+    retention = Retention(args.root, args.archive or os.path.join(args.root, "archive"))
+    print(retention.run(dry_run=args.dry_run))
@@ -1,13 +1,19 @@
 import os
 from ultralytics import YOLO
 import pandas as pd
-from memory_profiler import memory_usage
-import psutil
 import time
 import json
 import threading
+import queue
+import multiprocessing as mp
 import shutil
 import gc
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import numpy as np
+import cv2
+from profiler import ResourceProfiler, summarize
 
 
 def safe_remove(path):
@@ -31,186 +37,676 @@ def safe_rename(src, dst):
         print(f"Failed to rename {src} to {dst}: {e}")
 
 
-def convert2desired(m_path, d_path, format, type="FP32"):
+# INT8 calibration: a fixed-seed subset of the val split, preprocessed once
+# per imgsz and subset size (0 = whole split)
+CALIBRATION_IMAGES = 300
+CALIBRATION_DIR = os.path.join("src", "calibration")
+
+
+def letterbox(frame, imgsz):
+    """Resize keeping the aspect ratio and pad to imgsz x imgsz (gray 114 border, as Ultralytics)."""
+    h, w = frame.shape[:2]
+    r = imgsz / max(h, w)
+    nh, nw = round(h * r), round(w * r)
+    frame = cv2.resize(frame, (nw, nh), interpolation=cv2.INTER_LINEAR)
+    top, left = (imgsz - nh) // 2, (imgsz - nw) // 2
+    return cv2.copyMakeBorder(frame, top, imgsz - nh - top, left, imgsz - nw - left,
+                              cv2.BORDER_CONSTANT, value=(114, 114, 114))
+
+
+def calibration_images(d_path, imgsz=640, n=CALIBRATION_IMAGES):
+    """
+    Calibration tensor (N, 3, imgsz, imgsz), letterboxed RGB uint8, as a
+    memory-mapped .npy in CALIBRATION_DIR. Built once and reused by every
+    INT8 export until an image of the split changes.
+    """
+    from ultralytics.data.utils import check_det_dataset
+    val_dir = check_det_dataset(d_path)["val"]
+    paths = sorted(os.path.join(val_dir, f) for f in os.listdir(val_dir)
+                   if f.lower().endswith((".jpg", ".jpeg", ".png")))
+    if n and n < len(paths):
+        pick = np.random.default_rng(0).choice(len(paths), n, replace=False)
+        paths = [paths[i] for i in sorted(pick)]
+
+    key = hashlib.sha256("\n".join(os.path.basename(p) for p in paths).encode()).hexdigest()[:16]
+    cache_path = os.path.join(CALIBRATION_DIR, f"calib_{imgsz}_{len(paths)}_{key}.npy")
+    newest = max(os.path.getmtime(p) for p in paths)
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) > newest:
+        return np.load(cache_path, mmap_mode="r")
+
+    start = time.time()
+    os.makedirs(CALIBRATION_DIR, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    calib = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8,
+                                      shape=(len(paths), 3, imgsz, imgsz))
+    for i, p in enumerate(paths):
+        calib[i] = letterbox(cv2.imread(p), imgsz)[:, :, ::-1].transpose(2, 0, 1)
+    calib.flush()
+    del calib
+    # Parallel conversions may build the same file: never expose a partial one
+    os.replace(tmp_path, cache_path)
+    print(f"Calibration set {cache_path}: {len(paths)} images in {time.time() - start:.1f} s")
+    return np.load(cache_path, mmap_mode="r")
+
+
+def quantize_openvino(m_path, d_path, batch=1, imgsz=640, calib=CALIBRATION_IMAGES):
+    """
+    INT8 OpenVINO export fed from calibration_images(): FP32 IR export, then
+    NNCF post-training quantization with Ultralytics' settings (mixed
+    preset, box decoding of the detection head kept in float).
+    """
+    import nncf
+    import openvino as ov
+
+    model = YOLO(m_path)
+    fp32_dir = model.export(format="openvino", batch=batch, imgsz=imgsz, task="detect")
+    head = ".".join(list(model.model.named_modules())[-1][0].split(".")[:2])
+
+    data = calibration_images(d_path, imgsz, calib)
+    items = [data[i:i + batch] for i in range(0, len(data) - batch + 1, batch)]
+    stem = os.path.splitext(os.path.basename(m_path))[0]
+
+    start = time.time()
+    quantized = nncf.quantize(
+        ov.Core().read_model(os.path.join(fp32_dir, stem + ".xml")),
+        nncf.Dataset(items, lambda x: x.astype(np.float32) / 255.0),
+        subset_size=len(items),
+        preset=nncf.QuantizationPreset.MIXED,
+        ignored_scope=nncf.IgnoredScope(
+            patterns=[f".*{head}/.*/Add", f".*{head}/.*/Sub*", f".*{head}/.*/Mul*",
+                      f".*{head}/.*/Div*", f".*{head}\\.dfl.*"],
+            types=["Sigmoid"],
+        ),
+    )
+    print(f"Quantized with {len(items)} calibration batches in {time.time() - start:.1f} s")
+
+    out_dir = os.path.join(os.path.dirname(m_path), exported_name("INT8", "openvino"))
+    os.makedirs(out_dir, exist_ok=True)
+    ov.save_model(quantized, os.path.join(out_dir, stem + ".xml"), compress_to_fp16=False)
+    shutil.copy2(os.path.join(fp32_dir, "metadata.yaml"), out_dir)
+
+
+def convert2desired(m_path, d_path, format, type="FP32", batch=1, imgsz=640, calib=CALIBRATION_IMAGES):
+    if type == "INT8" and format == "openvino":
+        # Calibrated from the shared cache; MNN's INT8 is weight-only (no calibration data)
+        quantize_openvino(m_path, d_path, batch, imgsz, calib)
+        return
+
     model = YOLO(m_path)
     if type == "FP32":
-        model.export(format=format, data=d_path, batch=1, task="detect")
+        model.export(format=format, data=d_path, batch=batch, imgsz=imgsz, task="detect")
     elif type == "FP16":
-        model.export(format=format, data=d_path, half=True, batch=1, task="detect")
+        model.export(format=format, data=d_path, half=True, batch=batch, imgsz=imgsz, task="detect")
     else:
-        model.export(format=format, data=d_path, int8=True, batch=1, task="detect")
+        model.export(format=format, data=d_path, int8=True, batch=batch, imgsz=imgsz, task="detect")
     return
 
 
-def profile_function(func, *args, **kwargs):
-    """Profiles memory and CPU usage of a function execution."""
-    cpu_usage = []
-    stop_event = threading.Event()
+# Suffix Ultralytics uses to pick the backend when loading an exported model
+FORMAT_SUFFIX = {
+    "openvino": "_openvino_model",
+    "tflite": "_saved_model",
+    "mnn": ".mnn",
+    "ncnn": "_ncnn_model",
+}
 
-    def monitor_cpu():
-        while not stop_event.is_set():
-            cpu_usage.append(psutil.cpu_percent(interval=0.1))
 
-    cpu_thread = threading.Thread(target=monitor_cpu)
-    cpu_thread.start()
+def weights_hash(path):
+    """Short content hash of a weights file (conversion cache key)."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()[:16]
 
-    # Force garbage collection before measurement
-    gc.collect()
 
-    result = None
+def artifact_path(mod, prec, form, batch=1, imgsz=640, calib=CALIBRATION_IMAGES):
+    """
+    Where the converted model lives: models/<mod>/weights/cache/, keyed by
+    weights hash, precision (with the calibration subset size for
+    calibrated INT8), imgsz and batch, and ending with the format suffix so
+    Ultralytics loads it in place (no copy to best_*_model).
+    """
+    weights_dir = os.path.join("models", mod, "weights")
+    if form == "pytorch":
+        return os.path.join(weights_dir, "best.pt")
+    key = weights_hash(os.path.join(weights_dir, "best.pt"))
+    if prec == "INT8" and form == "openvino":
+        prec = f"INT8c{calib}"
+    return os.path.join(weights_dir, "cache", f"{mod}_{prec}_{imgsz}_b{batch}_{key}{FORMAT_SUFFIX[form]}")
 
-    # Define a wrapper to capture the function result
-    def wrapper():
-        nonlocal result
-        result = func(*args, **kwargs)
 
-    # Measure memory while running the function
-    mem_usage = memory_usage(wrapper)
+def exported_name(prec, form):
+    """What model.export() writes next to best.pt."""
+    if form == "openvino":
+        return "best_int8_openvino_model" if prec == "INT8" else "best_openvino_model"
+    if form == "tflite":
+        return "best_saved_model"
+    if form == "mnn":
+        return "best.mnn"
+    return "best_ncnn_model"
+
+
+def latency_stats(values, prefix):
+    """Median, tail percentiles and max of a list of milliseconds, as flat result keys."""
+    arr = np.asarray(values, dtype=float)
+    if arr.size == 0:
+        return {}
+    p50, p95, p99 = np.percentile(arr, [50, 95, 99])
+    return {
+        f"{prefix}_p50": round(float(p50), 4),
+        f"{prefix}_p95": round(float(p95), 4),
+        f"{prefix}_p99": round(float(p99), 4),
+        f"{prefix}_max": round(float(arr.max()), 4),
+    }
+
 
-    # Stop CPU monitoring thread
-    stop_event.set()
-    cpu_thread.join()
+def profile_function(func, *args, **kwargs):
+    """
+    Runs func under the out-of-process ResourceProfiler (see profiler.py).
+
+    Returns:
+        (func result, list of resource samples)
+    """
+    # Force garbage collection before measurement
+    gc.collect()
+
+    with ResourceProfiler() as prof:
+        result = func(*args, **kwargs)
 
-    # Calculate statistics
-    avg_mem_usage = sum(mem_usage) / len(mem_usage)
-    max_mem_usage = max(mem_usage)
-    avg_cpu_usage = sum(cpu_usage) / len(cpu_usage) if cpu_usage else 0
-    max_cpu_usage = max(cpu_usage) if cpu_usage else 0
+    return result, prof.samples
 
-    return result, avg_mem_usage, max_mem_usage, avg_cpu_usage, max_cpu_usage
 
+def convert_model(mod, prec, form, batch=1, imgsz=640, calib=CALIBRATION_IMAGES):
+    """
+    Export one combination into the conversion cache, unless it is already
+    there. Each export runs in its own work directory next to a copy of
+    best.pt, so several conversions of the same model can run in parallel.
 
-def convert_model(mod, prec, form):
+    Returns:
+        the artifact path, or None if the combination is not converted.
+    """
     if prec == "INT8" and (form == "tflite" or form == "ncnn"):
         print("Not supported!!")
-        return
+        return None
 
     if form == "pytorch":
         print("PyTorch does not need conversion!!")
-        return
+        return None
 
-    path_test = os.path.join("src", "learning", "test", "images")
-    if os.path.exists(path_test):
-        ims_list = os.listdir(path_test)
-    else:
-        ims_list = []
+    target = artifact_path(mod, prec, form, batch, imgsz, calib)
+    if os.path.exists(target):
+        print(f"Cached: {target}")
+        return target
 
     yaml_path = os.path.join("src", "data.yaml")
-
     weights_dir = os.path.join("models", mod, "weights")
-    models_dir = os.path.join(weights_dir, "best.pt")
-    convert2desired(models_dir, yaml_path, form, prec)
 
-    safe_remove(os.path.join(weights_dir, "best.onnx"))
-    safe_remove(os.path.join(weights_dir, f"{mod}_{prec}_{form}"))
+    work_dir = target + ".tmp"
+    safe_remove(work_dir)
+    os.makedirs(work_dir)
+    try:
+        shutil.copy2(os.path.join(weights_dir, "best.pt"), os.path.join(work_dir, "best.pt"))
+        convert2desired(os.path.join(work_dir, "best.pt"), yaml_path, form, prec, batch, imgsz, calib)
+        # Renamed only once complete: an existing target is always a full export
+        safe_rename(os.path.join(work_dir, exported_name(prec, form)), target)
+    finally:
+        safe_remove(work_dir)
 
-    if form == "openvino":
-        if prec == "INT8":
-            safe_rename(
-                os.path.join(weights_dir, "best_int8_openvino_model"),
-                os.path.join(weights_dir, f"{mod}_{prec}_{form}")
-            )
-        else:
-            safe_rename(
-                os.path.join(weights_dir, "best_openvino_model"),
-                os.path.join(weights_dir, f"{mod}_{prec}_{form}")
-            )
-    elif form == "tflite":
-        safe_rename(
-            os.path.join(weights_dir, "best_saved_model"),
-            os.path.join(weights_dir, f"{mod}_{prec}_{form}")
-        )
-    elif form == "mnn":
-        safe_rename(
-            os.path.join(weights_dir, "best.mnn"),
-            os.path.join(weights_dir, f"{mod}_{prec}_{form}.mnn")
-        )
-    elif form == "ncnn":
-        safe_rename(
-            os.path.join(weights_dir, "best_ncnn_model"),
-            os.path.join(weights_dir, f"{mod}_{prec}_{form}")
-        )
+    return target if os.path.exists(target) else None
 
 
-def run_test(mod, prec, form):
+def unsupported_reason(mod, prec, form):
+    """Why a model/precision/format combination cannot be tested, or None."""
     if prec == "INT8" and (form == "tflite" or form == "ncnn"):
-        print("Not supported!!")
-        return
-
+        return "Not supported!!"
     if form == "pytorch" and prec != "FP32":
-        print("PyTorch only FP32!!")
-        return
-
+        return "PyTorch only FP32!!"
     if "10" in mod and form == "ncnn":
-        print("YOLOv10 and NCNN is not supported")
+        return "YOLOv10 and NCNN is not supported"
+    return None
+
+
+def decode(item):
+    """Decode one image path, or a list of them (a batch), to BGR arrays."""
+    if isinstance(item, list):
+        return [cv2.imread(p) for p in item]
+    return cv2.imread(item)
+
+
+def load_decoded_images(ims_paths, cache_path):
+    """
+    Decode the test set once, outside any timed region.
+
+    When all frames share a shape they are stored as a memory-mapped .npy
+    (with a .json listing the source files) and reused by later runs while
+    no image is newer; parallel workers then share one page-cached copy.
+    Mixed-shape sets are kept as a plain list in RAM.
+    """
+    names_path = cache_path + ".json"
+    names = [os.path.basename(p) for p in ims_paths]
+    newest = max(os.path.getmtime(p) for p in ims_paths)
+
+    if os.path.exists(cache_path) and os.path.exists(names_path) and os.path.getmtime(cache_path) > newest:
+        with open(names_path, "r") as f:
+            if json.load(f) == names:
+                frames = np.load(cache_path, mmap_mode="r")
+                for frame in frames:
+                    frame.max()  # fault the pages in now, not during the timed loop
+                return list(frames)
+
+    frames = [cv2.imread(p) for p in ims_paths]
+    if len({f.shape for f in frames}) != 1:
+        return frames
+
+    stacked = np.lib.format.open_memmap(cache_path, mode="w+", dtype=np.uint8,
+                                        shape=(len(frames),) + frames[0].shape)
+    for i, frame in enumerate(frames):
+        stacked[i] = frame
+    stacked.flush()
+    with open(names_path, "w") as f:
+        json.dump(names, f)
+    return list(stacked)
+
+
+def prefetch(items, depth=4):
+    """Yield decoded items while a background thread decodes the next `depth` ones."""
+    q = queue.Queue(maxsize=depth)
+
+    def producer():
+        for item in items:
+            q.put(decode(item))
+        q.put(None)
+
+    threading.Thread(target=producer, daemon=True).start()
+    while (frame := q.get()) is not None:
+        yield frame
+
+
+def run_test(mod, prec, form, warmup=3, batch=1, inputs="path", imgsz=640, limit=None,
+             calib=CALIBRATION_IMAGES):
+    """
+    Run the exported model over the test set; print the RESULTS json and
+    return the same dict (None if the combination cannot be tested).
+
+    - warmup: untimed calls before measuring (first-call graph compilation,
+      allocator and cache setup would otherwise skew the distribution)
+    - batch: images per call; >1 is the throughput mode and needs an artifact
+      exported with the same batch (convert_model(..., batch=batch))
+    - inputs: "path" reads and decodes each JPEG inside the timed loop (as in
+      deployment without overlap), "preload" decodes the whole set beforehand
+      to time pure inference, "prefetch" decodes on a background thread
+      overlapped with inference
+    - limit: only the first `limit` test images (quick screening runs)
+    - calib: calibration subset size of the INT8 OpenVINO artifact to load
+    """
+    reason = unsupported_reason(mod, prec, form)
+    if reason:
+        print(reason)
         return
 
     path_test = os.path.join("src", "learning", "test", "images")
-    ims_list = os.listdir(path_test)
+    ims_list = sorted(os.listdir(path_test))[:limit]
 
-    weights_directory = os.path.join("models", mod, "weights")
+    new_model = artifact_path(mod, prec, form, batch, imgsz, calib)
+    if not os.path.exists(new_model):
+        print(f"Not converted: {new_model}")
+        return
 
-    new_model = ""
+    exported_model = YOLO(new_model, task="detect")
 
-    if form == "pytorch":
-        models_directory = os.path.join(weights_directory, "best.pt")
-    elif form == "openvino":
-        models_directory = os.path.join(weights_directory, f"{mod}_{prec}_{form}")
-        if prec == "INT8":
-            new_model = os.path.join(weights_directory, "best_int8_openvino_model")
-        else:
-            new_model = os.path.join(weights_directory, "best_openvino_model")
-
-        safe_remove(new_model)
-        shutil.copytree(models_directory, new_model)
-    elif form == "tflite":
-        models_directory = os.path.join(weights_directory, f"{mod}_{prec}_{form}")
-        new_model = os.path.join(weights_directory, "best_saved_model")
-        safe_remove(new_model)
-        shutil.copytree(models_directory, new_model)
-    elif form == "mnn":
-        models_directory = os.path.join(weights_directory, f"{mod}_{prec}_{form}.mnn")
-    elif form == "ncnn":
-        models_directory = os.path.join(weights_directory, f"{mod}_{prec}_{form}")
-        new_model = os.path.join(weights_directory, "best_ncnn_model")
-        safe_remove(new_model)
-        shutil.copytree(models_directory, new_model)
-
-    if new_model == "":
-        new_model = models_directory
+    ims_paths = [os.path.join(path_test, im) for im in ims_list]
+    if inputs == "preload":
+        frames = load_decoded_images(ims_paths, os.path.join(path_test, os.pardir, "decoded_images.npy"))
+    else:
+        frames = ims_paths
 
-    exported_model = YOLO(new_model, task="detect")
+    if len(frames) < batch:
+        # Exported graphs have a static batch dimension: no partial batch to fall back on
+        print(f"Only {len(frames)} test images for batch {batch}: lower --batch or raise --limit")
+        return
+
+    if batch > 1:
+        # Exported graphs have a static batch dimension: drop the remainder
+        batches = [frames[i:i + batch] for i in range(0, len(frames) - batch + 1, batch)]
+    else:
+        batches = frames
+
+    for _ in range(warmup):
+        exported_model(batches[0], imgsz=imgsz, verbose=False)
+
+    call_times = []
+    spans = []
+    wall_times = []
+
+    def timed_loop():
+        out = []
+        wall_start = time.monotonic()
+        for b in (prefetch(batches) if inputs == "prefetch" else batches):
+            t0 = time.monotonic()
+            out.append(exported_model(b, imgsz=imgsz, verbose=False))
+            t1 = time.monotonic()
+            call_times.append((t1 - t0) * 1000)
+            spans.append((t0, t1))
+        wall_times.append(time.monotonic() - wall_start)
+        return out
 
     # Start profiling before the loop
-    results, avg_mem, max_mem, avg_cpu, max_cpu = profile_function(
-        lambda: [exported_model(os.path.join(path_test, im), imgsz=640) for im in ims_list]
-    )
+    results, samples = profile_function(timed_loop)
+    resources, series = summarize(samples, spans)
 
-    if form in ["openvino", "tflite"]:
-        safe_remove(new_model)
+    # Full time series for throttling/thermal analysis, next to the summary
+    os.makedirs("profiles", exist_ok=True)
+    series_path = os.path.join("profiles", f"{mod}_{prec}_{form}_{imgsz}_b{batch}_{inputs}.json")
+    with open(series_path, "w") as f:
+        json.dump(series, f)
 
-    # Extract timing statistics
-    speeds = [res[0].speed for res in results]  # Extracting `speed` from each result
+    # Extract timing statistics (Ultralytics reports per-image ms, also in batches)
+    speeds = [r.speed for res in results for r in res]
     total_preprocessing = sum(s["preprocess"] for s in speeds) / len(speeds)
     total_inference = sum(s["inference"] for s in speeds) / len(speeds)
     total_postprocessing = sum(s["postprocess"] for s in speeds) / len(speeds)
+    n_images = len(speeds)
 
     stats = {
-        "max_RAM_MB": round(max_mem, 2),
-        "avg_RAM_MB": round(avg_mem, 2),
-        "max_CPU_percent": round(max_cpu, 2),
-        "avg_CPU_percent": round(avg_cpu, 2),
+        "max_RAM_MB": resources.get("max_RAM_MB", 0),
+        "avg_RAM_MB": resources.get("avg_RAM_MB", 0),
+        "max_CPU_percent": resources.get("max_CPU_percent", 0),
+        "avg_CPU_percent": resources.get("avg_CPU_percent", 0),
         "pre_processing_ms": round(total_preprocessing, 4),
         "inference_ms": round(total_inference, 3),
         "post_processing_ms": round(total_postprocessing, 4),
+        "warmup": warmup,
+        "batch": batch,
+        "images": n_images,
+        "inputs": inputs,
+        # end-to-end, including any decode the model call did not overlap
+        "images_per_s": round(n_images / wall_times[0], 3),
     }
+    stats.update(latency_stats([s["preprocess"] for s in speeds], "pre_processing_ms"))
+    stats.update(latency_stats([s["inference"] for s in speeds], "inference_ms"))
+    stats.update(latency_stats([s["postprocess"] for s in speeds], "post_processing_ms"))
+    # wall-clock time of one model call (one image, or one batch in throughput mode)
+    stats.update(latency_stats(call_times, "call_ms"))
+    # USS, per-core peak, frequency, temperature, throttling, latency drift
+    stats.update({k: v for k, v in resources.items() if k not in stats})
+    stats["profile"] = series_path
+    stats["artifact"] = new_model
 
     print("RESULTS")
     print(json.dumps(stats, indent=4))
     print("RESULTS")
+    return stats
+
+
+def run_validation(mod, prec, form, imgsz=640, batch=1, calib=CALIBRATION_IMAGES):
+    """
+    Accuracy of the converted artifact on the test split of src/data.yaml;
+    print the RESULTS json and return it (None if it cannot be evaluated).
+    """
+    reason = unsupported_reason(mod, prec, form)
+    if reason:
+        print(reason)
+        return None
+
+    new_model = artifact_path(mod, prec, form, batch, imgsz, calib)
+    if not os.path.exists(new_model):
+        print(f"Not converted: {new_model}")
+        return None
+
+    exported_model = YOLO(new_model, task="detect")
+    metrics = exported_model.val(
+        data=os.path.join("src", "data.yaml"), split="test", imgsz=imgsz, batch=batch,
+        plots=False, verbose=False,
+    )
 
+    stats = {
+        "imgsz": imgsz,
+        "calib": calib if prec == "INT8" else None,
+        "mAP50": round(float(metrics.box.map50), 4),
+        "mAP50_95": round(float(metrics.box.map), 4),
+    }
 
-def convert_all():
+    print("RESULTS")
+    print(json.dumps(stats, indent=4))
+    print("RESULTS")
+    return stats
+
+
+# Environment knobs read by the inference backends when their thread pools
+# are created (PyTorch/OpenMP, TFLite/XNNPACK via TF, BLAS). OpenVINO and
+# NCNN ignore them: set_backend_threads() configures those two directly.
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "TF_NUM_INTRAOP_THREADS"]
+
+# Longest a sweep configuration may take, model loading included, before its
+# workers are given up on
+SWEEP_TIMEOUT_S = 1800
+
+
+def set_intra_op_threads(n):
+    """Limit per-instance intra-op threads; must run before the backend starts."""
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(n)
+    try:
+        import torch
+        torch.set_num_threads(n)
+    except ImportError:
+        pass
+
+
+def set_backend_threads(model, model_path, n):
+    """
+    Apply `n` intra-op threads to the backends that do not read
+    THREAD_ENV_VARS: NCNN through its net options, OpenVINO by recompiling
+    with INFERENCE_NUM_THREADS. The model must have run once (the backend is
+    created on the first call).
+    """
+    backend = model.predictor.model
+    path = str(model_path).rstrip("/")
+    if path.endswith(FORMAT_SUFFIX["ncnn"]):
+        # Extractors take the net's options when created, i.e. on every call
+        backend.net.opt.num_threads = n
+    elif path.endswith(FORMAT_SUFFIX["openvino"]):
+        import openvino as ov
+        core = ov.Core()
+        xml = next(f for f in os.listdir(path) if f.endswith(".xml"))
+        backend.ov_compiled_model = core.compile_model(
+            core.read_model(os.path.join(path, xml)), device_name="CPU",
+            config={"PERFORMANCE_HINT": "LATENCY", "INFERENCE_NUM_THREADS": n},
+        )
+
+
+def get_from_alive(q, producers, timeout=SWEEP_TIMEOUT_S):
+    """
+    q.get() that gives up with RuntimeError once every producer (thread or
+    process) has exited without a result, or after `timeout` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return q.get(timeout=1)
+        except queue.Empty:
+            pass
+        if not any(p.is_alive() for p in producers):
+            # A put made just before exiting may still be in flight
+            try:
+                return q.get(timeout=1)
+            except queue.Empty:
+                raise RuntimeError("workers exited without a result")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"no result within {timeout} s")
+
+
+def concurrency_worker(model_path, image_paths, warmup, start_barrier, out_queue, imgsz=640, threads=None):
+    """One model instance processing its shard of the test set (thread or process)."""
+    model = YOLO(model_path, task="detect")
+    model(image_paths[0], imgsz=imgsz, verbose=False)  # creates the backend
+    if threads:
+        set_backend_threads(model, model_path, threads)
+    for _ in range(warmup):
+        model(image_paths[0], imgsz=imgsz, verbose=False)
+
+    start_barrier.wait(timeout=SWEEP_TIMEOUT_S)
+    latencies = []
+    for im in image_paths:
+        t0 = time.perf_counter()
+        model(im, imgsz=imgsz, verbose=False)
+        latencies.append((time.perf_counter() - t0) * 1000)
+    out_queue.put(latencies)
+
+
+def run_concurrency_config(model_path, image_paths, mode, workers, threads, warmup, result_queue, imgsz=640):
+    """
+    Run one (mode, workers, threads) configuration in a fresh process, so
+    thread settings apply before any backend is initialized, and profile the
+    whole process tree while the workers run. A worker that dies or hangs
+    makes this process exit without a result.
+    """
+    set_intra_op_threads(threads)
+    # No more workers than images: an empty shard has nothing to warm up on
+    workers = min(workers, len(image_paths))
+    shards = [image_paths[i::workers] for i in range(workers)]
+
+    if mode == "process":
+        ctx = mp.get_context("spawn")
+        start_barrier = ctx.Barrier(workers + 1)
+        out_queue = ctx.Queue()
+        runners = [ctx.Process(target=concurrency_worker, daemon=True,
+                               args=(model_path, shard, warmup, start_barrier, out_queue, imgsz, threads))
+                   for shard in shards]
+    else:
+        start_barrier = threading.Barrier(workers + 1)
+        out_queue = queue.Queue()
+        runners = [threading.Thread(target=concurrency_worker, daemon=True,
+                                    args=(model_path, shard, warmup, start_barrier, out_queue, imgsz, threads))
+                   for shard in shards]
+
+    for r in runners:
+        r.start()
+
+    # All models loaded and warmed up; a worker that died first breaks the
+    # barrier for everyone once the timeout passes
+    start_barrier.wait(timeout=SWEEP_TIMEOUT_S)
+    prof = ResourceProfiler().start()
+    t0 = time.perf_counter()
+
+    latencies = []
+    try:
+        for _ in runners:
+            latencies.extend(get_from_alive(out_queue, runners))
+    finally:
+        elapsed = time.perf_counter() - t0
+        resources, _ = summarize(prof.stop())
+    for r in runners:
+        r.join(timeout=SWEEP_TIMEOUT_S)
+
+    stats = {
+        "mode": mode,
+        "workers": workers,
+        "threads": threads,
+        "images": len(latencies),
+        "images_per_s": round(len(latencies) / elapsed, 3),
+        "latency_ms": round(float(np.mean(latencies)), 3),
+    }
+    stats.update(latency_stats(latencies, "latency_ms"))
+    stats.update(resources)
+    result_queue.put(stats)
+
+
+def recommend_config(configs, tolerance=0.05):
+    """
+    Best configuration for backlog processing: highest images/s; among those
+    within `tolerance` of it, the one with the lowest peak RAM.
+    """
+    best = max(c["images_per_s"] for c in configs)
+    close = [c for c in configs if c["images_per_s"] >= best * (1 - tolerance)]
+    return min(close, key=lambda c: c.get("max_RAM_MB", 0))
+
+
+def run_concurrency_sweep(mod, prec, form, workers=(1, 2, 4), threads=(1, 2, 4),
+                          modes=("thread", "process"), warmup=3, imgsz=640, calib=CALIBRATION_IMAGES):
+    """
+    Sweep concurrent model instances (threads or processes, one model each)
+    against intra-op threads per instance; print and return the RESULTS json
+    with every configuration plus the recommended one.
+    """
+    reason = unsupported_reason(mod, prec, form)
+    if reason:
+        print(reason)
+        return
+
+    path_test = os.path.join("src", "learning", "test", "images")
+    ims_paths = [os.path.join(path_test, im) for im in os.listdir(path_test)]
+    if not ims_paths:
+        print(f"No test images in {path_test}")
+        return
+
+    new_model = artifact_path(mod, prec, form, imgsz=imgsz, calib=calib)
+    if not os.path.exists(new_model):
+        print(f"Not converted: {new_model}")
+        return
+
+    ctx = mp.get_context("spawn")
+    configs = []
+
+    for mode in modes:
+        for n_workers in workers:
+            if n_workers > len(ims_paths):
+                print(f"Skipping {n_workers} workers: only {len(ims_paths)} test images")
+                continue
+            for n_threads in threads:
+                # Thread settings reach the config process (and its
+                # spawned workers) through the inherited environment
+                saved = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+                for var in THREAD_ENV_VARS:
+                    os.environ[var] = str(n_threads)
+
+                result_queue = ctx.Queue()
+                runner = ctx.Process(target=run_concurrency_config,
+                                     args=(new_model, ims_paths, mode, n_workers, n_threads,
+                                           warmup, result_queue, imgsz))
+                runner.start()
+                try:
+                    stats = get_from_alive(result_queue, [runner])
+                except RuntimeError as e:
+                    print(f"{mod} {prec} {form} - {mode} x{n_workers}, {n_threads} threads failed: {e}")
+                    runner.terminate()
+                    continue
+                finally:
+                    runner.join()
+                    for var, value in saved.items():
+                        if value is None:
+                            os.environ.pop(var, None)
+                        else:
+                            os.environ[var] = value
+
+                print(f"{mod} {prec} {form} - {mode} x{n_workers}, {n_threads} threads: "
+                      f"{stats['images_per_s']} img/s, p95 {stats.get('latency_ms_p95')} ms")
+                configs.append(stats)
+
+    if not configs:
+        print("No configuration completed")
+        return
+
+    results = {
+        "model": mod,
+        "precision": prec,
+        "format": form,
+        "imgsz": imgsz,
+        "calib": calib if prec == "INT8" else None,
+        "configs": configs,
+        "recommended": recommend_config(configs),
+        "recommended_latency": min(configs, key=lambda c: c.get("latency_ms_p95", c["latency_ms"])),
+    }
+
+    print("RESULTS")
+    print(json.dumps(results, indent=4))
+    print("RESULTS")
+    return results
+
+
+def convert_all(workers=2, imgszs=(640,), calib=CALIBRATION_IMAGES):
+    """Convert the matrix on a process pool; cached combinations are skipped."""
     mods = ["v10m", "v10n", "v10s", "v11m", "v11n", "v11s", "v9m", "v9s", "v9t"]
     precs = ["FP32", "FP16", "INT8"]
     forms = ["tflite", "openvino", "mnn"]
@@ -219,10 +715,54 @@ def convert_all():
     precs = ["FP16", "FP32"]
     forms = ["ncnn"]
 
-    for mod in mods:
-        for prec in precs:
-            for form in forms:
-                print(f"Doing: {mod} {prec} {form}")
-
-                convert_model(mod, prec, form)
-
+    jobs = [(mod, prec, form, imgsz) for mod in mods for prec in precs for form in forms for imgsz in imgszs]
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn")) as pool:
+        futures = {pool.submit(convert_model, mod, prec, form, 1, imgsz, calib): (mod, prec, form, imgsz)
+                   for mod, prec, form, imgsz in jobs}
+        for future in as_completed(futures):
+            mod, prec, form, imgsz = futures[future]
+            try:
+                print(f"Done: {mod} {prec} {form} {imgsz} -> {future.result()}")
+            except Exception as e:
+                print(f"Failed: {mod} {prec} {form} {imgsz}: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert or test a YOLO model on this device")
+    parser.add_argument("model")
+    parser.add_argument("precision", choices=["FP32", "FP16", "INT8"])
+    parser.add_argument("format")
+    parser.add_argument("--convert", action="store_true", help="export instead of testing")
+    parser.add_argument("--validate", action="store_true", help="compute mAP on the test split instead of timing")
+    parser.add_argument("--warmup", type=int, default=3, help="untimed warmup calls")
+    parser.add_argument("--batch", type=int, default=1, help="images per call (throughput mode)")
+    parser.add_argument("--imgsz", type=int, default=640, help="export/inference image size")
+    parser.add_argument("--calib", type=int, default=CALIBRATION_IMAGES,
+                        help="INT8 calibration images (0 = whole val split)")
+    parser.add_argument("--inputs", choices=["path", "preload", "prefetch"], default="path",
+                        help="decode inside the timed loop, before it, or on a prefetch thread")
+    parser.add_argument("--sweep", action="store_true",
+                        help="concurrency scaling benchmark over --workers x --threads x --modes")
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated model instance counts")
+    parser.add_argument("--threads", default="1,2,4", help="comma-separated intra-op threads per instance")
+    parser.add_argument("--modes", default="thread,process", help="comma-separated: thread, process")
+    args = parser.parse_args()
+
+    if args.convert:
+        convert_model(args.model, args.precision, args.format, args.batch, args.imgsz, args.calib)
+    elif args.validate:
+        run_validation(args.model, args.precision, args.format, args.imgsz, args.batch, args.calib)
+    elif args.sweep:
+        run_concurrency_sweep(
+            args.model, args.precision, args.format,
+            workers=[int(w) for w in args.workers.split(",")],
+            threads=[int(t) for t in args.threads.split(",")],
+            modes=args.modes.split(","),
+            warmup=args.warmup,
+            imgsz=args.imgsz,
+            calib=args.calib,
+        )
+    else:
+        run_test(args.model, args.precision, args.format, args.warmup, args.batch, args.inputs, args.imgsz,
+                 calib=args.calib)
@@ -1,90 +1,109 @@
-from flask import Flask, request, render_template, jsonify
-import os
-import json
+from flask import Blueprint, Flask, request, render_template, jsonify, send_file
+from metrics import Metrics, count_files
+from pyramid import ImagePyramid
+from labels import box
+# Paths, the retention index (archived originals come back on open) and the
+# label files (saves are logged to the change log shared with server-picture.py)
+from uploads import IMAGES_DIR, LABELS_DIR, JSONS_DIR, PYRAMID_DIR, retention, label_store
 
-app = Flask(__name__)
+# The routes; server.py registers them on the picture server's app instead
+routes = Blueprint("labeler", __name__)
+metrics = Metrics("antpi_labeler")
 
-# ----------------------------------------------------------------------
-# PATHS
-# ----------------------------------------------------------------------
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-STATIC_DIR = os.path.join(BASE_DIR, "static")
-UPLOAD_DIR = os.path.join(STATIC_DIR, "uploads")
+# Preview + zoom tiles of the images (the canvas never loads the full frame)
+pyramid = ImagePyramid(IMAGES_DIR, PYRAMID_DIR, restore=retention.restore)
 
-IMAGES_DIR = os.path.join(UPLOAD_DIR, "images")   # image files
-LABELS_DIR = os.path.join(UPLOAD_DIR, "labels")   # YOLO txt
-JSONS_DIR = os.path.join(UPLOAD_DIR, "jsons")     # per-image json
+# Browser cache lifetime of previews/tiles; they are revalidated by mtime anyway
+TILE_MAX_AGE = 3600
 
-os.makedirs(IMAGES_DIR, exist_ok=True)
-os.makedirs(LABELS_DIR, exist_ok=True)
-os.makedirs(JSONS_DIR, exist_ok=True)
+metrics.gauge("images", "Images stored.", lambda: count_files(IMAGES_DIR, (".jpg", ".jpeg")))
+metrics.gauge("label_files", "YOLO label files stored.", lambda: count_files(LABELS_DIR, (".txt",)))
+metrics.gauge("labeled_images", "Per-image label jsons stored.", lambda: count_files(JSONS_DIR, (".json",)))
 
 
 # ----------------------------------------------------------------------
 # HELPERS
 # ----------------------------------------------------------------------
-def json_path(image_name: str) -> str:
-    """
-    Path of the per-image JSON file for this image.
-    E.g. azz2.jpg -> jsons/azz2.json
-    """
-    base, _ = os.path.splitext(image_name)
-    return os.path.join(JSONS_DIR, base + ".json")
+def offload(func, *args, **kwargs):
+    """Disk work of a request; server.py swaps in the picture server's I/O pool."""
+    return func(*args, **kwargs)
 
 
-def yolo_txt_path(image_name: str) -> str:
-    """
-    Path of the YOLO txt file for this image.
-    E.g. azz2.jpg -> labels/azz2.txt
-    """
-    base, _ = os.path.splitext(image_name)
-    return os.path.join(LABELS_DIR, base + ".txt")
+# ----------------------------------------------------------------------
+# ROUTES
+# ----------------------------------------------------------------------
+@routes.route("/label")
+def label_page():
+    """Render the labeler UI for a given image (?image=...)."""
+    image_name = request.args.get("image")
+    if not image_name:
+        return "Missing 'image' parameter", 400
+    return render_template("labeler.html", image_name=image_name)
 
 
-def load_labels_from_json(image_name: str):
+@routes.route("/image_info")
+def image_info():
     """
-    Load per-image labels from jsons/<stem>.json.
+    Full-resolution size and tile layout of an image, for the labeler canvas.
 
-    Returns:
-        list of label dicts or None if file missing/invalid.
+    The canvas works on the preview (preview_width x preview_height); tiles
+    of level L cover tile_size px of the image downscaled by 2**L, for
+    L < levels. Labels stay normalized to the image, whatever is shown.
     """
-    jpath = json_path(image_name)
-    if not os.path.exists(jpath) or os.path.getsize(jpath) == 0:
-        return None
+    image_name = request.args.get("image")
+    if not image_name:
+        return jsonify({"status": "error", "message": "Missing 'image' parameter"}), 400
 
-    try:
-        with open(jpath, "r") as f:
-            data = json.load(f)
-        # We expect a list of dicts
-        if isinstance(data, list):
-            return data
-        return None
-    except Exception:
-        return None
+    with metrics.stage("pyramid_info"):
+        info = offload(pyramid.info, image_name)
+    if info is None:
+        return jsonify({"status": "error", "message": f"Unknown image: {image_name}"}), 404
+
+    return jsonify({
+        "status": "success",
+        "image": image_name,
+        "width": info["width"],
+        "height": info["height"],
+        "preview_width": info["preview_width"],
+        "preview_height": info["preview_height"],
+        "tile_size": info["tile_size"],
+        "levels": info["levels"],
+    })
 
 
-def save_labels_to_json(image_name: str, labels_list):
-    """
-    Save per-image labels to jsons/<stem>.json.
-    """
-    jpath = json_path(image_name)
-    with open(jpath, "w") as f:
-        json.dump(labels_list, f, indent=2)
+@routes.route("/preview")
+def preview():
+    """Screen-sized JPEG of an image (?image=...)."""
+    image_name = request.args.get("image")
+    if not image_name:
+        return jsonify({"status": "error", "message": "Missing 'image' parameter"}), 400
 
+    with metrics.stage("preview"):
+        path = offload(pyramid.preview, image_name)
+    if path is None:
+        return jsonify({"status": "error", "message": f"Unknown image: {image_name}"}), 404
+    return send_file(path, mimetype="image/jpeg", max_age=TILE_MAX_AGE)
 
-# ----------------------------------------------------------------------
-# ROUTES
-# ----------------------------------------------------------------------
-@app.route("/label")
-def label_page():
-    """Render the labeler UI for a given image (?image=...)."""
+
+@routes.route("/tile")
+def tile():
+    """One zoom tile (?image=...&level=L&x=..&y=..), cut on first use."""
     image_name = request.args.get("image")
+    try:
+        level, x, y = (int(request.args[k]) for k in ("level", "x", "y"))
+    except (KeyError, ValueError):
+        return jsonify({"status": "error", "message": "Missing or invalid level/x/y"}), 400
     if not image_name:
-        return "Missing 'image' parameter", 400
-    return render_template("labeler.html", image_name=image_name)
+        return jsonify({"status": "error", "message": "Missing 'image' parameter"}), 400
+
+    with metrics.stage("tile"):
+        path = offload(pyramid.tile, image_name, level, x, y)
+    if path is None:
+        return jsonify({"status": "error", "message": "No such tile"}), 404
+    return send_file(path, mimetype="image/jpeg", max_age=TILE_MAX_AGE)
 
 
-@app.route("/get_labels")
+@routes.route("/get_labels")
 def get_labels():
     """
     Return all boxes for an image.
@@ -97,63 +116,14 @@ def get_labels():
     if not image_name:
         return jsonify({"status": "error", "message": "Missing 'image' parameter"}), 400
 
-    labels_out = []
-
-    # --- 1) From per-image JSON (authoritative) ---
-    entry = load_labels_from_json(image_name)
-    if isinstance(entry, list):
-        for l in entry:
-            try:
-                cls = int(l["cls"])
-                xc = float(l["x_center"])
-                yc = float(l["y_center"])
-                w = float(l["width"])
-                h = float(l["height"])
-            except (KeyError, ValueError, TypeError):
-                continue
-
-            # default: if is_tp missing, assume True
-            is_tp = bool(l.get("is_tp", True))
-
-            labels_out.append({
-                "cls": cls,
-                "x_center": xc,
-                "y_center": yc,
-                "width": w,
-                "height": h,
-                "is_tp": is_tp,
-            })
-
-    # --- 2) Fallback: from YOLO txt (TP-only) ---
-    else:
-        txt_path = yolo_txt_path(image_name)
-        if os.path.exists(txt_path):
-            try:
-                with open(txt_path, "r") as f:
-                    for line in f:
-                        parts = line.strip().split()
-                        if len(parts) != 5:
-                            continue
-                        cls_str, xc_str, yc_str, w_str, h_str = parts
-                        cls = int(float(cls_str))
-                        xc = float(xc_str)
-                        yc = float(yc_str)
-                        w = float(w_str)
-                        h = float(h_str)
-
-                        labels_out.append({
-                            "cls": cls,
-                            "x_center": xc,
-                            "y_center": yc,
-                            "width": w,
-                            "height": h,
-                            "is_tp": True,  # everything from txt is TP
-                        })
-            except Exception as e:
-                return jsonify({
-                    "status": "error",
-                    "message": f"Error reading YOLO txt: {e}"
-                }), 500
+    try:
+        with metrics.stage("label_read"):
+            labels_out = offload(label_store.load, image_name)
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Error reading YOLO txt: {e}"
+        }), 500
 
     return jsonify({
         "status": "success",
@@ -162,7 +132,7 @@ def get_labels():
     })
 
 
-@app.route("/save_labels", methods=["POST"])
+@routes.route("/save_labels", methods=["POST"])
 def save_labels():
     """
     Save labels for one image.
@@ -177,9 +147,6 @@ def save_labels():
     if not image_name:
         return jsonify({"status": "error", "message": "Missing 'image' field"}), 400
 
-    txt_path = yolo_txt_path(image_name)
-
-    yolo_lines = []
     status_entry = []
 
     for l in labels:
@@ -198,38 +165,16 @@ def save_labels():
             is_tp = True
         is_tp = bool(is_tp)
 
-        status_entry.append({
-            "cls": cls,
-            "x_center": xc,
-            "y_center": yc,
-            "width": w,
-            "height": h,
-            "is_tp": is_tp,
-        })
-
-        if is_tp:
-            yolo_lines.append(f"{cls} {xc:.6f} {yc:.6f} {w:.6f} {h:.6f}")
-
-    # --- write YOLO txt (TP-only) ---
-    try:
-        with open(txt_path, "w") as f:
-            if yolo_lines:
-                f.write("\n".join(yolo_lines) + "\n")
-            else:
-                f.write("")  # empty file if no TP
-    except Exception as e:
-        return jsonify({
-            "status": "error",
-            "message": f"Failed to write label txt: {e}"
-        }), 500
+        status_entry.append(box(cls, xc, yc, w, h, is_tp))
 
-    # --- write per-image JSON ---
+    # --- write YOLO txt (TP-only) and per-image JSON, log the relabel ---
     try:
-        save_labels_to_json(image_name, status_entry)
+        with metrics.stage("label_write"):
+            offload(label_store.save, image_name, status_entry)
     except Exception as e:
         return jsonify({
             "status": "error",
-            "message": f"Failed to write JSON: {e}"
+            "message": f"Failed to write labels: {e}"
         }), 500
 
     kept = sum(1 for s in status_entry if s.get("is_tp", True))
@@ -241,6 +186,10 @@ def save_labels():
     })
 
 
+app = Flask(__name__)
+app.register_blueprint(routes)
+metrics.install(app)
+
 if __name__ == "__main__":
-    # separate from main gallery server
+    # separate from main gallery server (server.py runs both in one process)
     app.run(host="0.0.0.0", port=5001, debug=True)
@@ -1,30 +1,142 @@
-from flask import Flask, request, render_template, jsonify, send_file
+from flask import Flask, Request, request, render_template, jsonify, send_file
 from flask_socketio import SocketIO
 from werkzeug.utils import secure_filename
+from eventlet import tpool
+from eventlet.semaphore import Semaphore
 import os
 import io
 import zipfile
+import tempfile
+import threading
+import contextvars
+import shutil
 import time
 import json
 import piexif
-import datetime  # needed for timestamp parsing
+import datetime
+from metrics import Metrics, count_files
+from dataset import TrainingSet
+from retention import disk_usage
+from catalog import CatalogIndex
+from filenames import capture_time
+from dedup import DuplicateIndex, image_hash
+from labels import box
+# Paths, change log (shared with server-labeler.py), retention index and label cache
+from uploads import (UPLOAD_ROOT, IMAGES_DIR, LABELS_DIR, JSONS_DIR, VARIANTS_DIR, PYRAMID_DIR,
+                     changes, retention, label_store)
+
+
+class UploadRequest(Request):
+    """Keeps uploaded files in memory: werkzeug spools them to a temporary file on the hub otherwise."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
+
+class OffloadedFileWrapper:
+    """wsgi.file_wrapper for send_file(): file chunks are read on the I/O pool, not on the hub."""
+
+    def __init__(self, file, buffer_size=8192):
+        self.file = file
+        self.buffer_size = max(buffer_size, FILE_CHUNK)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = tpool.execute(self.file.read, self.buffer_size)
+        if data:
+            return data
+        raise StopIteration
+
+    def close(self):
+        if hasattr(self.file, "close"):
+            self.file.close()
+
+
+def offload_file_reads(wsgi_app):
+    def wrapped(environ, start_response):
+        environ["wsgi.file_wrapper"] = OffloadedFileWrapper
+        return wsgi_app(environ, start_response)
+    return wrapped
+
 
 app = Flask(__name__)
+app.request_class = UploadRequest
+app.wsgi_app = offload_file_reads(app.wsgi_app)
 socketio = SocketIO(app, async_mode='eventlet')
+metrics = Metrics("antpi_picture")
+metrics.install(app)
+app.config["LABELER_PORT"] = 5001
 
 # ----------------------------------------------------------------------
 # Configuration
 # ----------------------------------------------------------------------
-STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
-UPLOAD_ROOT = os.path.join(STATIC_DIR, "uploads")
-
-IMAGES_DIR = os.path.join(UPLOAD_ROOT, "images")   # image files
-LABELS_DIR = os.path.join(UPLOAD_ROOT, "labels")   # YOLO txt files
-JSONS_DIR = os.path.join(UPLOAD_ROOT, "jsons")     # per-image json files
-
-os.makedirs(IMAGES_DIR, exist_ok=True)
-os.makedirs(LABELS_DIR, exist_ok=True)
-os.makedirs(JSONS_DIR, exist_ok=True)
+# What a client may send instead of the full-resolution JPEG
+UPLOAD_VARIANTS = {"full", "reduced", "crop"}
+
+# YOLO training directory (dataset.py), on the uploads' filesystem for hardlinks
+DATASET_DIR = os.environ.get("ANTPI_DATASET_DIR", os.path.join(UPLOAD_ROOT, "dataset"))
+DATASET_SYNC_INTERVAL = 60  # seconds between incremental updates once materialized
+RETENTION_INTERVAL = 3600  # seconds between policy runs (retention.py)
+# The policy re-encodes originals lossily, so it only runs on a schedule when
+# enabled with ANTPI_RETENTION=1 (POST /apply-retention runs it on demand)
+RETENTION_ENABLED = os.environ.get("ANTPI_RETENTION") == "1"
+
+training_set = TrainingSet(UPLOAD_ROOT, DATASET_DIR, changes, restore=retention.restore)
+dataset_sync_started = False
+
+# Time/device/GPS/sensor/class index answering /get-images filters (catalog.py)
+catalog_index = CatalogIndex(UPLOAD_ROOT, changes)
+
+# Near-duplicate frames (dedup.py): "group" them in the gallery, "reject" them
+# at upload, or "archive" them (retention.py) right after upload
+DUPLICATE_POLICY = os.environ.get("ANTPI_DUPLICATES", "group")
+if DUPLICATE_POLICY not in ("group", "reject", "archive"):
+    raise ValueError(f"ANTPI_DUPLICATES must be group, reject or archive, not {DUPLICATE_POLICY!r}")
+dedup = DuplicateIndex(UPLOAD_ROOT)
+
+# Gallery pages currently connected over Socket.IO
+connected_clients = 0
+
+# Disk work (uploads, listings, label reads, deletions, exports, SQLite
+# indexes) runs on a bounded pool of native threads so the eventlet hub keeps
+# serving other requests and Socket.IO meanwhile; a zip export holds one of
+# the EXPORT_SLOTS, so the other threads stay free for the rest
+IO_THREADS = int(os.environ.get("ANTPI_IO_THREADS", 4))
+EXPORT_SLOTS = 1
+FILE_CHUNK = 1 << 16       # bytes per pooled read of a send_file() response
+MAX_UPLOAD_BYTES = 64 << 20  # uploads are held in memory (UploadRequest)
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
+tpool.set_num_threads(IO_THREADS)
+export_slots = Semaphore(EXPORT_SLOTS)
+
+
+def offload(func, *args, **kwargs):
+    """
+    Run func on the I/O pool and wait for it without blocking the hub. The
+    request context goes along (metrics stages, Server-Timing). Inline when
+    already on the pool. Anything taking the locks of changes, the indexes
+    or retention must go through here: a greenlet waiting on a lock held by
+    a pool thread would stall the whole hub.
+    """
+    return tpool.execute(contextvars.copy_context().run, func, *args, **kwargs)
+
+# Computed on the I/O pool when /metrics is scraped
+metrics.gauge("images", "Images stored.", lambda: offload(count_files, IMAGES_DIR, (".jpg", ".jpeg")))
+metrics.gauge("label_files", "YOLO label files stored.", lambda: offload(count_files, LABELS_DIR, (".txt",)))
+metrics.gauge("labeled_images", "Per-image label jsons stored.", lambda: offload(count_files, JSONS_DIR, (".json",)))
+metrics.gauge("variant_images", "Images stored as a reduced/crop variant.",
+              lambda: offload(count_files, VARIANTS_DIR, (".json",)))
+metrics.gauge("socketio_clients", "Connected Socket.IO clients.", lambda: connected_clients)
+metrics.gauge("change_version", "Latest catalog change version.", lambda: offload(changes.version))
+metrics.gauge("archived_images", "Originals moved to archive bundles.", lambda: offload(retention.count, "archived"))
+metrics.gauge("reencoded_images", "Unlabeled images re-encoded at lower quality.",
+              lambda: offload(retention.count, "reencoded"))
+metrics.gauge("duplicate_images", "Images in near-duplicate groups.", lambda: dedup.grouped)
+metrics.gauge("disk_usage_ratio", "Used fraction of the uploads disk.",
+              lambda: round(offload(disk_usage, IMAGES_DIR), 4))
+metrics.gauge("io_pool_threads", "Native threads for disk work.", lambda: IO_THREADS)
 
 
 # ----------------------------------------------------------------------
@@ -39,12 +151,73 @@ def json_path_for_image(filename: str) -> str:
     return os.path.join(JSONS_DIR, base + ".json")
 
 
-def is_image_labeled(filename: str) -> bool:
+def variant_path_for_image(filename: str) -> str:
     """
-    An image is considered 'labeled' if a non-empty jsons/<stem>.json exists.
+    Path of the upload-variant sidecar for this image.
+    E.g. azz2.jpg -> variants/azz2.json
+    Only exists while the stored image is not the full-resolution original.
     """
-    jpath = json_path_for_image(filename)
-    return os.path.exists(jpath) and os.path.getsize(jpath) > 0
+    base, _ = os.path.splitext(filename)
+    return os.path.join(VARIANTS_DIR, base + ".json")
+
+
+def load_variant(filename: str):
+    """Return the variant sidecar dict for this image, or None if it is the original."""
+    vpath = variant_path_for_image(filename)
+    if not os.path.exists(vpath):
+        return None
+    try:
+        with open(vpath, "r") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def load_requested_originals():
+    """{device: set of filenames} of the sidecars asking for the original (one scan at startup)."""
+    requested = {}
+    for fname in os.listdir(VARIANTS_DIR):
+        if not fname.endswith(".json"):
+            continue
+        with open(os.path.join(VARIANTS_DIR, fname), "r") as f:
+            try:
+                entry = json.load(f)
+            except ValueError:
+                continue
+        if entry.get("original_requested"):
+            requested.setdefault(entry.get("device"), set()).add(entry["filename"])
+    return requested
+
+
+# Originals asked for, by uploading device: /receive answers each client
+# with its own images without re-reading the sidecars
+requested_originals = load_requested_originals()
+requested_lock = threading.Lock()
+
+
+def originals_requested(device):
+    """Filenames whose full-resolution original this client should re-send."""
+    with requested_lock:
+        return sorted(requested_originals.get(device, ()))
+
+
+def remap_labels(filename, old_box, new_box):
+    """
+    Re-normalize saved labels drawn on a crop (old_box, normalized to the
+    full frame) to the image replacing it: the full frame (new_box None) or
+    another crop.
+    """
+    boxes = label_store.load(filename)
+    if not boxes:
+        return
+    ox, oy, ow, oh = old_box[0], old_box[1], old_box[2] - old_box[0], old_box[3] - old_box[1]
+    nx, ny, nw, nh = (new_box[0], new_box[1], new_box[2] - new_box[0], new_box[3] - new_box[1]) \
+        if new_box else (0., 0., 1., 1.)
+    label_store.save(filename, [
+        box(b["cls"], (ox + b["x_center"] * ow - nx) / nw, (oy + b["y_center"] * oh - ny) / nh,
+            b["width"] * ow / nw, b["height"] * oh / nh, b["is_tp"])
+        for b in boxes
+    ])
 
 
 # ----------------------------------------------------------------------
@@ -81,72 +254,58 @@ def extract_metadata(image_path):
 # ----------------------------------------------------------------------
 # Image listing (gallery)
 # ----------------------------------------------------------------------
-def get_sorted_images(image_folder):
+@metrics.timed("get_sorted_images")
+def get_sorted_images(image_folder, image_files=None):
     """
     Retrieve images and sort them by the timestamp encoded in the filename
-    (e.g., 2023-07-20T20-19-46+0200_...), newest first.
+    (e.g., 2023-07-20T20-19-46+0200_... or img_20230720-201946, see filenames.py), newest first.
     If parsing fails, fall back to file modification time.
-    Image files: *.jpg, *.jpeg in IMAGES_DIR
+    Image files: *.jpg, *.jpeg in IMAGES_DIR (or only `image_files`,
+    e.g. the ones changed since a catalog version)
     Label files: same base name, *.txt in LABELS_DIR
     """
 
-    def parse_timestamp_from_filename(filename: str, file_path: str) -> float:
-        """
-        Try to parse the leading timestamp in the filename:
-        2023-07-20T20-19-46+0200_b8-27-eb-3b-8d-1c.jpeg
-
-        Prefix:  %Y-%m-%dT%H-%M-%S%z
-        If anything goes wrong, fall back to os.path.getmtime(file_path).
-        """
-        base_name, _ = os.path.splitext(filename)
-
-        try:
-            # Take the part before the first underscore
-            prefix = base_name.split("_", 1)[0]  # "2023-07-20T20-19-46+0200"
-            dt = datetime.datetime.strptime(prefix, "%Y-%m-%dT%H-%M-%S%z")
-            return dt.timestamp()
-        except Exception:
-            # Fallback: filesystem mtime
-            return os.path.getmtime(file_path)
-
-    image_files = [
-        f
-        for f in os.listdir(image_folder)
-        if f.lower().endswith((".jpg", ".jpeg"))
+    if image_files is None:
+        with metrics.stage("listing"):
+            image_files = [
+                f
+                for f in os.listdir(image_folder)
+                if f.lower().endswith((".jpg", ".jpeg"))
+            ]
+
+    # sort key based on filename timestamp (or mtime as fallback)
+    with metrics.stage("parsing"):
+        sort_ts = {
+            image: capture_time(image, os.path.join(image_folder, image))
+            for image in image_files
+        }
+
+    with metrics.stage("metadata"):
+        metadata = {
+            image: extract_metadata(os.path.join(image_folder, image))
+            for image in image_files
+        }
+
+    # Count labels (non-empty lines of the .txt in LABELS_DIR), cached until relabeled
+    with metrics.stage("labels"):
+        label_store.sync()
+        labels_counts = {image: count for image, (count, _) in label_store.summaries(image_files).items()}
+
+    image_files_with_metadata = [
+        {
+            "filename": image,
+            "upload_ts": sort_ts[image],   # numeric timestamp used for sorting
+            "metadata": metadata[image],
+            "labels_count": labels_counts[image],
+        }
+        for image in image_files
     ]
 
-    image_files_with_metadata = []
-    for image in image_files:
-        file_path = os.path.join(image_folder, image)
-
-        # sort key based on filename timestamp (or mtime as fallback)
-        sort_ts = parse_timestamp_from_filename(image, file_path)
-
-        metadata = extract_metadata(file_path)
-
-        # Count labels, if a corresponding .txt exists in LABELS_DIR
-        base_name, _ = os.path.splitext(image)
-        labels_path = os.path.join(LABELS_DIR, base_name + ".txt")
-        labels_count = 0
-        if os.path.exists(labels_path):
-            with open(labels_path, "r") as lf:
-                for line in lf:
-                    if line.strip():
-                        labels_count += 1
-
-        image_files_with_metadata.append(
-            {
-                "filename": image,
-                "upload_ts": sort_ts,   # numeric timestamp used for sorting
-                "metadata": metadata,
-                "labels_count": labels_count,
-            }
-        )
-
     # Sort by our parsed timestamp (newest first)
-    sorted_images = sorted(
-        image_files_with_metadata, key=lambda x: x["upload_ts"], reverse=True
-    )
+    with metrics.stage("sorting"):
+        sorted_images = sorted(
+            image_files_with_metadata, key=lambda x: x["upload_ts"], reverse=True
+        )
 
     # Add a human-readable upload_time string
     for image in sorted_images:
@@ -157,9 +316,66 @@ def get_sorted_images(image_folder):
     return sorted_images
 
 
+def add_image_flags(images):
+    """
+    Add is_labeled (per-image json), variant (sidecar) and, for near-duplicates,
+    duplicate_group/duplicates (group name and size) to catalog entries.
+    """
+    with metrics.stage("flags"):
+        groups = dedup.groups([img.get("filename") for img in images])
+        labels = label_store.summaries([img.get("filename") for img in images])
+        for img in images:
+            fname = img.get("filename")
+            img["is_labeled"] = labels[fname][1]
+            variant = load_variant(fname)
+            img["variant"] = variant["variant"] if variant else "full"
+            group, size = groups.get(fname, (None, 1))
+            img["duplicate_group"] = group
+            img["duplicates"] = size
+    return images
+
+
+# ----------------------------------------------------------------------
+# Change log (delta sync for the gallery)
+# ----------------------------------------------------------------------
+def list_image_names():
+    return {f for f in os.listdir(IMAGES_DIR) if f.lower().endswith((".jpg", ".jpeg"))}
+
+
+# Images present at the last directory check, and the directory mtime then
+image_dir_state = {"mtime_ns": os.stat(IMAGES_DIR).st_mtime_ns, "names": list_image_names()}
+image_dir_lock = threading.Lock()   # updated from several pool threads
+
+# Deltas from before this server started may miss images written while it
+# was down: galleries that synced earlier get a full snapshot instead
+reset_version = changes.record("", "reset")
+
+
+def reconcile_image_dir():
+    """
+    Log images that appeared or disappeared without going through /receive
+    or /delete-image (e.g. a client on the same Pi writing into IMAGES_DIR).
+    Only re-lists the directory when its mtime changed.
+    """
+    with image_dir_lock:
+        mtime_ns = os.stat(IMAGES_DIR).st_mtime_ns
+        if mtime_ns == image_dir_state["mtime_ns"]:
+            return
+        names = list_image_names()
+        changes.record_many(sorted(names - image_dir_state["names"]), "added")
+        changes.record_many(sorted(image_dir_state["names"] - names), "deleted")
+        image_dir_state.update(mtime_ns=mtime_ns, names=names)
+
+
 # ----------------------------------------------------------------------
 # Routes
 # ----------------------------------------------------------------------
+@app.context_processor
+def labeler_location():
+    # The gallery opens the labeler on this port (server.py serves both on one)
+    return {"labeler_port": app.config["LABELER_PORT"]}
+
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -170,11 +386,102 @@ def gallery():
     return render_template("gallery.html")
 
 
+@socketio.on("connect")
+def on_connect():
+    global connected_clients
+    connected_clients += 1
+
+
+@socketio.on("disconnect")
+def on_disconnect():
+    global connected_clients
+    connected_clients -= 1
+
+
+def store_upload(file, filename, variant, detections, crop_box, device):
+    """
+    Disk side of /receive (runs on the I/O pool): hash, near-duplicate check,
+    save, variant sidecar, change log. Returns {"duplicate_of", "metadata",
+    "version", "originals_requested"}; version is None when the upload was
+    rejected as a near-duplicate.
+    """
+    file_path = os.path.join(IMAGES_DIR, filename)
+    existed = os.path.exists(file_path)
+
+    # Crops are not comparable with whole frames
+    phash, duplicate = None, None
+    if variant != "crop":
+        with metrics.stage("phash"):
+            try:
+                phash = image_hash(file.stream)
+            except OSError:
+                phash = None
+            file.stream.seek(0)
+            if phash is not None:
+                duplicate = dedup.nearest(phash, exclude=filename)
+
+    stored = {"duplicate_of": duplicate[0] if duplicate else None, "metadata": None, "version": None}
+    if duplicate and DUPLICATE_POLICY == "reject" and not existed:
+        return dict(stored, originals_requested=originals_requested(device))
+
+    with metrics.stage("save"):
+        if existed:
+            # The older file may be archived or re-encoded: its state goes with it
+            retention.replace(filename, lambda: file.save(file_path))
+        else:
+            file.save(file_path)
+    if phash is not None:
+        _, others = dedup.add(filename, phash)
+        if others:
+            # Their group size in the gallery changes with this upload
+            changes.record_many(others, "updated")
+        if duplicate and DUPLICATE_POLICY == "archive":
+            retention.archive(filename)
+
+    vpath = variant_path_for_image(filename)
+    previous = load_variant(filename) or {}
+    if previous.get("variant") == "crop" and previous.get("crop_box"):
+        # Labels drawn on the crop are normalized to it, not to what replaces it
+        remap_labels(filename, previous["crop_box"], crop_box if variant == "crop" else None)
+    if variant == "full":
+        # The original supersedes any earlier reduced/crop upload
+        if os.path.exists(vpath):
+            os.remove(vpath)
+        with requested_lock:
+            requested_originals.get(previous.get("device"), set()).discard(filename)
+    else:
+        with open(vpath, "w") as f:
+            json.dump({
+                "filename": filename,
+                "variant": variant,
+                "detections": detections,
+                "crop_box": crop_box,
+                "device": device,
+                "original_requested": previous.get("original_requested", False),
+            }, f)
+
+    stored["metadata"] = extract_metadata(file_path)
+    stored["version"] = changes.record(filename, "updated" if existed else "added")
+    with image_dir_lock:
+        image_dir_state["names"].add(filename)
+    return dict(stored, originals_requested=originals_requested(device))
+
+
 @app.route("/receive", methods=["POST"])
 def receive_image():
     """
     Handles image upload and metadata extraction.
     Expects form field "image".
+
+    Optional form fields (bandwidth-adaptive clients):
+      - variant: "full" (default), "reduced" or "crop"
+      - detections: JSON list of [cls, x_center, y_center, width, height]
+                    normalized to the full-resolution frame
+      - crop_box: JSON [x1, y1, x2, y2] normalized, for variant "crop"
+      - device: client id (default: the client's address)
+
+    The response lists "originals_requested": filenames of this client whose
+    original it should upload again with variant "full".
     """
     if "image" not in request.files:
         return jsonify({"error": "No image part"}), 400
@@ -187,63 +494,237 @@ def receive_image():
     if ext not in {"jpg", "jpeg"}:
         return jsonify({"error": "Invalid file type"}), 400
 
-    filename = secure_filename(file.filename)
-    file_path = os.path.join(IMAGES_DIR, filename)
-    file.save(file_path)
+    variant = request.form.get("variant", "full").strip().lower()
+    if variant not in UPLOAD_VARIANTS:
+        return jsonify({"error": "Invalid variant"}), 400
 
-    metadata = extract_metadata(file_path)
+    try:
+        detections = json.loads(request.form.get("detections", "[]"))
+        crop_box = json.loads(request.form.get("crop_box", "null"))
+    except ValueError:
+        return jsonify({"error": "Invalid detections/crop_box"}), 400
+
+    device = request.form.get("device", "").strip() or request.remote_addr
+    filename = secure_filename(file.filename)
+    stored = offload(store_upload, file, filename, variant, detections, crop_box, device)
+    duplicate = stored["duplicate_of"]
+
+    if stored["version"] is None:
+        # 200: the client must not retry an upload that is redundant
+        return jsonify({
+            "message": "Near-duplicate, not stored",
+            "duplicate_of": duplicate,
+            "variant": variant,
+            "originals_requested": stored["originals_requested"],
+        }), 200
 
     socketio.emit(
         "new_image",
         {
             "filename": filename,
-            "metadata": metadata,
+            "metadata": stored["metadata"],
+            "variant": variant,
+            "version": stored["version"],
         },
     )
 
-    return jsonify({"message": "Image received", "metadata": metadata}), 200
+    return jsonify({
+        "message": "Image received",
+        "metadata": stored["metadata"],
+        "variant": variant,
+        "duplicate_of": duplicate,
+        "originals_requested": stored["originals_requested"],
+    }), 200
+
+
+def mark_original_requested(filename):
+    """Flag a variant's sidecar for the client; returns the sidecar, None for originals."""
+    entry = load_variant(filename)
+    if entry is not None:
+        entry["original_requested"] = True
+        with open(variant_path_for_image(filename), "w") as f:
+            json.dump(entry, f)
+        with requested_lock:
+            requested_originals.setdefault(entry.get("device"), set()).add(filename)
+    return entry
+
+
+@app.route("/request-original", methods=["POST"])
+def request_original():
+    """
+    Ask the uploading client for the full-resolution original of an image
+    that arrived as a "reduced" or "crop" variant. The request is delivered
+    in the response of the client's next /receive call.
+    """
+    data = request.get_json(silent=True) or {}
+    filename = data.get("filename")
+
+    if not filename:
+        return jsonify({"status": "error", "message": "filename missing"}), 400
+
+    entry = offload(mark_original_requested, filename)
+    if entry is None:
+        return jsonify({"status": "not_found", "message": "image is already the original"}), 404
+
+    return jsonify({"status": "success", "variant": entry["variant"]})
 
 
 @app.route("/uploaded_images")
 def uploaded_images():
     # kept for backward compatibility (same as /get-images)
-    return jsonify(get_sorted_images(IMAGES_DIR))
+    return jsonify(offload(get_sorted_images, IMAGES_DIR))
+
+
+def parse_time_arg(value):
+    """Epoch seconds or ISO 8601 (2023-07-20T20:19:46+02:00) -> timestamp."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def parse_floats(value, n):
+    values = [float(v) for v in value.split(",")]
+    if len(values) != n:
+        raise ValueError(f"expected {n} comma-separated numbers")
+    return values
 
 
 @app.route("/get-images")
 def get_images():
     """
-    Return the list of images with optional filtering.
+    Return the list of images with optional filtering (answered by the
+    catalog index, newest first).
 
     Query parameters:
       - filter: substring (case-insensitive) to match in filename
       - only_labeled: if true/1/yes/on → keep only NON-labeled images
                       (as per your latest semantics)
+      - since, until: capture time, epoch seconds or ISO 8601
+      - hours: only the last N hours (e.g. hours=24)
+      - device: client id(s), comma-separated (e.g. b8-27-eb-3b-8d-1c)
+      - bbox: GPS box min_lat,min_lon,max_lat,max_lon
+      - temperature_min/_max, pressure_min/_max, humidity_min/_max: EXIF sensor ranges
+      - cls: class id(s), comma-separated: images with a TP box of any of them
     """
-    # read query params
-    filter_str = request.args.get("filter", "").strip().lower()
-    only_labeled_raw = request.args.get("only_labeled", "false").strip().lower()
-    only_labeled = only_labeled_raw in ("1", "true", "yes", "on")
+    args = request.args
+    only_labeled = args.get("only_labeled", "false").strip().lower() in ("1", "true", "yes", "on")
+    try:
+        since = parse_time_arg(args["since"]) if "since" in args else None
+        until = parse_time_arg(args["until"]) if "until" in args else None
+        if "hours" in args:
+            since = max(since or 0., time.time() - float(args["hours"]) * 3600)
+        bbox = parse_floats(args["bbox"], 4) if "bbox" in args else None
+        classes = [int(c) for c in args["cls"].split(",")] if "cls" in args else None
+        ranges = {
+            sensor: (float(args[f"{sensor}_min"]) if f"{sensor}_min" in args else None,
+                     float(args[f"{sensor}_max"]) if f"{sensor}_max" in args else None)
+            for sensor in ("temperature", "pressure", "humidity")
+            if f"{sensor}_min" in args or f"{sensor}_max" in args
+        }
+    except ValueError as e:
+        return jsonify({"error": f"Invalid filter: {e}"}), 400
+    devices = [d for d in args.get("device", "").split(",") if d]
+
+    def query():
+        reconcile_image_dir()
+        with metrics.stage("index_sync"):
+            catalog_index.sync()
+        with metrics.stage("index_query"):
+            names = catalog_index.query(
+                since=since, until=until, devices=devices, bbox=bbox, classes=classes,
+                labeled=False if only_labeled else None,  # only_labeled means NON-labeled only
+                name_contains=args.get("filter", "").strip(), **ranges,
+            )
+        return add_image_flags(get_sorted_images(IMAGES_DIR, names))
+
+    images = offload(query)
+
+    with metrics.stage("serialize"):
+        return jsonify(images)
+
+
+@app.route("/changes")
+def get_changes():
+    """
+    Catalog changes since a version, for galleries that keep their own copy.
 
-    images = get_sorted_images(IMAGES_DIR)
+    Query parameters:
+      - since: last version the caller has applied (0 or missing: none)
 
-    # add is_labeled flag to each image (based on per-image json)
-    for img in images:
-        fname = img.get("filename")
-        img["is_labeled"] = is_image_labeled(fname)
+    Returns {"version", "full", "upserts", "deleted"}: upserts are /get-images
+    entries of images added, replaced or relabeled since then, deleted their
+    filenames. "full" means upserts is the whole catalog and the caller
+    should drop what it has (first sync, or `since` predates a server start).
+    """
+    try:
+        since = int(request.args.get("since", 0))
+    except ValueError:
+        return jsonify({"error": "since must be an integer"}), 400
 
-    # apply filename filter (if any)
-    if filter_str:
-        images = [
-            img for img in images
-            if filter_str in img["filename"].lower()
-        ]
+    def delta():
+        reconcile_image_dir()
 
-    # apply "only non labeled" filter (as per your previous logic)
-    if only_labeled:  # interpreted as: only NON-labeled
-        images = [img for img in images if not img.get("is_labeled")]
+        if since < reset_version:
+            # Version first: anything changing during the scan is re-sent next time
+            version = changes.version()
+            images = add_image_flags(get_sorted_images(IMAGES_DIR))
+            return {"version": version, "full": True, "upserts": images, "deleted": []}
 
-    return jsonify(images)
+        version, changed = changes.since(since)
+        present = [f for f, kind in changed.items()
+                   if kind != "deleted" and os.path.exists(os.path.join(IMAGES_DIR, f))]
+        deleted = sorted(set(changed) - set(present))
+        images = add_image_flags(get_sorted_images(IMAGES_DIR, present))
+        return {"version": version, "full": False, "upserts": images, "deleted": deleted}
+
+    result = offload(delta)
+    with metrics.stage("serialize"):
+        return jsonify(result)
+
+
+def remove_image_files(filename):
+    """Delete an image and everything derived from it (runs on the I/O pool); returns what was removed."""
+    img_path = os.path.join(IMAGES_DIR, filename)
+    base, _ = os.path.splitext(filename)
+    labels_path = os.path.join(LABELS_DIR, base + ".txt")
+    json_path = json_path_for_image(filename)
+
+    removed = {"image": False, "labels": False, "json": False}
+
+    if os.path.exists(img_path):
+        os.remove(img_path)
+        removed["image"] = True
+
+    if os.path.exists(labels_path):
+        os.remove(labels_path)
+        removed["labels"] = True
+
+    if os.path.exists(json_path):
+        os.remove(json_path)
+        removed["json"] = True
+
+    # Not part of the "removed" status: most images have no sidecar
+    vpath = variant_path_for_image(filename)
+    if os.path.exists(vpath):
+        os.remove(vpath)
+    with requested_lock:
+        for requested in requested_originals.values():
+            requested.discard(filename)
+
+    # Labeler previews/tiles (server-labeler.py)
+    shutil.rmtree(os.path.join(PYRAMID_DIR, base), ignore_errors=True)
+    retention.forget(filename)
+    others = dedup.forget(filename)
+    if others:
+        changes.record_many(others, "updated")   # their group shrinks
+    label_store.forget(filename)
+
+    if removed["image"]:
+        changes.record(filename, "deleted")
+        with image_dir_lock:
+            image_dir_state["names"].discard(filename)
+    return removed
 
 
 @app.route("/delete-image", methods=["POST"])
@@ -257,25 +738,8 @@ def delete_image():
     if not filename:
         return jsonify({"status": "error", "message": "filename missing"}), 400
 
-    img_path = os.path.join(IMAGES_DIR, filename)
-    base, _ = os.path.splitext(filename)
-    labels_path = os.path.join(LABELS_DIR, base + ".txt")
-    json_path = json_path_for_image(filename)
-
-    removed = {"image": False, "labels": False, "json": False}
-
     try:
-        if os.path.exists(img_path):
-            os.remove(img_path)
-            removed["image"] = True
-
-        if os.path.exists(labels_path):
-            os.remove(labels_path)
-            removed["labels"] = True
-
-        if os.path.exists(json_path):
-            os.remove(json_path)
-            removed["json"] = True
+        removed = offload(remove_image_files, filename)
 
         status = "success"
         if not any(removed.values()):
@@ -288,18 +752,75 @@ def delete_image():
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
-@app.route("/download-dataset")
-def download_dataset():
+def sync_training_set():
+    reconcile_image_dir()
+    with metrics.stage("dataset_sync"):
+        return training_set.sync()
+
+
+def dataset_sync_loop():
+    """Apply new labels/uploads/deletions to the training directory periodically."""
+    while True:
+        socketio.sleep(DATASET_SYNC_INTERVAL)
+        offload(sync_training_set)
+
+
+def start_dataset_sync():
+    global dataset_sync_started
+    if not dataset_sync_started:
+        dataset_sync_started = True
+        socketio.start_background_task(dataset_sync_loop)
+
+
+@app.route("/materialize-dataset", methods=["POST"])
+def materialize_dataset():
     """
-    Create a zip on the fly containing:
-      - image files from IMAGES_DIR -> images/...
-      - txt label files from LABELS_DIR -> labels/...
-      - json files from JSONS_DIR -> jsons/...
+    Create or update the YOLO training directory (DATASET_DIR): data.yaml,
+    images/ and labels/ with stratified train/val splits, images hardlinked
+    from the uploads. The first call links everything; later calls (and a
+    background task every DATASET_SYNC_INTERVAL s) only apply the changes
+    since the previous one.
     """
-    memory_file = io.BytesIO()
+    try:
+        summary = offload(sync_training_set)
+    except OSError as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+    start_dataset_sync()
+    return jsonify(dict(summary, status="success"))
+
+
+def retention_loop():
+    """Apply the retention policy periodically (age rules and the disk high-water mark)."""
+    while True:
+        with metrics.stage("retention"):
+            summary = offload(retention.run)
+        if summary["reencoded"] or summary["archived"]:
+            print(f"[retention] {summary}")
+        socketio.sleep(RETENTION_INTERVAL)
+
+
+@app.route("/apply-retention", methods=["POST"])
+def apply_retention():
+    """
+    Run the retention policy now. JSON body {"dry_run": true} only reports
+    what the age rules would re-encode or archive.
+    """
+    data = request.get_json(silent=True) or {}
+    with metrics.stage("retention"):
+        summary = offload(retention.run, dry_run=bool(data.get("dry_run", False)))
+    return jsonify(dict(summary, status="success"))
 
-    with zipfile.ZipFile(
-        memory_file, mode="w", compression=zipfile.ZIP_DEFLATED
+
+def build_dataset_zip():
+    """
+    Write the dataset zip to an anonymous temporary file in UPLOAD_ROOT (runs
+    on the I/O pool; an SD card has more room than the Pi's RAM) and return
+    it rewound.
+    """
+    archive = tempfile.TemporaryFile(dir=UPLOAD_ROOT)
+    with metrics.stage("zip"), zipfile.ZipFile(
+        archive, mode="w", compression=zipfile.ZIP_DEFLATED
     ) as zf:
         # Add images to /images
         for root, dirs, files in os.walk(IMAGES_DIR):
@@ -310,7 +831,12 @@ def download_dataset():
                 full_path = os.path.join(root, fname)
                 rel_path = os.path.relpath(full_path, IMAGES_DIR)
                 arcname = os.path.join("images", rel_path)
-                zf.write(full_path, arcname)
+                # Archived: the original from its bundle, not the thumbnail left in place
+                original = retention.read_original(fname) if root == IMAGES_DIR else None
+                if original is not None:
+                    zf.writestr(arcname, original)
+                else:
+                    zf.write(full_path, arcname)
 
         # Add labels to /labels (only .txt)
         for root, dirs, files in os.walk(LABELS_DIR):
@@ -334,15 +860,40 @@ def download_dataset():
                 arcname = os.path.join("jsons", rel_path)
                 zf.write(full_path, arcname)
 
-    memory_file.seek(0)
+    archive.seek(0)
+    return archive
+
+
+@app.route("/download-dataset")
+def download_dataset():
+    """
+    Create a zip on the fly containing:
+      - image files from IMAGES_DIR -> images/...
+      - txt label files from LABELS_DIR -> labels/...
+      - json files from JSONS_DIR -> jsons/...
+    """
+    # One export at a time; waiting here does not hold a pool thread
+    with export_slots:
+        archive = offload(build_dataset_zip)
 
-    return send_file(
-        memory_file,
+    # Streamed from the temporary file by OffloadedFileWrapper, which closes (deletes) it
+    response = send_file(
+        archive,
         mimetype="application/zip",
         as_attachment=True,
         download_name="antpi_dataset.zip",
     )
+    response.content_length = os.fstat(archive.fileno()).st_size
+    return response
 
 
-if __name__ == "__main__":
+def main():
+    if training_set.exists:
+        start_dataset_sync()
+    if RETENTION_ENABLED:
+        socketio.start_background_task(retention_loop)
     socketio.run(app, host="0.0.0.0", port=5000, debug=True)
+
+
+if __name__ == "__main__":
+    main()
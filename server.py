@@ -0,0 +1,24 @@
+"""
+Picture server and labeler in one process, both on port 5000: an optional
+deployment for the Pi instead of server-picture.py + server-labeler.py.
+
+    python server.py
+
+The two route sets share one Python process, the paths, change log,
+retention index and label cache of uploads.py, one /metrics, and the
+picture server's I/O pool for the labeler's disk work (previews, tiles,
+label files). A label save is in the gallery's counts at its next listing.
+"""
+import importlib
+
+picture = importlib.import_module("server-picture")
+labeler = importlib.import_module("server-labeler")
+
+# Stage timings go to the picture server's /metrics, disk work to its pool
+labeler.metrics = picture.metrics
+labeler.offload = picture.offload
+picture.app.register_blueprint(labeler.routes)
+picture.app.config["LABELER_PORT"] = 5000
+
+if __name__ == "__main__":
+    picture.main()
@@ -11,7 +11,11 @@ let drawPreview = null;
 const DEL_SIZE = 32;   // bigger icon box
 const DEL_PAD = 6;     // slightly more spacing
 
-const STATIC_UPLOADS_BASE = "/static/uploads/images";
+// Screen-sized preview first, zoom tiles on demand (server-labeler.py /image_info, /preview, /tile)
+let imageInfo = null;         // sizes + tile layout from /image_info
+let fullScale = 1;            // full-resolution px per canvas (preview) px
+const tileCache = new Map();  // "level/x/y" -> <img>
+const TILE_CACHE_MAX = 256;
 const LABEL_ALPHA = 0.0;   // 0 = fully transparent, 1 = fully opaque
 
 const APP = 1; // 0 = bugs, 1 = ants
@@ -63,6 +67,7 @@ function applyTransform() {
     stage.style.transformOrigin = "0 0";
     stage.style.transform =
         `translate(${zoomState.x}px, ${zoomState.y}px) scale(${zoomState.scale})`;
+    scheduleTiles();
 }
 
 
@@ -103,7 +108,29 @@ async function loadServerImage(filename) {
     const img = document.getElementById("previewImage");
     const canvas = document.getElementById("bboxCanvas");
 
-    const imgURL = `${STATIC_UPLOADS_BASE}/${filename}`;
+    const imgURL = `/preview?image=${encodeURIComponent(filename)}`;
+
+    // Size and tile layout first: the canvas works on the preview, the
+    // full-resolution frame is only fetched as tiles of the zoomed area
+    imageInfo = null;
+    tileCache.clear();
+    document.getElementById("tileLayer").replaceChildren();
+    try {
+        const res = await fetch(`/image_info?image=${encodeURIComponent(filename)}`);
+        const data = await res.json();
+        if (data.status !== "success") {
+            throw new Error(data.message || "HTTP " + res.status);
+        }
+        imageInfo = data;
+    } catch (err) {
+        setStatus(`Cannot load image: ${err && err.message ? err.message : err}`, "error");
+        return;
+    }
+
+    // Zoom limits and 1:1 stay relative to the full-resolution frame
+    fullScale = imageInfo.width / imageInfo.preview_width;
+    zoomState.minScale = 0.25 * fullScale;
+    zoomState.maxScale = 4 * fullScale;
 
     img.onload = () => {
         fitCanvasToImage(img, canvas);  // sets natural size for img + canvas
@@ -903,8 +930,8 @@ function resetZoomToFit() {
     const vh = viewer.clientHeight;
     if (!vw || !vh) return;
 
-    // scale so the whole image fits in the viewer, but don't upscale above 1
-    const scale = Math.min(vw / imgW, vh / imgH, 1);
+    // scale so the whole image fits in the viewer, but don't upscale above full resolution
+    const scale = Math.min(vw / imgW, vh / imgH, fullScale);
 
     zoomState.scale = scale;
 
@@ -918,3 +945,80 @@ function resetZoomToFit() {
 }
 
 
+/* -------------------- ZOOM TILES -------------------- */
+
+let tilesScheduled = false;
+
+function scheduleTiles() {
+    if (tilesScheduled) return;
+    tilesScheduled = true;
+    requestAnimationFrame(() => {
+        tilesScheduled = false;
+        updateTiles();
+    });
+}
+
+// Cover the visible part of the image with tiles of the coarsest level that
+// is at least as sharp as the screen; below that the preview is enough
+function updateTiles() {
+    const layer = document.getElementById("tileLayer");
+    const viewer = document.getElementById("viewer");
+    if (!layer || !viewer || !imageInfo) return;
+
+    const screenPerFull = zoomState.scale / fullScale;
+    const level = Math.max(0, Math.floor(Math.log2(1 / screenPerFull)));
+    if (level >= imageInfo.levels) {
+        layer.replaceChildren();
+        return;
+    }
+
+    const T = imageInfo.tile_size;
+    const levelW = Math.ceil(imageInfo.width / 2 ** level);
+    const levelH = Math.ceil(imageInfo.height / 2 ** level);
+    const k = levelW / imageInfo.preview_width;   // level px per canvas px
+
+    // Visible rectangle in canvas px
+    const x0 = (viewer.scrollLeft - zoomState.x) / zoomState.scale;
+    const y0 = (viewer.scrollTop - zoomState.y) / zoomState.scale;
+    const x1 = x0 + viewer.clientWidth / zoomState.scale;
+    const y1 = y0 + viewer.clientHeight / zoomState.scale;
+
+    const clamp = (v, n) => Math.max(0, Math.min(n - 1, v));
+    const cols = Math.ceil(levelW / T), rows = Math.ceil(levelH / T);
+    const tx0 = clamp(Math.floor(x0 * k / T), cols), tx1 = clamp(Math.floor(x1 * k / T), cols);
+    const ty0 = clamp(Math.floor(y0 * k / T), rows), ty1 = clamp(Math.floor(y1 * k / T), rows);
+
+    const tiles = [];
+    for (let ty = ty0; ty <= ty1; ty++) {
+        for (let tx = tx0; tx <= tx1; tx++) {
+            tiles.push(getTile(level, tx, ty, Math.min(T, levelW - tx * T), Math.min(T, levelH - ty * T), k));
+        }
+    }
+    layer.replaceChildren(...tiles);
+}
+
+function getTile(level, tx, ty, w, h, k) {
+    const key = `${level}/${tx}/${ty}`;
+    let tile = tileCache.get(key);
+    if (tile) {
+        tileCache.delete(key);   // most recently used last
+    } else {
+        const T = imageInfo.tile_size;
+        tile = document.createElement("img");
+        tile.classList.add("tile");
+        tile.style.left = `${tx * T / k}px`;
+        tile.style.top = `${ty * T / k}px`;
+        tile.style.width = `${w / k}px`;
+        tile.style.height = `${h / k}px`;
+        tile.src = `/tile?image=${encodeURIComponent(currentImage.name)}&level=${level}&x=${tx}&y=${ty}`;
+    }
+    tileCache.set(key, tile);
+
+    // Bound the decoded tiles kept around (tablets)
+    if (tileCache.size > TILE_CACHE_MAX) {
+        tileCache.delete(tileCache.keys().next().value);
+    }
+    return tile;
+}
+
+window.addEventListener("resize", scheduleTiles);
@@ -4,66 +4,152 @@ const gallery = document.querySelector('#gallery');  // Select gallery container
 // NEW: base path now points to images/ subfolder
 const STATIC_UPLOADS_BASE = "/static/uploads/images";
 
-// Fetch and display all images from the server
-function loadGalleryImages() {
-    const filterInput = document.getElementById('filterInput');
-    const onlyLabeledCheckbox = document.getElementById('onlyLabeledCheckbox');
+// Virtualized grid: must match #gallery in styles.css
+const TILE_MIN_WIDTH = 250;
+const GRID_GAP = 20;
+const GRID_PADDING = 20;
+const OVERSCAN_ROWS = 2;
+
+// Local copy of the catalog, kept current with /changes deltas
+const catalog = new Map();   // filename -> image entry
+let catalogVersion = 0;
+let visibleImages = [];      // filtered and sorted view of the catalog
+let rowHeight = 300;         // measured from the first rendered tile
+let syncing = false;
+let syncAgain = false;
+
+// One observer for all tiles (loads images only when they are near the viewport)
+const imageObserver = new IntersectionObserver((entries, observer) => {
+    entries.forEach(entry => {
+        if (entry.isIntersecting) {
+            entry.target.src = entry.target.dataset.src;  // Load image
+            entry.target.onload = () => entry.target.style.visibility = 'visible'; // Show after loading
+            observer.unobserve(entry.target); // Stop observing after loading
+        }
+    });
+}, { rootMargin: '100px' }); // Load images slightly before they appear on screen
 
-    let url = '/get-images';
-    const params = [];
 
-    if (filterInput && filterInput.value.trim() !== '') {
-        params.push('filter=' + encodeURIComponent(filterInput.value.trim()));
+// Fetch the changes since the last applied version and apply them
+function syncGallery() {
+    if (syncing) {
+        syncAgain = true;
+        return;
     }
+    syncing = true;
+
+    fetch(`/changes?since=${catalogVersion}`)
+        .then(response => response.json())
+        .then(delta => {
+            if (delta.full) {
+                catalog.clear();
+            }
+            delta.deleted.forEach(filename => catalog.delete(filename));
+            delta.upserts.forEach(imageData => catalog.set(imageData.filename, imageData));
+            catalogVersion = delta.version;
+
+            if (delta.full || delta.deleted.length || delta.upserts.length) {
+                applyFilters();
+            }
+        })
+        .catch(err => console.error('Sync error:', err))
+        .finally(() => {
+            syncing = false;
+            if (syncAgain) {
+                syncAgain = false;
+                syncGallery();
+            }
+        });
+}
+
 
-    if (onlyLabeledCheckbox && onlyLabeledCheckbox.checked) {
-        params.push('only_labeled=1');  // means NON-labeled only (backend logic)
+// Filter and sort the local catalog (same semantics as /get-images), then render
+function applyFilters() {
+    const filterInput = document.getElementById('filterInput');
+    const onlyLabeledCheckbox = document.getElementById('onlyLabeledCheckbox');
+    const collapseCheckbox = document.getElementById('collapseDuplicatesCheckbox');
+    const filterStr = filterInput ? filterInput.value.trim().toLowerCase() : '';
+    const onlyNonLabeled = onlyLabeledCheckbox && onlyLabeledCheckbox.checked;
+    const collapse = collapseCheckbox && collapseCheckbox.checked;
+
+    let labeled = 0;
+    visibleImages = [];
+    catalog.forEach(imageData => {
+        if (imageData.is_labeled) labeled++;
+        if (filterStr && !imageData.filename.toLowerCase().includes(filterStr)) return;
+        if (onlyNonLabeled && imageData.is_labeled) return;  // means NON-labeled only
+        visibleImages.push(imageData);
+    });
+    visibleImages.sort((a, b) => b.upload_ts - a.upload_ts);  // newest first
+
+    // One tile per near-duplicate group: its newest shown image
+    if (collapse) {
+        const seen = new Set();
+        visibleImages = visibleImages.filter(imageData => {
+            if (!imageData.duplicate_group) return true;
+            if (seen.has(imageData.duplicate_group)) return false;
+            seen.add(imageData.duplicate_group);
+            return true;
+        });
     }
 
-    if (params.length > 0) {
-        url += '?' + params.join('&');
+    const counter = document.getElementById('labeledCounter');
+    if (counter) {
+        counter.textContent = `${labeled} / ${catalog.size} labeled (shown ${visibleImages.length})`;
     }
 
-    fetch(url)
-        .then(response => response.json())
-        .then(images => {
-
-            // --- Compute global stats (unfiltered) ---
-            return fetch('/get-images')
-                .then(res => res.json())
-                .then(allImages => {
-                    const total = allImages.length;
-                    const labeled = allImages.filter(img => img.is_labeled).length;
-                    const shown = images.length;
-
-                    const counter = document.getElementById('labeledCounter');
-                    if (counter) {
-                        counter.textContent = `${labeled} / ${total} labeled (shown ${shown})`;
-                    }
-
-                    return images;
-                });
-        })
-        .then(images => {
-            console.log("Fetched images (filtered):", images);
+    renderVisibleTiles();
+}
 
-            // OPTIONAL: backend already returns them sorted by timestamp
-            // If you prefer that order, comment out the next line.
-            // images.sort((a, b) => b.filename.localeCompare(a.filename));
 
-            gallery.innerHTML = "";
+// Render only the rows of tiles in (or near) the viewport; padding stands in for the rest
+function renderVisibleTiles() {
+    const width = gallery.clientWidth - 2 * GRID_PADDING;
+    const columns = Math.max(1, Math.floor((width + GRID_GAP) / (TILE_MIN_WIDTH + GRID_GAP)));
+    const totalRows = Math.ceil(visibleImages.length / columns);
 
-            images.forEach(imageData => {
-                addImageToGallery(imageData, false);
-            });
-        });
+    const top = gallery.getBoundingClientRect().top + GRID_PADDING;
+    const firstRow = Math.max(0, Math.floor(-top / rowHeight) - OVERSCAN_ROWS);
+    const lastRow = Math.min(totalRows - 1, Math.ceil((window.innerHeight - top) / rowHeight) + OVERSCAN_ROWS);
+
+    gallery.style.gridTemplateColumns = `repeat(${columns}, minmax(0, 1fr))`;
+    gallery.style.paddingTop = `${GRID_PADDING + firstRow * rowHeight}px`;
+    gallery.style.paddingBottom = `${GRID_PADDING + Math.max(0, totalRows - lastRow - 1) * rowHeight}px`;
+
+    const tiles = visibleImages
+        .slice(firstRow * columns, (lastRow + 1) * columns)
+        .map(createTile);
+    gallery.replaceChildren(...tiles);
+
+    if (tiles.length) {
+        const measured = tiles[0].offsetHeight + GRID_GAP;
+        if (measured > GRID_GAP && Math.abs(measured - rowHeight) > 1) {
+            rowHeight = measured;
+            renderVisibleTiles();
+        }
+    }
 }
 
+let renderScheduled = false;
 
+function scheduleRender() {
+    if (renderScheduled) return;
+    renderScheduled = true;
+    requestAnimationFrame(() => {
+        renderScheduled = false;
+        renderVisibleTiles();
+    });
+}
 
-// Add an image to the gallery with optional real-time effect
-function addImageToGallery(imageData, isRealTime = true) {
-    console.log("Adding image:", imageData.filename); // Debugging
+
+// Tile DOM nodes are reused while their entry is unchanged
+const tileCache = new Map();  // filename -> {imageData, div}
+
+function createTile(imageData) {
+    const cached = tileCache.get(imageData.filename);
+    if (cached && cached.imageData === imageData) {
+        return cached.div;
+    }
 
     const div = document.createElement('div');
     div.classList.add('col', 'gallery-item');   // add gallery-item for CSS positioning
@@ -87,8 +173,9 @@ function addImageToGallery(imageData, isRealTime = true) {
             .then(res => res.json())
             .then(data => {
                 if (data.status === 'success' || data.status === 'partial') {
-                    // remove from DOM
-                    div.remove();
+                    catalog.delete(imageData.filename);
+                    tileCache.delete(imageData.filename);
+                    applyFilters();
                 } else {
                     alert('Delete failed: ' + (data.message || 'unknown error'));
                 }
@@ -110,7 +197,7 @@ function addImageToGallery(imageData, isRealTime = true) {
 
     // When clicking the image (or the whole div), open labeler
     const host = window.location.hostname;
-    const labelerUrl = `http://${host}:5001/label?image=${encodeURIComponent(imageData.filename)}`;
+    const labelerUrl = `http://${host}:${window.LABELER_PORT || 5001}/label?image=${encodeURIComponent(imageData.filename)}`;
 
     div.style.cursor = 'pointer';
     div.addEventListener('click', () => {
@@ -123,11 +210,14 @@ function addImageToGallery(imageData, isRealTime = true) {
     const labeledText = imageData.is_labeled
         ? '🟩 labeled'
         : '⬜ non-labeled';
+    const duplicatesText = imageData.duplicates > 1
+        ? ` · ${imageData.duplicates - 1} similar`
+        : '';
 
     metadataDiv.innerHTML = `
         ${imageData.filename}
         (<strong>Labels: ${imageData.labels_count ?? 0}</strong>)<br>
-        ${labeledText}
+        ${labeledText}${duplicatesText}
     `;
 
     // order: X button on top, then img, then metadata
@@ -135,13 +225,15 @@ function addImageToGallery(imageData, isRealTime = true) {
     div.appendChild(img);
     div.appendChild(metadataDiv);
 
-    if (isRealTime) {
-        gallery.prepend(div);
-    } else {
-        gallery.appendChild(div);
-    }
+    imageObserver.observe(img);
+    tileCache.set(imageData.filename, { imageData, div });
 
-    lazyLoadImage(img);
+    // Bound the cache to a few screens of tiles
+    if (tileCache.size > 2000) {
+        const oldest = tileCache.keys().next().value;
+        tileCache.delete(oldest);
+    }
+    return div;
 }
 
 document.addEventListener('DOMContentLoaded', () => {
@@ -156,51 +248,45 @@ document.addEventListener('DOMContentLoaded', () => {
     const onlyLabeledCheckbox = document.getElementById('onlyLabeledCheckbox');
 
     if (filterInput) {
-        // reload on typing (you can debounce later if needed)
+        // filtering is local: no request per keystroke
         filterInput.addEventListener('input', () => {
-            loadGalleryImages();
+            applyFilters();
         });
     }
 
     if (onlyLabeledCheckbox) {
         onlyLabeledCheckbox.addEventListener('change', () => {
-            loadGalleryImages();
+            applyFilters();
         });
     }
-});
-
 
-// Lazy loading for images (loads only when they are near the viewport)
-function lazyLoadImage(img) {
-    const observer = new IntersectionObserver((entries, observer) => {
-        entries.forEach(entry => {
-            if (entry.isIntersecting) {
-                entry.target.src = entry.target.dataset.src;  // Load image
-                entry.target.onload = () => entry.target.style.visibility = 'visible'; // Show after loading
-                observer.unobserve(entry.target); // Stop observing after loading
-            }
+    const collapseCheckbox = document.getElementById('collapseDuplicatesCheckbox');
+    if (collapseCheckbox) {
+        collapseCheckbox.addEventListener('change', () => {
+            applyFilters();
         });
-    }, { rootMargin: '100px' }); // Load images slightly before they appear on screen
+    }
+});
 
-    observer.observe(img);
-}
+window.addEventListener('scroll', scheduleRender, { passive: true });
+window.addEventListener('resize', scheduleRender);
 
-// Listen for real-time image uploads via WebSockets
-socket.on('new_image', (data) => {
-    addImageToGallery(data, true); // Add new image to gallery
+// Real-time uploads via WebSockets: fetch the delta (also covers missed events)
+socket.on('new_image', () => {
+    syncGallery();
 });
 
-// Load all images when the page loads
-loadGalleryImages();
+// Initial full snapshot (since=0)
+syncGallery();
 
-// Reload gallery when tab becomes visible again
+// Catch up when the tab becomes visible again (only what changed meanwhile)
 document.addEventListener("visibilitychange", () => {
     if (document.visibilityState === "visible") {
-        loadGalleryImages();
+        syncGallery();
     }
 });
 
-// Also reload when window gets focus
+// Also catch up when window gets focus
 window.addEventListener("focus", () => {
-    loadGalleryImages();
+    syncGallery();
 });
@@ -0,0 +1,78 @@
+import os
+import collections
+
+from changes import ChangeLog
+from dataset import TrainingSet, val_count
+
+
+def make_uploads(root, names, cls=0):
+    for d in ("images", "labels"):
+        os.makedirs(os.path.join(root, d), exist_ok=True)
+    for name in names:
+        with open(os.path.join(root, "images", name), "wb") as f:
+            f.write(b"jpeg")
+        with open(os.path.join(root, "labels", os.path.splitext(name)[0] + ".txt"), "w") as f:
+            f.write(f"{cls} 0.5 0.5 0.1 0.1\n")
+
+
+def training_set(root, out="dataset"):
+    return TrainingSet(str(root), str(root / out), ChangeLog(str(root / "changes.sqlite")))
+
+
+def splits(training):
+    return {name: e["split"] for name, e in training._load_state()["images"].items()}
+
+
+def test_split_is_stable_and_proportional(tmp_path):
+    names = [f"img_20230720-{i:06d}.jpg" for i in range(2000)]
+    make_uploads(str(tmp_path), names)
+    training = training_set(tmp_path)
+    summary = training.sync()
+
+    assert summary["images"] == {"train": 1600, "val": 400}
+    entries = training._load_state()["images"]
+    assert all(e["stratum"] == "0|unknown" for e in entries.values())
+
+    # Rebuilding from scratch gives the same splits
+    rebuilt = training_set(tmp_path, "rebuilt")
+    rebuilt.sync()
+    assert splits(rebuilt) == splits(training)
+
+
+def test_splits_are_kept_as_a_stratum_grows(tmp_path):
+    make_uploads(str(tmp_path), [f"img_20230720-{i:06d}.jpg" for i in range(10)])
+    changes = ChangeLog(str(tmp_path / "changes.sqlite"))
+    training = TrainingSet(str(tmp_path), str(tmp_path / "dataset"), changes)
+    training.sync()
+    before = splits(training)
+
+    added = [f"img_20230721-{i:06d}.jpg" for i in range(10)]
+    make_uploads(str(tmp_path), added)
+    changes.record_many(added, "added")
+    summary = training.sync()
+
+    after = splits(training)
+    assert {name: after[name] for name in before} == before
+    assert summary["images"]["val"] == val_count(20)
+
+
+def test_small_strata_get_val_images(tmp_path):
+    # Twenty strata (class x device) of two images each, and one of a single image
+    for cls in range(5):
+        for dev in range(4):
+            mac = f"b8-27-eb-3b-8d-{dev:02x}"
+            make_uploads(str(tmp_path), [f"2023-07-2{cls}T10-00-0{i}+0200_{mac}.jpeg" for i in range(2)], cls)
+    make_uploads(str(tmp_path), ["2023-07-20T10-00-00+0200_b8-27-eb-3b-8d-ff.jpeg"], 5)
+    training = training_set(tmp_path)
+    training.sync()
+
+    per_stratum = collections.defaultdict(collections.Counter)
+    for e in training._load_state()["images"].values():
+        per_stratum[e["stratum"]][e["split"]] += 1
+    assert len(per_stratum) == 21
+    for stratum, counts in per_stratum.items():
+        if stratum == "5|b8-27-eb-3b-8d-ff":
+            assert counts == {"train": 1}
+        else:
+            assert counts == {"train": 1, "val": 1}, stratum
+    assert len(os.listdir(tmp_path / "dataset" / "images" / "val")) == 20
@@ -0,0 +1,25 @@
+import datetime
+
+from filenames import capture_time, device_of
+
+MAC = "b8-27-eb-3b-8d-1c"
+
+
+def test_device_only_from_mac_suffix():
+    assert device_of(f"2023-07-20T20-19-46+0200_{MAC}.jpeg") == MAC
+    assert device_of(f"2023-07-20T20-19-46+0200_{MAC.upper()}.jpeg") == MAC
+    assert device_of("img_20230720-201946.jpg") is None
+    assert device_of("2023-07-20T20-19-46+0200.jpeg") is None
+    assert device_of("photo_of_ants.jpg") is None
+
+
+def test_capture_time_from_either_name(tmp_path):
+    path = tmp_path / "x.jpg"
+    path.write_bytes(b"")
+    expected = datetime.datetime(2023, 7, 20, 18, 19, 46, tzinfo=datetime.timezone.utc).timestamp()
+    assert capture_time(f"2023-07-20T20-19-46+0200_{MAC}.jpeg", str(path)) == expected
+    assert capture_time(f"2023-07-20T20-19-460200_{MAC}.jpeg", str(path)) == expected   # secure_filename()
+    assert capture_time(f"2023-07-20T14-19-46-0400_{MAC}.jpeg", str(path)) == expected
+    assert capture_time("img_20230720-201946.jpg", str(path)) == datetime.datetime(2023, 7, 20, 20, 19, 46).timestamp()
+    assert capture_time("photo_of_ants.jpg", str(path)) == path.stat().st_mtime
+    assert capture_time("img_20231340-999999.jpg", str(path)) == path.stat().st_mtime
@@ -0,0 +1,61 @@
+import os
+import importlib
+
+from PIL import Image
+
+from retention import Retention
+
+NAME = "2023-07-20T20-19-460200_b8-27-eb-3b-8d-1c.jpeg"
+
+
+def make_image(path, size):
+    Image.new("RGB", size, (120, 80, 40)).save(path, "JPEG")
+
+
+def labeled_root(root):
+    for d in ("images", "jsons"):
+        os.makedirs(os.path.join(root, d), exist_ok=True)
+    with open(os.path.join(root, "jsons", os.path.splitext(NAME)[0] + ".json"), "w") as f:
+        f.write("[]\n")
+
+
+def test_reupload_drops_the_archived_copy(tmp_path, monkeypatch):
+    monkeypatch.setattr(Retention, "archive_frees", True)
+    root = str(tmp_path)
+    labeled_root(root)
+    path = os.path.join(root, "images", NAME)
+    make_image(path, (800, 600))
+    retention = Retention(root, os.path.join(root, "archive"))
+    assert retention.archive(NAME)
+    assert retention.archived(NAME) is not None
+
+    # The full original arrives under the same name
+    retention.replace(NAME, lambda: make_image(path, (4000, 3000)))
+
+    assert retention.archived(NAME) is None
+    assert retention.read_original(NAME) is None
+    assert not retention.restore(NAME)
+    with Image.open(path) as img:
+        assert img.size == (4000, 3000)
+
+
+def test_receive_overwriting_an_archived_image(tmp_path, monkeypatch):
+    monkeypatch.setenv("ANTPI_UPLOAD_ROOT", str(tmp_path))
+    monkeypatch.setattr(Retention, "archive_frees", True)
+    server = importlib.import_module("server-picture")
+    client = server.app.test_client()
+
+    def upload(size, variant):
+        path = str(tmp_path / "upload.jpg")
+        make_image(path, size)
+        with open(path, "rb") as f:
+            return client.post("/receive", data={"image": (f, NAME), "variant": variant},
+                               content_type="multipart/form-data")
+
+    assert upload((800, 600), "reduced").status_code == 200
+    assert server.retention.archive(NAME)
+    assert upload((4000, 3000), "full").status_code == 200
+
+    assert not server.retention.restore(NAME)
+    with Image.open(os.path.join(server.IMAGES_DIR, NAME)) as img:
+        assert img.size == (4000, 3000)
@@ -0,0 +1,33 @@
+"""
+Data directories of the servers and the stores on them, set up once: both
+server-picture.py and server-labeler.py import them from here, so when the
+two run in one process (server.py) they share one change log connection,
+one retention index and one label cache.
+
+ANTPI_UPLOAD_ROOT points the servers at another data directory
+(loadtest.py); ANTPI_ARCHIVE_DIR moves the retention archive (retention.py).
+"""
+import os
+from changes import ChangeLog
+from retention import Retention
+from labels import LabelStore
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+UPLOAD_ROOT = os.environ.get("ANTPI_UPLOAD_ROOT", os.path.join(STATIC_DIR, "uploads"))
+
+IMAGES_DIR = os.path.join(UPLOAD_ROOT, "images")      # image files
+LABELS_DIR = os.path.join(UPLOAD_ROOT, "labels")      # YOLO txt files
+JSONS_DIR = os.path.join(UPLOAD_ROOT, "jsons")        # per-image json files
+VARIANTS_DIR = os.path.join(UPLOAD_ROOT, "variants")  # sidecars for non-full uploads
+PYRAMID_DIR = os.path.join(UPLOAD_ROOT, "pyramid")    # labeler previews/tiles (pyramid.py)
+# Old originals: re-encoded or archived with a thumbnail left in place (retention.py)
+ARCHIVE_DIR = os.environ.get("ANTPI_ARCHIVE_DIR", os.path.join(UPLOAD_ROOT, "archive"))
+
+for d in (IMAGES_DIR, LABELS_DIR, JSONS_DIR, VARIANTS_DIR):
+    os.makedirs(d, exist_ok=True)
+
+# Catalog change log: uploads and deletions (picture), relabels (labeler)
+changes = ChangeLog(os.path.join(UPLOAD_ROOT, "changes.sqlite"))
+retention = Retention(UPLOAD_ROOT, ARCHIVE_DIR)
+label_store = LabelStore(UPLOAD_ROOT, changes)
@@ -0,0 +1,114 @@
+"""
+Long-lived benchmark worker, run on the device next to rpi.py.
+
+benchmark.py starts it once (over ssh, or as a local subprocess for
+testing) and sends experiments as JSON lines on stdin:
+
+    {"id": 1, "op": "run_test", "args": {"mod": "v11n", "prec": "FP16", "form": "openvino"}}
+
+Each request is answered on stdout with JSON lines:
+
+    {"id": 1, "event": "started", "temp_C": ..., "t": ...}
+    {"id": 1, "event": "result", "data": {...}, "t": ...}
+    {"id": 1, "event": "error", "message": "...", "t": ...}
+
+Requests are queued and run one at a time; the worker exits after the
+queue drains once stdin is closed, or on {"op": "shutdown"}. The "ready"
+message carries the environment fingerprint (library versions, device
+model, governor, temperature). Ultralytics and the backends stay imported
+between experiments, so only the first one pays the interpreter and
+import startup.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import threading
+import traceback
+
+# Keep the protocol stream clean: anything written to fd 1 by Python code,
+# Ultralytics or native backends goes to stderr instead.
+protocol = os.fdopen(os.dup(1), "w", buffering=1)
+os.dup2(2, 1)
+sys.stdout = sys.stderr
+
+import_start = time.time()
+import rpi  # noqa: E402  (heavy: ultralytics, torch, cv2)
+import_time = time.time() - import_start
+
+from profiler import environment_fingerprint, read_temperature  # noqa: E402
+
+OPS = {
+    "run_test": rpi.run_test,
+    "convert_model": rpi.convert_model,
+    "validate": rpi.run_validation,
+    "sweep": rpi.run_concurrency_sweep,
+}
+
+
+def send(message):
+    message["t"] = time.time()
+    protocol.write(json.dumps(message) + "\n")
+
+
+def read_requests(requests):
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            requests.put(json.loads(line))
+        except ValueError:
+            send({"event": "error", "message": f"invalid request: {line[:200]}"})
+    requests.put(None)  # stdin closed
+
+
+def main():
+    requests = queue.Queue()
+    threading.Thread(target=read_requests, args=(requests,), daemon=True).start()
+    send({
+        "event": "ready",
+        "pid": os.getpid(),
+        "import_s": round(import_time, 3),
+        "fingerprint": environment_fingerprint(),
+    })
+
+    while (req := requests.get()) is not None:
+        req_id = req.get("id")
+        op = req.get("op")
+
+        if op == "shutdown":
+            break
+        if op == "fingerprint":
+            send({"id": req_id, "event": "result", "data": environment_fingerprint()})
+            continue
+        if op == "ping":
+            send({"id": req_id, "event": "result", "data": {"pending": requests.qsize()}})
+            continue
+        if op not in OPS:
+            send({"id": req_id, "event": "error", "message": f"unknown op: {op}"})
+            continue
+
+        args = req.get("args", {})
+        reason = rpi.unsupported_reason(args.get("mod", ""), args.get("prec", ""), args.get("form", ""))
+        if reason and op != "convert_model":
+            send({"id": req_id, "event": "error", "message": reason})
+            continue
+
+        send({"id": req_id, "event": "started", "pending": requests.qsize(), "temp_C": read_temperature()})
+        try:
+            data = OPS[op](**args)
+        except Exception as e:
+            traceback.print_exc()
+            send({"id": req_id, "event": "error", "message": str(e)})
+            continue
+
+        if data is None:
+            send({"id": req_id, "event": "error", "message": "no result (see worker stderr)"})
+        else:
+            send({"id": req_id, "event": "result", "data": data})
+
+
+if __name__ == "__main__":
+    main()